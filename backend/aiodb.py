@@ -0,0 +1,257 @@
+import asyncio
+import functools
+import os
+import time
+import uuid
+from contextlib import asynccontextmanager
+
+import psycopg
+import psycopg_pool
+from psycopg.conninfo import make_conninfo
+from starlette.responses import Response
+
+from db import PoolTimeout, _db_time, _env_float, _env_int, _record
+from logs import get_logger
+from metrics import DB_POOL_ACQUIRE, metrics
+
+log = get_logger("aiodb")
+
+DB_CANCELLED = metrics.counter(
+    "db_cancelled_queries_total", "Read queries cancelled because the client went away",
+)
+
+
+# Same settings as db.get_connection, for psycopg 3
+def conninfo():
+    return make_conninfo(
+        dbname=os.getenv("POSTGRES_DB", "iot"),
+        user=os.getenv("POSTGRES_USER", "postgres"),
+        password=os.getenv("POSTGRES_PASSWORD", "secret"),
+        host=os.getenv("POSTGRES_HOST", "db"),
+        port="5432",
+        sslmode="require",
+    )
+
+
+class InstrumentedAsyncCursor(psycopg.AsyncCursor):
+    """Async twin of db.InstrumentedCursor: same metrics, same slow-query log."""
+
+    async def execute(self, query, params=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            _record(query, time.perf_counter() - started, self.rowcount)
+
+
+class AsyncDatabase:
+    """asyncio pool of psycopg 3 connections for the read routes.
+
+    A request waiting for a connection or a query parks a coroutine instead
+    of a threadpool thread, so in-flight requests are bounded by memory and
+    ``max_waiting``, not by the ~40 worker threads. Connections run in
+    autocommit (reads need no BEGIN/COMMIT round-trips); use
+    ``conn.transaction()`` for anything that must share one.
+
+    Cancelling the awaiting task (see ``cancel_on_disconnect``) cancels the
+    statement on the server too.
+    """
+
+    def __init__(self, minconn=1, maxconn=20, max_age=1800.0, max_idle=600.0,
+                 timeout=10.0, max_waiting=0):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("invalid pool size: min=%s max=%s" % (minconn, maxconn))
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.max_age = max_age
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.max_waiting = max_waiting
+        self._pool = None
+
+    async def open(self):
+        if self._pool is None:
+            self._pool = psycopg_pool.AsyncConnectionPool(
+                conninfo(),
+                min_size=self.minconn,
+                max_size=self.maxconn,
+                max_lifetime=self.max_age,
+                max_idle=self.max_idle,
+                timeout=self.timeout,
+                max_waiting=self.max_waiting,
+                kwargs={"autocommit": True, "cursor_factory": InstrumentedAsyncCursor},
+                open=False,
+            )
+        await self._pool.open(wait=False)
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+
+    @asynccontextmanager
+    async def connection(self):
+        started = time.perf_counter()
+        try:
+            if self._pool is None:
+                raise PoolTimeout("async connection pool is not open")
+            try:
+                conn = await self._pool.getconn()
+            except (psycopg_pool.PoolTimeout, psycopg_pool.TooManyRequests) as e:
+                raise PoolTimeout(str(e))
+            DB_POOL_ACQUIRE.observe("async", value=time.perf_counter() - started)
+            try:
+                yield conn
+            finally:
+                await self._pool.putconn(conn)
+        finally:
+            tally = _db_time.get()
+            if tally is not None:
+                tally[0] += time.perf_counter() - started
+
+    async def iter_query(self, sql, params, chunk_size):
+        """Yield lists of rows from a server-side cursor, holding one
+        connection until the generator is exhausted, closed or cancelled."""
+        async with self.connection() as conn:
+            async with conn.transaction():
+                cursor = conn.cursor(name=f"stream_{uuid.uuid4().hex}")
+                started, elapsed, rows = time.perf_counter(), 0.0, 0
+                try:
+                    await cursor.execute(sql, params)
+                    elapsed = time.perf_counter() - started
+                    while True:
+                        started = time.perf_counter()
+                        chunk = await cursor.fetchmany(chunk_size)
+                        elapsed += time.perf_counter() - started
+                        if not chunk:
+                            break
+                        rows += len(chunk)
+                        yield chunk
+                finally:
+                    await cursor.close()
+                    _record(sql, elapsed, rows)
+
+    def stats(self):
+        if self._pool is None:
+            return {"open": False}
+        s = self._pool.get_stats()
+        return {
+            "open": True,
+            "min": self.minconn,
+            "max": self.maxconn,
+            "size": s.get("pool_size", 0),
+            "idle": s.get("pool_available", 0),
+            "waiting": s.get("requests_waiting", 0),
+            "acquired": s.get("requests_num", 0),
+            "waited": s.get("requests_queued", 0),
+            "wait_ms_total": s.get("requests_wait_ms", 0),
+            "timeouts": s.get("requests_errors", 0),
+            "opened": s.get("connections_num", 0),
+            "lost": s.get("connections_lost", 0),
+        }
+
+
+# 499 (client closed request): nobody reads it, but it shows up in metrics
+CLIENT_CLOSED = 499
+
+
+def cancel_on_disconnect(handler, poll=0.25):
+    """Decorate an async route that takes ``request`` so it is cancelled if
+    the client disconnects before it finishes.
+
+    The client is checked every ``poll`` seconds; on disconnect the handler
+    task is cancelled (psycopg sends a cancel request for a running
+    statement) and a 499 response is returned. Quick handlers finish before
+    the first check.
+    """
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        request = kwargs["request"]
+        task = asyncio.ensure_future(handler(*args, **kwargs))
+        try:
+            while True:
+                done, _ = await asyncio.wait({task}, timeout=poll)
+                if done:
+                    return task.result()
+                if await request.is_disconnected():
+                    task.cancel()
+                    # Finishes in the background once the server has cancelled
+                    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+                    DB_CANCELLED.inc()
+                    return Response(status_code=CLIENT_CLOSED)
+        finally:
+            if not task.done():
+                task.cancel()
+    return wrapper
+
+
+class Listener:
+    """One LISTEN connection per worker, shared by everything that reacts to
+    NOTIFY (live push, cache invalidation).
+
+    Handlers are called with the payload on the event loop and must not
+    block. Notifications sent while the connection is down are lost, so
+    after a reconnect each channel's ``on_reconnect`` runs to let its owner
+    resync (e.g. drop a cache).
+    """
+
+    def __init__(self):
+        self._channels = {}  # channel -> (on_notify, on_reconnect)
+        self._task = None
+        self.connected = False
+        self.received = 0
+        self.reconnects = 0
+
+    def subscribe(self, channel, on_notify, on_reconnect=None):
+        self._channels[channel] = (on_notify, on_reconnect)
+
+    async def start(self):
+        if self._channels and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        delay = 1.0
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(conninfo(), autocommit=True) as conn:
+                    for channel in self._channels:
+                        await conn.execute(f"LISTEN {channel}")
+                    if self.reconnects:
+                        for _, on_reconnect in self._channels.values():
+                            if on_reconnect is not None:
+                                on_reconnect()
+                    self.connected = True
+                    delay = 1.0
+                    async for note in conn.notifies():
+                        self.received += 1
+                        try:
+                            self._channels[note.channel][0](note.payload)
+                        except Exception as e:
+                            log.error("notification handler failed", extra={"channel": note.channel, "error": repr(e)})
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("listener disconnected", extra={"error": repr(e), "retry_s": delay})
+            self.connected = False
+            self.reconnects += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+
+
+listener = Listener()
+
+adb = AsyncDatabase(
+    minconn=_env_int("ASYNC_DB_POOL_MIN", 1),
+    maxconn=_env_int("ASYNC_DB_POOL_MAX", 20),
+    max_age=_env_float("DB_POOL_MAX_AGE", 1800),
+    timeout=_env_float("DB_POOL_TIMEOUT", 10),
+    max_waiting=_env_int("ASYNC_DB_MAX_WAITING", 0),
+)
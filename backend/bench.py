@@ -0,0 +1,345 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlencode, urlsplit
+
+PREFIX = "bench-"
+EMAIL = "bench@example.com"
+MANIFEST = "bench_seed.json"
+
+
+# --- Seeding ---------------------------------------------------------------
+
+def reset(cursor):
+    """Remove everything a previous seed created."""
+    like = PREFIX + "%"
+    cursor.execute("DELETE FROM device_data WHERE device_id LIKE %s", (like,))
+    for table in ("device_rollups_hourly", "device_rollups_daily", "device_stats"):
+        cursor.execute(f"DELETE FROM {table} WHERE device_id LIKE %s", (like,))
+    cursor.execute("""
+        DELETE FROM unit_devices WHERE unit_id IN (SELECT id FROM units WHERE name LIKE %s)
+    """, (like,))
+    cursor.execute("DELETE FROM units WHERE name LIKE %s", (like,))
+    cursor.execute("DELETE FROM devices WHERE device_id LIKE %s", (like,))
+    cursor.execute("DELETE FROM users WHERE email = %s", (EMAIL,))
+    cursor.execute("DELETE FROM organisations WHERE name = %s", (PREFIX + "org",))
+
+
+def seed(conn, devices=50, days=30, interval_minutes=5, end=None):
+    """Create an organisation, a user, ``devices`` devices with ``days`` of
+    readings every ``interval_minutes``, and one unit per pair of devices
+    (the second device swapped in halfway through). Returns the manifest.
+    """
+    from device_stats import device_stats
+    from migrations import migrate
+    from passwords import pwd_context
+    from rollups import rollups
+
+    migrate(conn)
+    cursor = conn.cursor()
+    reset(cursor)
+
+    end = (end or datetime.utcnow()).replace(second=0, microsecond=0)
+    start = end - timedelta(days=days)
+    middle = start + (end - start) / 2
+
+    cursor.execute("INSERT INTO organisations (name) VALUES (%s) RETURNING id", (PREFIX + "org",))
+    org_id = cursor.fetchone()[0]
+    cursor.execute(
+        "INSERT INTO users (email, password_hash, name, organisation_id) VALUES (%s, %s, %s, %s) RETURNING id",
+        (EMAIL, pwd_context.hash("bench"), "Bench", org_id)
+    )
+    user_id = cursor.fetchone()[0]
+
+    device_ids = [f"{PREFIX}{i:05d}" for i in range(devices)]
+    cursor.execute("""
+        INSERT INTO devices (device_id, name, owner_id, organisation_id)
+        SELECT d, d, %s, %s FROM unnest(%s::varchar[]) d
+    """, (user_id, org_id, device_ids))
+
+    unit_ids = []
+    for i in range(0, devices - 1, 2):
+        cursor.execute(
+            "INSERT INTO units (name, organisation_id, commissioned_at) VALUES (%s, %s, %s) RETURNING id",
+            (f"{PREFIX}unit-{i // 2:05d}", org_id, start)
+        )
+        unit_id = cursor.fetchone()[0]
+        unit_ids.append(unit_id)
+        cursor.execute("""
+            INSERT INTO unit_devices (unit_id, device_id, attached_at, detached_at, active)
+            SELECT %s, d.id, w.attached_at, w.detached_at, w.active
+            FROM (VALUES (%s, %s::timestamp, %s::timestamp, FALSE), (%s, %s, NULL, TRUE))
+                 AS w(device_id, attached_at, detached_at, active)
+            JOIN devices d ON d.device_id = w.device_id
+        """, (unit_id, device_ids[i], start, middle, device_ids[i + 1], middle))
+
+    cursor.execute("""
+        INSERT INTO device_data (device_id, volume_ml, timestamp)
+        SELECT d, (random() * 100)::int, ts
+        FROM unnest(%s::varchar[]) d,
+             generate_series(%s::timestamp, %s::timestamp, %s * interval '1 minute') ts
+    """, (device_ids, start, end, interval_minutes))
+    readings = cursor.rowcount
+    conn.commit()
+    cursor.close()
+
+    # Serve reads from the same fast paths production uses
+    rollups.rebuild(conn)
+    device_stats.reconcile(conn)
+
+    return {
+        "organisation_id": org_id,
+        "user_id": user_id,
+        "email": EMAIL,
+        "devices": device_ids,
+        "units": unit_ids,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "interval_minutes": interval_minutes,
+        "readings": readings,
+    }
+
+
+# --- Scenarios -------------------------------------------------------------
+
+def _window(rng, manifest, span):
+    start = datetime.fromisoformat(manifest["start"])
+    end = datetime.fromisoformat(manifest["end"])
+    offset = rng.random() * max((end - start - span).total_seconds(), 0)
+    lo = start + timedelta(seconds=offset)
+    return lo.isoformat(), (lo + span).isoformat()
+
+
+def _reading(rng, manifest):
+    start = datetime.fromisoformat(manifest["start"])
+    end = datetime.fromisoformat(manifest["end"])
+    ts = start + (end - start) * rng.random()
+    return {"device_id": rng.choice(manifest["devices"]), "volume_ml": rng.randint(1, 100), "timestamp": ts.isoformat()}
+
+
+# name -> builder(rng, manifest, options) -> (method, path, body)
+SCENARIOS = {
+    "ingest": lambda rng, m, o: ("POST", "/ingest", _reading(rng, m)),
+    "ingest_batch": lambda rng, m, o: (
+        "POST", "/ingest/batch", [_reading(rng, m) for _ in range(o.batch_size)]),
+    "data": lambda rng, m, o: (
+        "GET", f"/data/{rng.choice(m['devices'])}?" + urlencode(
+            dict(zip(("start", "end"), _window(rng, m, timedelta(days=1))))), None),
+    "unit_data": lambda rng, m, o: (
+        "GET", "/unit/data?" + urlencode(dict(
+            zip(("from", "to"), _window(rng, m, timedelta(days=1))), unitId=rng.choice(m["units"]))), None),
+    "histogram": lambda rng, m, o: (
+        "GET", f"/data/{rng.choice(m['devices'])}/histogram?" + urlencode(dict(
+            zip(("start", "end"), _window(rng, m, timedelta(days=7))), interval="hour")), None),
+    "histogram_multi": lambda rng, m, o: (
+        "GET", "/histogram?" + urlencode(dict(
+            zip(("start", "end"), _window(rng, m, timedelta(days=7))), bucket="hour")), None),
+    "devices_summary": lambda rng, m, o: (
+        "GET", "/devices/summary?" + urlencode(
+            dict(zip(("start", "end"), _window(rng, m, timedelta(days=7))))), None),
+    "dashboard": lambda rng, m, o: ("GET", f"/dashboard/{m['user_id']}", None),
+}
+
+
+# --- Driver ----------------------------------------------------------------
+
+def _server_timing(header, name):
+    for part in (header or "").split(","):
+        metric, _, rest = part.strip().partition(";")
+        if metric == name and rest.startswith("dur="):
+            return float(rest[4:])
+    return None
+
+
+def _worker(base, build, rng, manifest, options, deadline, samples, lock):
+    url = urlsplit(base)
+    conn_cls = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+    conn = conn_cls(url.hostname, url.port, timeout=30)
+    headers = {"Cookie": f"email={manifest['email']}", "Content-Type": "application/json"}
+    local = []
+    while time.monotonic() < deadline:
+        method, path, body = build(rng, manifest, options)
+        payload = json.dumps(body).encode() if body is not None else None
+        started = time.perf_counter()
+        try:
+            conn.request(method, path, body=payload, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            status, timing = response.status, response.getheader("Server-Timing")
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            status, timing = 0, None
+        local.append((time.perf_counter() - started, status, _server_timing(timing, "db")))
+    conn.close()
+    with lock:
+        samples.extend(local)
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarise(samples, elapsed):
+    latencies = sorted(s[0] * 1000 for s in samples)
+    db = sorted(s[2] for s in samples if s[2] is not None)
+    errors = sum(1 for s in samples if not 200 <= s[1] < 300)
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "rps": round(len(samples) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) or 0, 3),
+        "p95_ms": round(percentile(latencies, 95) or 0, 3),
+        "p99_ms": round(percentile(latencies, 99) or 0, 3),
+        "max_ms": round(latencies[-1], 3) if latencies else 0.0,
+        "db_p50_ms": round(percentile(db, 50) or 0, 3),
+        "db_mean_ms": round(sum(db) / len(db), 3) if db else None,
+    }
+
+
+def run_scenario(base, name, manifest, options):
+    build = SCENARIOS[name]
+    samples, lock = [], threading.Lock()
+
+    # Warm up connections, caches and the pool before measuring
+    warm_until = time.monotonic() + options.warmup
+    _worker(base, build, random.Random(options.seed), manifest, options, warm_until, [], lock)
+
+    deadline = time.monotonic() + options.duration
+    started = time.monotonic()
+    threads = [
+        threading.Thread(target=_worker, args=(
+            base, build, random.Random(options.seed + i), manifest, options, deadline, samples, lock))
+        for i in range(options.concurrency)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return summarise(samples, time.monotonic() - started)
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new, threshold):
+    """``[(route, metric, old, new)]`` where ``new`` is worse than allowed."""
+    worse = []
+    for route, after in new["routes"].items():
+        before = old["routes"].get(route)
+        if not before:
+            continue
+        if before["p95_ms"] and after["p95_ms"] > before["p95_ms"] * (1 + threshold):
+            worse.append((route, "p95_ms", before["p95_ms"], after["p95_ms"]))
+        if before["rps"] and after["rps"] < before["rps"] * (1 - threshold):
+            worse.append((route, "rps", before["rps"], after["rps"]))
+        if after["errors"] > before["errors"]:
+            worse.append((route, "errors", before["errors"], after["errors"]))
+    return worse
+
+
+# python bench.py seed | run | compare  (see README "Benchmarks")
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Seed, load-test and compare the API")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("seed", help="load benchmark data into POSTGRES_* (replaces earlier bench data)")
+    p.add_argument("--devices", type=int, default=50)
+    p.add_argument("--days", type=int, default=30)
+    p.add_argument("--interval", type=int, default=5, help="minutes between readings")
+    p.add_argument("--manifest", default=MANIFEST)
+
+    p = sub.add_parser("run", help="drive the routes of a running server")
+    p.add_argument("--url", default="http://localhost:8000")
+    p.add_argument("--routes", default=",".join(SCENARIOS), help="comma-separated: " + ", ".join(SCENARIOS))
+    p.add_argument("--concurrency", type=int, default=8)
+    p.add_argument("--duration", type=float, default=10.0, help="seconds per route")
+    p.add_argument("--warmup", type=float, default=1.0, help="seconds per route, not measured")
+    p.add_argument("--batch-size", type=int, default=500)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--manifest", default=MANIFEST)
+    p.add_argument("--out", help="results file (default bench-results/<timestamp>.json)")
+
+    p = sub.add_parser("compare", help="exit 1 if NEW regressed against OLD")
+    p.add_argument("old")
+    p.add_argument("new")
+    p.add_argument("--threshold", type=float, default=0.10, help="allowed relative change")
+    args = parser.parse_args(argv)
+
+    if args.command == "seed":
+        from db import get_connection
+
+        conn = get_connection()
+        try:
+            started = time.monotonic()
+            manifest = seed(conn, args.devices, args.days, args.interval)
+        finally:
+            conn.close()
+        with open(args.manifest, "w") as f:
+            json.dump(manifest, f, indent=2)
+        print(f"Seeded {manifest['readings']} readings for {len(manifest['devices'])} devices "
+              f"in {time.monotonic() - started:.1f}s -> {args.manifest}")
+        return 0
+
+    if args.command == "run":
+        with open(args.manifest) as f:
+            manifest = json.load(f)
+        routes = [r.strip() for r in args.routes.split(",") if r.strip()]
+        unknown = [r for r in routes if r not in SCENARIOS]
+        if unknown:
+            parser.error("unknown route(s): " + ", ".join(unknown))
+
+        results = {
+            "meta": {
+                "started_at": datetime.utcnow().isoformat(),
+                "commit": _git_commit(),
+                "url": args.url,
+                "concurrency": args.concurrency,
+                "duration": args.duration,
+                "batch_size": args.batch_size,
+                "devices": len(manifest["devices"]),
+                "readings": manifest["readings"],
+            },
+            "routes": {},
+        }
+        for name in routes:
+            results["routes"][name] = stats = run_scenario(args.url, name, manifest, args)
+            print(f"{name:16} {stats['rps']:>9.1f} rps  p50 {stats['p50_ms']:>8.2f}  p95 {stats['p95_ms']:>8.2f}"
+                  f"  p99 {stats['p99_ms']:>8.2f} ms  db {stats['db_p50_ms']:>7.2f} ms  errors {stats['errors']}")
+
+        out = args.out or os.path.join("bench-results", datetime.utcnow().strftime("%Y%m%dT%H%M%S") + ".json")
+        os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+        with open(out, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results -> {out}")
+        return 0
+
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    worse = compare(old, new, args.threshold)
+    for route, metric, before, after in worse:
+        print(f"REGRESSION  {route} {metric}: {before} -> {after}")
+    if not worse:
+        print("No regressions")
+    return 1 if worse else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,388 @@
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+
+from logs import get_logger
+from metrics import DB_POOL_ACQUIRE, DB_QUERY_DURATION, DB_ROWS, DB_SLOW_QUERIES, statement_label
+from ratelimit import load_shedder
+
+log = get_logger("db")
+
+def _env_int(name, default):
+    return int(os.getenv(name, default))
+
+
+def _env_float(name, default):
+    return float(os.getenv(name, default))
+
+
+# Statements at or above this many milliseconds are logged as slow (0 = off)
+SLOW_QUERY_MS = _env_float("SLOW_QUERY_MS", 500)
+
+
+def _snippet(query, limit=300):
+    if isinstance(query, bytes):
+        query = query[:limit * 2].decode("utf-8", "replace")
+    return " ".join(str(query).split())[:limit]
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """Cursor that records each statement in the query metrics.
+
+    Time and rows go to ``db_query_duration_seconds`` / ``db_rows_total``
+    under the statement's label, and statements slower than SLOW_QUERY_MS
+    are logged (without their parameters). Named (server-side) cursors are
+    recorded once, on close, with the time spent executing and fetching.
+    """
+
+    _query = None
+    _elapsed = 0.0
+    _rows = 0
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            elapsed = time.perf_counter() - started
+            if self.name is None:
+                _record(query, elapsed, self.rowcount)
+            else:
+                self._query, self._elapsed, self._rows = query, elapsed, 0
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            elapsed = time.perf_counter() - started
+            _record(sql, elapsed, self.rowcount)
+
+    def fetchmany(self, size=None):
+        if self.name is None:
+            return super().fetchmany(size) if size is not None else super().fetchmany()
+        started = time.perf_counter()
+        rows = super().fetchmany(size) if size is not None else super().fetchmany()
+        self._elapsed += time.perf_counter() - started
+        self._rows += len(rows)
+        return rows
+
+    def close(self):
+        if self._query is not None:
+            query, self._query = self._query, None
+            _record(query, self._elapsed, self._rows)
+        super().close()
+
+
+def _record(query, elapsed, rows):
+    label = statement_label(query)
+    DB_QUERY_DURATION.observe(label, value=elapsed)
+    if rows > 0:
+        DB_ROWS.inc(label, amount=rows)
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+        DB_SLOW_QUERIES.inc(label)
+        log.warning("slow query", extra={
+            "statement": label, "ms": round(elapsed * 1000, 1), "rows": rows, "sql": _snippet(query),
+        })
+
+
+# Open a new physical connection (used by the pool, and for one-off scripts)
+def get_connection():
+    return psycopg2.connect(
+        dbname=os.getenv("POSTGRES_DB", "iot"),
+        user=os.getenv("POSTGRES_USER", "postgres"),
+        password=os.getenv("POSTGRES_PASSWORD", "secret"),
+        host=os.getenv("POSTGRES_HOST", "db"),
+        port="5432",
+        sslmode="require",
+        cursor_factory=InstrumentedCursor,
+    )
+
+
+# Startup schema work (migrations, rollup and device_stats tables,
+# partitions) runs under this session advisory lock, one process at a time.
+# Not migrations.LOCK_ID: migrate() takes that one per migration from
+# another connection while this is held.
+SCHEMA_LOCK_ID = 7340022
+
+
+@contextmanager
+def schema_lock():
+    """Hold SCHEMA_LOCK_ID on a dedicated connection (outside any pool, so
+    the work inside can borrow freely). If the database can't be reached
+    the body still runs, unlocked; its own steps will fail and log."""
+    conn = None
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT pg_advisory_lock(%s)", (SCHEMA_LOCK_ID,))
+        conn.commit()
+    except Exception as e:
+        log.error("could not take the schema lock", extra={"error": repr(e)})
+    try:
+        yield
+    finally:
+        # Closing the session releases the lock
+        if conn is not None:
+            conn.close()
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# Per-request tally of seconds spent borrowing pooled connections (waiting
+# plus holding). The HTTP middleware starts one and reports it in the
+# Server-Timing header; outside a request nothing is recorded.
+_db_time = contextvars.ContextVar("db_time", default=None)
+
+
+def start_db_timer():
+    tally = [0.0]
+    _db_time.set(tally)
+    return tally
+
+
+class ConnectionPool:
+    """Thread-safe pool of long-lived psycopg2 connections.
+
+    Connections are checked on borrow (closed / broken / idle for longer
+    than ``check_idle`` seconds gets a ``SELECT 1``) and recycled once they
+    are older than ``max_age`` seconds. Always borrow through
+    ``connection()`` so the connection is returned even on errors.
+    """
+
+    def __init__(self, connect, minconn=1, maxconn=10, max_age=1800.0,
+                 check_idle=30.0, timeout=10.0):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("invalid pool size: min=%s max=%s" % (minconn, maxconn))
+        self._connect = connect
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.max_age = max_age
+        self.check_idle = check_idle
+        self.timeout = timeout
+
+        self._cond = threading.Condition()
+        self._idle = []        # [(conn, created_at, last_used)], used LIFO
+        self._born = {}        # id(conn) -> created_at for borrowed connections
+        self._size = 0         # open + being opened
+        self._waiting = 0
+        self._closed = False
+
+        self._acquired = 0
+        self._waited = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._timeouts = 0
+        self._opened = 0
+        self._recycled = 0
+        self._discarded = 0
+
+    def open(self):
+        for _ in range(self.minconn):
+            with self._cond:
+                if self._size >= self.minconn:
+                    break
+                self._size += 1
+            conn = self._new_connection()
+            with self._cond:
+                self._idle.append((conn, time.monotonic(), time.monotonic()))
+                self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _, _ in idle:
+            self._close_quietly(conn)
+
+    def _new_connection(self):
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._opened += 1
+        return conn
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _drop(self, conn):
+        self._close_quietly(conn)
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        if time.monotonic() - last_used < self.check_idle:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def acquire(self):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        waited = False
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolTimeout("connection pool is closed")
+                    if self._idle:
+                        conn, born, last_used = self._idle.pop()
+                        fresh = False
+                        break
+                    if self._size < self.maxconn:
+                        self._size += 1
+                        conn = None
+                        fresh = True
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        load_shedder.observe_wait(self.timeout)
+                        raise PoolTimeout(
+                            "no database connection available after %.1fs (max=%d)"
+                            % (self.timeout, self.maxconn)
+                        )
+                    waited = True
+                    self._waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+
+            if fresh:
+                conn = self._new_connection()
+                born = time.monotonic()
+            elif time.monotonic() - born > self.max_age:
+                with self._cond:
+                    self._recycled += 1
+                self._drop(conn)
+                continue
+            elif not self._healthy(conn, last_used):
+                with self._cond:
+                    self._discarded += 1
+                self._drop(conn)
+                continue
+
+            wait = time.monotonic() - started
+            DB_POOL_ACQUIRE.observe("sync", value=wait)
+            load_shedder.observe_wait(wait)
+            with self._cond:
+                self._born[id(conn)] = born
+                self._acquired += 1
+                self._wait_total += wait
+                if waited:
+                    self._waited += 1
+                if wait > self._wait_max:
+                    self._wait_max = wait
+            return conn
+
+    def release(self, conn, discard=False):
+        with self._cond:
+            born = self._born.pop(id(conn), time.monotonic())
+
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+
+        if discard or conn.closed:
+            with self._cond:
+                self._discarded += 1
+            self._drop(conn)
+            return
+        if time.monotonic() - born > self.max_age:
+            with self._cond:
+                self._recycled += 1
+            self._drop(conn)
+            return
+
+        with self._cond:
+            if self._closed:
+                self._size -= 1
+                closing = True
+            else:
+                self._idle.append((conn, born, time.monotonic()))
+                closing = False
+            self._cond.notify()
+        if closing:
+            self._close_quietly(conn)
+
+    @contextmanager
+    def connection(self):
+        started = time.perf_counter()
+        conn = self.acquire()
+        try:
+            yield conn
+        except BaseException as e:
+            # psycopg2 errors that leave the socket unusable mark conn.closed;
+            # anything else (HTTPException, bad SQL) just needs a rollback.
+            self.release(conn, discard=isinstance(e, psycopg2.InterfaceError))
+            raise
+        else:
+            self.release(conn)
+        finally:
+            tally = _db_time.get()
+            if tally is not None:
+                tally[0] += time.perf_counter() - started
+
+    def stats(self):
+        with self._cond:
+            in_use = len(self._born)
+            return {
+                "min": self.minconn,
+                "max": self.maxconn,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": in_use,
+                "waiting": self._waiting,
+                "acquired": self._acquired,
+                "waited": self._waited,
+                "wait_ms_avg": round(self._wait_total * 1000 / self._acquired, 3) if self._acquired else 0.0,
+                "wait_ms_max": round(self._wait_max * 1000, 3),
+                "timeouts": self._timeouts,
+                "opened": self._opened,
+                "recycled": self._recycled,
+                "discarded": self._discarded,
+            }
+
+
+db_pool = ConnectionPool(
+    get_connection,
+    minconn=_env_int("DB_POOL_MIN", 1),
+    maxconn=_env_int("DB_POOL_MAX", 10),
+    max_age=_env_float("DB_POOL_MAX_AGE", 1800),
+    check_idle=_env_float("DB_POOL_CHECK_IDLE", 30),
+    timeout=_env_float("DB_POOL_TIMEOUT", 10),
+)
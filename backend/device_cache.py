@@ -0,0 +1,93 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class DeviceCache:
+    """Bounded LRU set of device_ids known to exist in ``devices``.
+
+    Entries expire after ``ttl`` seconds so a device deleted out-of-band is
+    eventually looked up again. Only add ids after the transaction that
+    created them has committed.
+    """
+
+    def __init__(self, capacity=100000, ttl=3600.0):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._entries = OrderedDict()  # device_id -> expires_at
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expired = 0
+
+    def __contains__(self, device_id):
+        now = time.monotonic()
+        with self._lock:
+            expires = self._entries.get(device_id)
+            if expires is None:
+                self._misses += 1
+                return False
+            if expires < now:
+                del self._entries[device_id]
+                self._expired += 1
+                self._misses += 1
+                return False
+            self._entries.move_to_end(device_id)
+            self._hits += 1
+            return True
+
+    def missing(self, device_ids):
+        return [d for d in device_ids if d not in self]
+
+    def add(self, device_id):
+        self.add_many((device_id,))
+
+    def add_many(self, device_ids):
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for device_id in device_ids:
+                self._entries[device_id] = expires
+                self._entries.move_to_end(device_id)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def discard(self, device_id):
+        with self._lock:
+            self._entries.pop(device_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    # Preload the most recently registered devices
+    def warm(self, pool):
+        with pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT device_id FROM devices ORDER BY id DESC LIMIT %s", (self.capacity,))
+            ids = [row[0] for row in cursor.fetchall()]
+            cursor.close()
+        # Oldest first so the newest end up most-recently-used
+        self.add_many(reversed(ids))
+        return len(ids)
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "size": len(self._entries),
+                "capacity": self.capacity,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_ratio": round(self._hits / lookups, 4) if lookups else 0.0,
+                "evictions": self._evictions,
+                "expired": self._expired,
+            }
+
+
+device_cache = DeviceCache(
+    capacity=int(os.getenv("DEVICE_CACHE_SIZE", "100000")),
+    ttl=float(os.getenv("DEVICE_CACHE_TTL", "3600")),
+)
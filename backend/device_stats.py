@@ -0,0 +1,203 @@
+import argparse
+import os
+import threading
+import time
+
+from psycopg2.extras import execute_values
+
+from rollups import parse_ts, rollups
+
+
+UPSERT = """
+    INSERT INTO device_stats (device_id, total_ml, readings, first_ts, last_ts, last_volume_ml)
+    VALUES %s
+    ON CONFLICT (device_id) DO UPDATE SET
+        total_ml = device_stats.total_ml + EXCLUDED.total_ml,
+        readings = device_stats.readings + EXCLUDED.readings,
+        first_ts = LEAST(device_stats.first_ts, EXCLUDED.first_ts),
+        last_volume_ml = CASE WHEN EXCLUDED.last_ts >= device_stats.last_ts
+                              THEN EXCLUDED.last_volume_ml ELSE device_stats.last_volume_ml END,
+        last_ts = GREATEST(device_stats.last_ts, EXCLUDED.last_ts)
+"""
+
+RAW_TOTALS = """
+    SELECT device_id, SUM(volume_ml)::bigint AS total_ml, COUNT(*) AS readings,
+           MIN(timestamp) AS first_ts, MAX(timestamp) AS last_ts
+    FROM device_data {where}
+    GROUP BY device_id
+"""
+
+# Readings older than the retention boundary only exist as daily rollups
+ARCHIVED_TOTALS = """
+    SELECT device_id, SUM(total_ml)::bigint, SUM(readings)::bigint, MIN(first_ts), MAX(last_ts)
+    FROM device_rollups_daily {where}
+    GROUP BY device_id
+"""
+
+# Latest reading per device: ties on timestamp go to the last row inserted,
+# matching the order apply() sees them in. Devices with no raw readings left
+# keep their previous last reading if it is still the latest one.
+FRESH = """
+    CREATE TEMP TABLE device_stats_fresh ON COMMIT DROP AS
+    SELECT a.device_id, a.total_ml, a.readings, a.first_ts,
+           COALESCE(l.timestamp, a.last_ts) AS last_ts,
+           CASE WHEN l.device_id IS NOT NULL THEN l.volume_ml
+                WHEN s.last_ts = a.last_ts THEN s.last_volume_ml END AS last_volume_ml
+    FROM (
+        SELECT device_id, SUM(total_ml)::bigint AS total_ml, SUM(readings)::bigint AS readings,
+               MIN(first_ts) AS first_ts, MAX(last_ts) AS last_ts
+        FROM ({totals}) parts
+        GROUP BY device_id
+    ) a
+    LEFT JOIN (
+        SELECT DISTINCT ON (device_id) device_id, timestamp, volume_ml
+        FROM device_data {raw_where}
+        ORDER BY device_id, timestamp DESC, id DESC
+    ) l ON l.device_id = a.device_id
+    LEFT JOIN device_stats s ON s.device_id = a.device_id
+"""
+
+
+def _where(*conditions):
+    conditions = [c for c in conditions if c]
+    return "WHERE " + " AND ".join(conditions) if conditions else ""
+
+
+class DeviceStats:
+    """Lifetime running totals per device (``device_stats``), kept in step
+    with ingest so lifetime reads cost O(devices) instead of O(readings).
+
+    Reads only use the table once ``reconcile`` has recorded a full run in
+    ``rollup_state``; until then callers fall back to raw ``device_data``.
+    """
+
+    def __init__(self, enabled=True, ready_ttl=60.0):
+        self.enabled = enabled
+        self.ready_ttl = ready_ttl
+        self._active = False
+        self._ready = False
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def setup(self, pool):
+        if not self.enabled:
+            return
+        with pool.connection() as conn:
+            cursor = conn.cursor()
+            # Nothing to reconcile on an empty database
+            cursor.execute("""
+                INSERT INTO rollup_state (name, completed_at)
+                SELECT 'device_stats', NOW() WHERE NOT EXISTS (SELECT 1 FROM device_data)
+                ON CONFLICT (name) DO NOTHING
+            """)
+            conn.commit()
+            cursor.close()
+        self._active = True
+
+    # Called from the read routes with a psycopg 3 cursor from aiodb.adb
+    async def ready(self, cursor):
+        if not self._active:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            if now - self._checked < self.ready_ttl:
+                return self._ready
+        await cursor.execute("SELECT 1 FROM rollup_state WHERE name = 'device_stats'")
+        ready = await cursor.fetchone() is not None
+        with self._lock:
+            self._ready, self._checked = ready, now
+        return ready
+
+    # Fold freshly inserted (device_id, volume_ml, timestamp) rows into the
+    # counters, inside the same transaction as the insert.
+    def apply(self, cursor, rows):
+        if not self._active:
+            return
+        stats = {}
+        for device_id, volume_ml, ts in rows:
+            ts = parse_ts(ts)
+            agg = stats.get(device_id)
+            if agg is None:
+                stats[device_id] = [volume_ml, 1, ts, ts, volume_ml]
+            else:
+                agg[0] += volume_ml
+                agg[1] += 1
+                agg[2] = min(agg[2], ts)
+                if ts >= agg[3]:
+                    agg[3], agg[4] = ts, volume_ml
+        # Sorted so concurrent writers lock device rows in the same order
+        values = [(device_id,) + tuple(agg) for device_id, agg in sorted(stats.items())]
+        execute_values(cursor, UPSERT, values, page_size=1000)
+
+    def reconcile(self, conn, device_id=None):
+        """Rebuild ``device_stats`` from device_data in one transaction.
+
+        Ingest is blocked on the table while this runs. Returns
+        ``(devices, drifted)`` where ``drifted`` counts rows that were wrong.
+        A full run (no ``device_id``) marks the table ready for reads.
+        """
+        cursor = conn.cursor()
+        self._active = True
+
+        cursor.execute("LOCK TABLE device_stats IN EXCLUSIVE MODE")
+        raw_from = rollups.raw_from(cursor)
+        device_filter = "device_id = %(device)s" if device_id else None
+        params = {"device": device_id, "raw_from": raw_from}
+        raw_where = _where(device_filter, "timestamp >= %(raw_from)s" if raw_from else None)
+        totals = RAW_TOTALS.format(where=raw_where)
+        if raw_from:
+            totals += " UNION ALL " + ARCHIVED_TOTALS.format(where=_where(device_filter, "bucket < %(raw_from)s"))
+        cursor.execute(FRESH.format(totals=totals, raw_where=raw_where), params)
+        where = _where(device_filter)
+        cursor.execute(f"""
+            SELECT
+                (SELECT COUNT(*) FROM device_stats_fresh),
+                (SELECT COUNT(*)
+                 FROM device_stats_fresh f
+                 FULL JOIN (SELECT * FROM device_stats {where}) s ON s.device_id = f.device_id
+                 WHERE (f.total_ml, f.readings, f.first_ts, f.last_ts, f.last_volume_ml)
+                       IS DISTINCT FROM (s.total_ml, s.readings, s.first_ts, s.last_ts, s.last_volume_ml))
+        """, params)
+        devices, drifted = cursor.fetchone()
+
+        cursor.execute(f"DELETE FROM device_stats {where}", params)
+        cursor.execute("""
+            INSERT INTO device_stats (device_id, total_ml, readings, first_ts, last_ts, last_volume_ml)
+            SELECT device_id, total_ml, readings, first_ts, last_ts, last_volume_ml FROM device_stats_fresh
+        """)
+        if device_id is None:
+            cursor.execute("""
+                INSERT INTO rollup_state (name, completed_at) VALUES ('device_stats', NOW())
+                ON CONFLICT (name) DO UPDATE SET completed_at = EXCLUDED.completed_at
+            """)
+        conn.commit()
+        cursor.close()
+        with self._lock:
+            self._checked = 0.0
+        return devices, drifted
+
+
+device_stats = DeviceStats(enabled=os.getenv("DEVICE_STATS_ENABLED", "1") == "1")
+
+
+# python device_stats.py reconcile [--device ID]
+def main(argv=None):
+    from db import get_connection
+
+    parser = argparse.ArgumentParser(description="Maintain per-device running totals")
+    sub = parser.add_subparsers(dest="command", required=True)
+    reconcile = sub.add_parser("reconcile", help="rebuild device_stats from device_data")
+    reconcile.add_argument("--device", help="only this device_id")
+    args = parser.parse_args(argv)
+
+    conn = get_connection()
+    try:
+        started = time.monotonic()
+        devices, drifted = device_stats.reconcile(conn, args.device)
+        print(f"Reconciled {devices} device(s), {drifted} corrected, in {time.monotonic() - started:.1f}s")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+import numpy as np
+
+
+METHODS = ("lttb", "minmax")
+
+
+def lttb(x, y, n):
+    """Largest-Triangle-Three-Buckets: indices of ``n`` points that keep the shape.
+
+    ``x`` must be ascending. The first and last points are always kept; each
+    of the ``n - 2`` buckets in between contributes the point forming the
+    largest triangle with the previous pick and the next bucket's centroid.
+    """
+    size = len(x)
+    if n >= size or n < 3:
+        return np.arange(size)
+
+    edges = np.linspace(1, size - 1, n - 1).astype(np.int64)
+    out = np.empty(n, dtype=np.int64)
+    out[0], out[-1] = 0, size - 1
+    a = 0
+    for i in range(n - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nhi = edges[i + 2] if i + 2 < n - 1 else size
+        avg_x = x[hi:nhi].mean()
+        avg_y = y[hi:nhi].mean()
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(area.argmax())
+        out[i + 1] = a
+    return out
+
+
+def minmax(y, n):
+    """Per-bucket min and max: indices of at most ``n`` points, in order."""
+    size = len(y)
+    if n >= size or n < 2:
+        return np.arange(size)
+
+    buckets = n // 2
+    bucket = (np.arange(size) * buckets) // size
+    # Within each bucket, rows sorted by value: first is the min, last the max
+    order = np.lexsort((y, bucket))
+    starts = np.searchsorted(bucket[order], np.arange(buckets))
+    ends = np.append(starts[1:], size) - 1
+    return np.unique(np.concatenate((order[starts], order[ends])))
+
+
+def downsample(timestamps, values, max_points, method="lttb"):
+    """Pick which of the (ascending) rows to keep; returns sorted indices."""
+    if len(values) <= max_points:
+        return np.arange(len(values))
+    y = np.asarray(values, dtype=np.float64)
+    if method == "minmax":
+        return minmax(y, max_points)
+    # Only relative spacing matters here, and naive .timestamp() is several
+    # times faster than building a datetime64 array from Python datetimes
+    x = np.fromiter((ts.timestamp() for ts in timestamps), dtype=np.float64, count=len(values))
+    return lttb(x, y, max_points)
@@ -0,0 +1,161 @@
+# Query-plan regression check for the read routes. Runs EXPLAIN for the SQL
+# behind each hot route against a live database and exits non-zero if any plan
+# falls back to a sequential scan of a large table:
+#
+#     python migrations.py up && python explain_check.py
+#
+# Sequential scans are disabled for the session, so the planner uses an index
+# whenever one can serve the query. A Seq Scan that survives means no usable
+# index exists, however small the local data set is.
+import argparse
+import json
+import sys
+from datetime import datetime, timedelta
+
+import main as app
+from histograms import HISTOGRAM_SQL, WINDOWS, _bucket_expr
+from rollups import split_window, _union, totals_query
+from unit_timeline import INTERVALS_SQL, PAGE_COLUMNS, ranges, rows_query
+
+# Tables that grow with readings or customers; prefixes cover partitions
+LARGE_TABLES = ("device_data", "device_rollups_", "device_stats", "unit_devices", "devices", "users", "units")
+
+
+def _samples(cursor):
+    def one(sql, default):
+        cursor.execute(sql)
+        row = cursor.fetchone()
+        return row[0] if row and row[0] is not None else default
+
+    end = one("SELECT MAX(timestamp) FROM device_data", datetime.utcnow())
+    unit = one("SELECT unit_id FROM unit_devices ORDER BY unit_id LIMIT 1", 1)
+    cursor.execute(INTERVALS_SQL, (unit,))
+    return {
+        "device": one("SELECT device_id FROM devices LIMIT 1", "device-1"),
+        "unit": unit,
+        "intervals": cursor.fetchall(),
+        "org": one("SELECT organisation_id FROM devices WHERE organisation_id IS NOT NULL LIMIT 1", 1),
+        "user": one("SELECT id FROM users LIMIT 1", 1),
+        "email": one("SELECT email FROM users LIMIT 1", "someone@example.com"),
+        "start": end - timedelta(days=7, minutes=17),
+        "end": end,
+    }
+
+
+def _device_summary(s):
+    totals, params = totals_query(app.ORG_DEVICES_SQL, [s["org"]], s["start"], s["end"])
+    params += [s["start"], s["end"], s["org"]]
+    sql = app.DEVICE_SUMMARY_SQL.format(
+        totals=totals, window=" AND dd.timestamp >= %s AND dd.timestamp <= %s"
+    )
+    return sql, params
+
+
+def _window_total(s):
+    sql, params = _union(split_window(s["start"], s["end"]), s["device"])
+    return f"SELECT COALESCE(SUM(total), 0)::bigint FROM ({sql}) t", params
+
+
+def _histogram(s):
+    sql = HISTOGRAM_SQL.format(
+        windows=WINDOWS["devices"],
+        first_bucket=_bucket_expr("hour", "lo"),
+        bucket=_bucket_expr("hour", "(dd.timestamp AT TIME ZONE 'UTC')"),
+    )
+    return sql, {"devices": [s["device"]], "start": s["start"], "end": s["end"], "step": "1 hour"}
+
+
+# (route, builder(samples) -> (sql, params)), using the SQL constants and
+# query builders from main.py. "(raw)" checks cover the fallbacks used before
+# the rollups / device_stats are backfilled.
+CHECKS = [
+    ("GET /data/{device_id}", lambda s: app._device_data_query(s["device"], s["start"], s["end"])),
+    ("GET /data/{device_id}?page_size", lambda s: app._device_data_page_query(
+        s["device"], s["start"], None, 1000, (s["end"], 2**31 - 1))),
+    ("GET /data/{device_id}/summary (rollups)", _window_total),
+    ("GET /data/{device_id}/summary (raw)", lambda s: app._volume_summary_query(s["device"], s["start"], s["end"])),
+    ("GET /data/{device_id}/histogram (raw)", lambda s: (
+        app.VOLUME_HISTOGRAM_SQL, ("hour", s["device"], s["start"], s["end"]))),
+    ("GET /summary/{device_id} (owner)", lambda s: (app.OWNED_BY_SQL, (s["device"], s["email"]))),
+    ("GET /summary/{device_id} (raw)", lambda s: app._summary_query(s["device"], s["start"], s["end"])),
+    ("GET /histogram/{device_id} (raw)", lambda s: app._daily_histogram_query(s["device"], s["start"], s["end"])),
+    ("GET /unit/data", lambda s: rows_query(
+        ranges(s["intervals"], s["start"], s["end"]), s["end"], limit=100000)),
+    ("GET /unit/data?page_size", lambda s: rows_query(
+        ranges(s["intervals"], s["start"], s["end"]), s["end"], PAGE_COLUMNS,
+        after=(s["start"], 0), limit=1001)),
+    ("GET /unit (timeline)", lambda s: (INTERVALS_SQL, (s["unit"],))),
+    ("GET /unit", lambda s: (app.UNIT_STMT.sql, (s["unit"],))),
+    ("GET /devices", lambda s: (app.ORG_DEVICE_LIST_SQL, (s["org"],))),
+    ("GET /devices/summary", _device_summary),
+    ("GET /devices/summary (lifetime)", lambda s: (app.DEVICE_STATS_SUMMARY_SQL, (s["org"],))),
+    ("GET /devices/summary?by=unit", lambda s: (
+        app.UNIT_SUMMARY_SQL.format(window=" AND dd.timestamp >= %(start)s AND dd.timestamp <= %(end)s"),
+        {"org": s["org"], "start": s["start"], "end": s["end"]})),
+    ("GET /dashboard/{user_id}", lambda s: (app.DASHBOARD_STATS_SQL, (s["user"],))),
+    ("GET /dashboard/{user_id} (rollups)", lambda s: (app.DASHBOARD_ROLLUPS_SQL, (s["user"],))),
+    ("GET /dashboard/{user_id} (raw)", lambda s: (app.DASHBOARD_RAW_SQL, (s["user"],))),
+    ("GET /histogram", _histogram),
+    ("auth middleware", lambda s: (app.USER_BY_EMAIL.sql, (s["email"],))),
+    ("POST /login", lambda s: (app.LOGIN_SQL, (s["email"],))),
+]
+
+
+def _seq_scans(plan):
+    found = []
+    if plan.get("Node Type") == "Seq Scan":
+        relation = plan.get("Relation Name", "")
+        if relation.startswith(LARGE_TABLES):
+            found.append(relation)
+    for child in plan.get("Plans", []):
+        found.extend(_seq_scans(child))
+    return found
+
+
+def run(conn, verbose=False):
+    """EXPLAIN every check; returns ``[(route, [tables seq-scanned])]``."""
+    cursor = conn.cursor()
+    samples = _samples(cursor)
+    results = []
+    for route, build in CHECKS:
+        sql, params = build(samples)
+        cursor.execute("SET LOCAL enable_seqscan = off")
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        plan = plan[0]["Plan"]
+        if verbose:
+            print(f"--- {route}\n{json.dumps(plan, indent=1)}")
+        results.append((route, _seq_scans(plan)))
+        conn.rollback()
+    cursor.close()
+    return results
+
+
+def main(argv=None):
+    from db import get_connection
+
+    parser = argparse.ArgumentParser(description="Fail on sequential scans in hot-route query plans")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print each plan")
+    args = parser.parse_args(argv)
+
+    conn = get_connection()
+    try:
+        results = run(conn, args.verbose)
+    finally:
+        conn.close()
+
+    failed = 0
+    for route, scans in results:
+        if scans:
+            failed += 1
+            print(f"FAIL  {route}: seq scan on {', '.join(sorted(set(scans)))}")
+        else:
+            print(f"ok    {route}")
+    print(f"{len(results) - failed} passed, {failed} failed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+import importlib.util
+import os
+import re
+import time
+
+from starlette.concurrency import run_in_threadpool
+
+from db import _record
+
+EXPORT_CHUNK_BYTES = int(os.getenv("EXPORT_CHUNK_BYTES", str(256 * 1024)))
+EXPORT_ROW_GROUP_ROWS = int(os.getenv("EXPORT_ROW_GROUP_ROWS", "100000"))
+
+FORMATS = {"csv": "text/csv; charset=utf-8", "parquet": "application/vnd.apache.parquet"}
+
+_WINDOW = """
+     AND (%(from)s::timestamp IS NULL OR dd.timestamp >= %(from)s::timestamp)
+     AND (%(to)s::timestamp IS NULL OR dd.timestamp <= %(to)s::timestamp)
+"""
+
+# Unit exports are built per request from the unit's attachment intervals
+# (unit_timeline.rows_query) with these columns
+COLUMNS = ("timestamp", "device_id", "volume_ml")
+
+DEVICE_EXPORT_SQL = """
+    SELECT dd.timestamp, dd.device_id, dd.volume_ml
+    FROM device_data dd
+    WHERE dd.device_id = %(id)s
+""" + _WINDOW + """
+    ORDER BY dd.timestamp
+"""
+
+ORG_EXPORT_SQL = """
+    SELECT dd.timestamp, dd.device_id, dd.volume_ml
+    FROM devices d
+    JOIN device_data dd ON dd.device_id = d.device_id
+""" + _WINDOW + """
+    WHERE d.organisation_id = %(id)s
+    ORDER BY dd.device_id, dd.timestamp
+"""
+
+SCOPES = {"device": DEVICE_EXPORT_SQL, "org": ORG_EXPORT_SQL}
+
+
+def export_params(scope_id, start, end):
+    return {"id": scope_id, "from": start, "to": end}
+
+
+def parquet_available():
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+def filename(scope, scope_id, fmt):
+    return "%s-%s.%s" % (scope, re.sub(r"[^\w.-]", "_", str(scope_id)), fmt)
+
+
+async def csv_body(db, query, params):
+    """CSV straight from ``COPY (query) TO STDOUT``: Postgres formats the
+    rows and the bytes go to the client untouched, in chunks of about
+    EXPORT_CHUNK_BYTES. One connection is held until the copy ends or the
+    client goes away (leaving the block early cancels the COPY)."""
+    async with db.connection() as conn:
+        cursor = conn.cursor()
+        # COPY takes no bind parameters; psycopg merges them in client-side
+        statement = "COPY (" + query + ") TO STDOUT WITH (FORMAT csv, HEADER)"
+        started, rows = time.perf_counter(), 0
+        try:
+            async with cursor.copy(statement, params) as copy:
+                buf = bytearray()
+                # libpq hands over COPY output one row at a time
+                async for data in copy:
+                    buf += data
+                    rows += 1
+                    if len(buf) >= EXPORT_CHUNK_BYTES:
+                        yield bytes(buf)
+                        buf.clear()
+                if buf:
+                    yield bytes(buf)
+        finally:
+            await cursor.close()
+            # Header line included
+            _record(statement, time.perf_counter() - started, rows)
+
+
+class _Sink:
+    """Write-only file object for ParquetWriter; ``take`` hands over what
+    has been written since the last call."""
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._pos = 0
+        self.closed = False
+
+    def write(self, data):
+        self._buf += data
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = bytes(self._buf)
+        self._buf.clear()
+        return data
+
+
+async def parquet_body(db, query, params):
+    """Parquet, one row group per EXPORT_ROW_GROUP_ROWS rows read from a
+    server-side cursor; each row group is sent as soon as it is encoded."""
+    # pyarrow is optional (not in requirements.txt); only Parquet exports need it
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ("timestamp", pa.timestamp("us")),
+        ("device_id", pa.string()),
+        ("volume_ml", pa.int64()),
+    ])
+    sink = _Sink()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+
+    def encode(rows):
+        columns = list(zip(*rows))
+        writer.write_table(pa.Table.from_arrays(
+            [pa.array(col, type=field.type) for col, field in zip(columns, schema)], schema=schema,
+        ))
+        return sink.take()
+
+    chunks = db.iter_query(query, params, EXPORT_ROW_GROUP_ROWS)
+    try:
+        async for rows in chunks:
+            yield await run_in_threadpool(encode, rows)
+        writer.close()
+        yield sink.take()
+    finally:
+        await chunks.aclose()
@@ -0,0 +1,295 @@
+import asyncio
+import struct
+from datetime import datetime, timezone
+
+from logs import get_logger
+from metrics import metrics
+
+log = get_logger("gateway")
+
+# Frame (big-endian):
+#   header   "IW", version (u8), count (u8, 1..255), seq (u32)
+#   reading  device_id (32 bytes UTF-8, NUL-padded), volume_ml (i32),
+#            timestamp (i64, milliseconds since the Unix epoch, UTC)
+# Ack:
+#   "IA", status (u8), accepted (u8), seq (u32)
+MAGIC = b"IW"
+ACK_MAGIC = b"IA"
+VERSION = 1
+HEADER = struct.Struct(">2sBBI")
+READING = struct.Struct(">32siq")
+ACK = struct.Struct(">2sBBI")
+DEVICE_ID_MAX = 32
+MAX_READINGS = 255
+
+OK, MALFORMED, BUSY, FAILED, PENDING = 0, 1, 2, 3, 4
+STATUS_NAMES = {OK: "ok", MALFORMED: "malformed", BUSY: "busy", FAILED: "failed", PENDING: "pending"}
+
+GATEWAY_FRAMES = metrics.counter(
+    "gateway_frames_total", "Binary ingest frames, by transport and ack status", ("transport", "status"),
+)
+
+
+class MalformedFrame(ValueError):
+    pass
+
+
+class Partial(Exception):
+    """Raised by the write callable when not every reading of a frame is
+    known to be written; ``accepted`` of them (a prefix) are."""
+
+    status = FAILED
+    message = "ingest failed"
+
+    def __init__(self, accepted=0):
+        super().__init__(self.message)
+        self.accepted = accepted
+
+
+class Busy(Partial):
+    """The rest could not be queued; the device should resend them later."""
+
+    status = BUSY
+    message = "ingest queue full"
+
+
+class Failed(Partial):
+    """Writing the rest failed."""
+
+
+class Pending(Partial):
+    """The rest are queued but their commit was not confirmed in time. They
+    may still be written, so the device must not resend them."""
+
+    status = PENDING
+    message = "commit not confirmed in time"
+
+
+def encode_frame(seq, readings):
+    """``readings`` is a list of ``(device_id, volume_ml, epoch_ms)``."""
+    if not 1 <= len(readings) <= MAX_READINGS:
+        raise ValueError(f"a frame carries 1..{MAX_READINGS} readings")
+    parts = [HEADER.pack(MAGIC, VERSION, len(readings), seq)]
+    for device_id, volume_ml, epoch_ms in readings:
+        raw = device_id.encode("utf-8")
+        if not raw or len(raw) > DEVICE_ID_MAX:
+            raise ValueError(f"device_id must be 1..{DEVICE_ID_MAX} bytes: {device_id!r}")
+        parts.append(READING.pack(raw, volume_ml, epoch_ms))
+    return b"".join(parts)
+
+
+def decode_header(data):
+    """Returns ``(count, seq)``; raises MalformedFrame."""
+    magic, version, count, seq = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise MalformedFrame("bad magic or version")
+    if count == 0:
+        raise MalformedFrame("empty frame")
+    return count, seq
+
+
+def decode_readings(data, count):
+    """``(device_id, volume_ml, timestamp)`` tuples, as HTTP ingest passes
+    them to the write path."""
+    readings = []
+    for raw, volume_ml, epoch_ms in READING.iter_unpack(data[:count * READING.size]):
+        try:
+            device_id = raw.rstrip(b"\0").decode("utf-8")
+            timestamp = datetime.fromtimestamp(epoch_ms / 1000, timezone.utc)
+        except (UnicodeDecodeError, ValueError, OverflowError, OSError) as e:
+            raise MalformedFrame(str(e))
+        if not device_id or "\0" in device_id:
+            raise MalformedFrame("bad device_id")
+        readings.append((device_id, volume_ml, timestamp))
+    return readings
+
+
+def encode_ack(status, accepted, seq):
+    return ACK.pack(ACK_MAGIC, status, accepted, seq)
+
+
+def decode_ack(data):
+    magic, status, accepted, seq = ACK.unpack(data)
+    if magic != ACK_MAGIC:
+        raise MalformedFrame("bad ack")
+    return status, accepted, seq
+
+
+class _Peer:
+    __slots__ = ("frames", "readings", "malformed", "failed", "busy", "pending")
+
+    def __init__(self):
+        self.frames = self.readings = self.malformed = self.failed = self.busy = self.pending = 0
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class Gateway:
+    """Binary UDP/TCP ingest listener on the app's event loop.
+
+    Frames skip HTTP parsing, middleware and Pydantic; their readings go to
+    ``write``, an async callable taking ``(device_id, volume_ml, timestamp)``
+    tuples that takes the same path as ``POST /ingest`` (buffered queue or a
+    direct write). Every frame gets an ack with its ``seq``, once ``write``
+    returns. TCP frames on one connection are handled in order; a frame with
+    a bad header closes the connection since the stream can't be re-synced.
+    At most ``max_inflight`` UDP frames are handled at once; beyond that
+    they are acked ``busy`` without touching the database.
+    """
+
+    def __init__(self, write, host="0.0.0.0", udp_port=0, tcp_port=0, max_connections=1000, max_inflight=1000):
+        self.write = write
+        self.host = host
+        self.udp_port = udp_port
+        self.tcp_port = tcp_port
+        self.max_connections = max_connections
+        self.max_inflight = max_inflight
+        self._inflight = set()  # UDP frame tasks
+        self._udp = None
+        self._tcp = None
+        self._peers = {}
+        self._totals = {"udp": _Peer(), "tcp": _Peer()}
+
+    @property
+    def enabled(self):
+        return bool(self.udp_port or self.tcp_port)
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        # reuse_port lets every uvicorn worker bind the same ports
+        if self.udp_port and self._udp is None:
+            self._udp, _ = await loop.create_datagram_endpoint(
+                lambda: _Datagram(self), local_addr=(self.host, self.udp_port), reuse_port=True,
+            )
+            log.info("gateway listening", extra={"transport": "udp", "port": self.udp_port})
+        if self.tcp_port and self._tcp is None:
+            self._tcp = await asyncio.start_server(
+                self._serve_tcp, self.host, self.tcp_port, reuse_port=True,
+            )
+            log.info("gateway listening", extra={"transport": "tcp", "port": self.tcp_port})
+
+    async def stop(self):
+        if self._udp is not None:
+            self._udp.close()
+            self._udp = None
+        if self._tcp is not None:
+            self._tcp.close()
+            await self._tcp.wait_closed()
+            self._tcp = None
+
+    async def handle(self, transport, peer, count, seq, body):
+        """Persist one decoded frame and return its ack."""
+        try:
+            readings = decode_readings(body, count)
+        except MalformedFrame:
+            return self._ack(transport, peer, MALFORMED, 0, seq)
+        try:
+            await self.write(readings)
+        except Partial as e:
+            if e.status == FAILED:
+                log.error("gateway ingest failed", extra={"transport": transport, "readings": count, "accepted": e.accepted})
+            return self._ack(transport, peer, e.status, e.accepted, seq)
+        except Exception as e:
+            log.error("gateway ingest failed", extra={"transport": transport, "readings": count, "error": repr(e)})
+            return self._ack(transport, peer, FAILED, 0, seq)
+        return self._ack(transport, peer, OK, count, seq)
+
+    def _ack(self, transport, peer, status, accepted, seq):
+        # UDP has no connection, so only the transport totals count it
+        for counters in (peer, self._totals[transport]):
+            if counters is None:
+                continue
+            counters.frames += 1
+            counters.readings += accepted
+            if status == MALFORMED:
+                counters.malformed += 1
+            elif status == BUSY:
+                counters.busy += 1
+            elif status == FAILED:
+                counters.failed += 1
+            elif status == PENDING:
+                counters.pending += 1
+        GATEWAY_FRAMES.inc(transport, STATUS_NAMES[status])
+        return encode_ack(status, accepted, seq)
+
+    async def _serve_tcp(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        if len(self._peers) >= self.max_connections:
+            writer.close()
+            return
+        peer = self._peers[addr] = _Peer()
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(HEADER.size)
+                except asyncio.IncompleteReadError:
+                    break
+                try:
+                    count, seq = decode_header(header)
+                except MalformedFrame:
+                    seq = HEADER.unpack(header)[3]
+                    writer.write(self._ack("tcp", peer, MALFORMED, 0, seq))
+                    await writer.drain()
+                    break
+                body = await reader.readexactly(count * READING.size)
+                writer.write(await self.handle("tcp", peer, count, seq, body))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._peers.pop(addr, None)
+            writer.close()
+
+    def stats(self):
+        return {
+            "udp_port": self.udp_port or None,
+            "tcp_port": self.tcp_port or None,
+            "udp_inflight": len(self._inflight),
+            "udp": self._totals["udp"].as_dict(),
+            "tcp": self._totals["tcp"].as_dict(),
+            "connections": [
+                {"peer": f"{addr[0]}:{addr[1]}", **peer.as_dict()} for addr, peer in self._peers.items()
+            ],
+        }
+
+
+class _Datagram(asyncio.DatagramProtocol):
+    """One frame per datagram; the ack goes back to the sender."""
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        gateway = self.gateway
+        seq = 0
+        try:
+            if len(data) < HEADER.size:
+                raise MalformedFrame("short datagram")
+            count, seq = decode_header(data)
+            if len(data) != HEADER.size + count * READING.size:
+                raise MalformedFrame("length does not match count")
+        except MalformedFrame:
+            if len(data) >= HEADER.size:
+                seq = HEADER.unpack_from(data)[3]
+            self.transport.sendto(gateway._ack("udp", None, MALFORMED, 0, seq), addr)
+            return
+        if len(gateway._inflight) >= gateway.max_inflight:
+            # A flood must not turn into unbounded tasks and database work
+            self.transport.sendto(gateway._ack("udp", None, BUSY, 0, seq), addr)
+            return
+        task = asyncio.ensure_future(self._handle(count, seq, data[HEADER.size:], addr))
+        gateway._inflight.add(task)
+        task.add_done_callback(gateway._inflight.discard)
+
+    async def _handle(self, count, seq, body, addr):
+        ack = await self.gateway.handle("udp", None, count, seq, body)
+        if self.transport is not None:
+            self.transport.sendto(ack, addr)
+
+    def connection_lost(self, exc):
+        self.transport = None
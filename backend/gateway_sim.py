@@ -0,0 +1,108 @@
+import argparse
+import asyncio
+import random
+import time
+
+from gateway import ACK, OK, STATUS_NAMES, decode_ack, encode_frame
+
+PREFIX = "sim-"
+
+
+class _AckWaiter(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.acks = asyncio.Queue()
+
+    def datagram_received(self, data, addr):
+        self.acks.put_nowait(data)
+
+
+def _readings(device_id, batch, volume):
+    now = int(time.time() * 1000)
+    return [(device_id, random.randint(0, volume), now + i) for i in range(batch)]
+
+
+async def _device_tcp(args, n, stats):
+    device_id = f"{PREFIX}{n:05d}"
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    try:
+        for seq in range(args.frames):
+            started = time.perf_counter()
+            writer.write(encode_frame(seq, _readings(device_id, args.batch, args.volume)))
+            await writer.drain()
+            stats.record(decode_ack(await reader.readexactly(ACK.size)), seq, time.perf_counter() - started)
+            if args.interval:
+                await asyncio.sleep(args.interval)
+    finally:
+        writer.close()
+
+
+async def _device_udp(args, n, stats):
+    device_id = f"{PREFIX}{n:05d}"
+    loop = asyncio.get_running_loop()
+    transport, proto = await loop.create_datagram_endpoint(_AckWaiter, remote_addr=(args.host, args.port))
+    try:
+        for seq in range(args.frames):
+            started = time.perf_counter()
+            transport.sendto(encode_frame(seq, _readings(device_id, args.batch, args.volume)))
+            try:
+                ack = await asyncio.wait_for(proto.acks.get(), args.timeout)
+            except asyncio.TimeoutError:
+                stats.lost += 1
+                continue
+            stats.record(decode_ack(ack), seq, time.perf_counter() - started)
+            if args.interval:
+                await asyncio.sleep(args.interval)
+    finally:
+        transport.close()
+
+
+class _Stats:
+    def __init__(self):
+        self.status = {}
+        self.readings = 0
+        self.lost = 0
+        self.out_of_order = 0
+        self.latencies = []
+
+    def record(self, ack, seq, elapsed):
+        status, accepted, ack_seq = ack
+        name = STATUS_NAMES.get(status, str(status))
+        self.status[name] = self.status.get(name, 0) + 1
+        self.readings += accepted
+        self.out_of_order += ack_seq != seq
+        self.latencies.append(elapsed)
+
+    def report(self, elapsed):
+        lat = sorted(self.latencies) or [0.0]
+        pct = lambda p: lat[min(len(lat) - 1, int(p * len(lat)))] * 1000
+        print(f"acks: {self.status}  unacked: {self.lost}  seq mismatches: {self.out_of_order}")
+        print(f"readings accepted: {self.readings} in {elapsed:.2f}s ({self.readings / elapsed:.0f}/s)")
+        print(f"ack latency ms: p50 {pct(0.5):.2f}  p95 {pct(0.95):.2f}  p99 {pct(0.99):.2f}  max {lat[-1] * 1000:.2f}")
+
+
+async def run(args):
+    stats = _Stats()
+    device = _device_tcp if args.transport == "tcp" else _device_udp
+    started = time.perf_counter()
+    await asyncio.gather(*(device(args, n, stats) for n in range(args.devices)))
+    stats.report(time.perf_counter() - started)
+    return 0 if stats.status.get(STATUS_NAMES[OK], 0) == args.devices * args.frames else 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate devices sending binary frames to the ingest gateway")
+    parser.add_argument("transport", choices=("udp", "tcp"))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--devices", type=int, default=10, help="concurrent simulated devices (sim-00000...)")
+    parser.add_argument("--frames", type=int, default=100, help="frames each device sends")
+    parser.add_argument("--batch", type=int, default=1, help="readings per frame (1-255)")
+    parser.add_argument("--interval", type=float, default=0.0, help="seconds between a device's frames")
+    parser.add_argument("--volume", type=int, default=500, help="largest random volume_ml")
+    parser.add_argument("--timeout", type=float, default=2.0, help="UDP: seconds to wait for an ack")
+    args = parser.parse_args(argv)
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,116 @@
+import os
+from datetime import timedelta
+
+import psycopg
+
+from rollups import parse_ts
+
+
+HISTOGRAM_MAX_BUCKETS = int(os.getenv("HISTOGRAM_MAX_BUCKETS", "10000"))
+
+# bucket name -> (date_trunc unit or None for date_bin, step interval, approx seconds)
+BUCKETS = {
+    "1m": ("minute", "1 minute", 60),
+    "5m": (None, "5 minutes", 300),
+    "15m": (None, "15 minutes", 900),
+    "hour": ("hour", "1 hour", 3600),
+    "day": ("day", "1 day", 86400),
+    "week": ("week", "1 week", 7 * 86400),
+    "month": ("month", "1 month", 28 * 86400),
+}
+
+WINDOWS = {
+    "devices": """
+        SELECT unnest(%(devices)s::varchar[]) AS device_id,
+               '-infinity'::timestamp AS attached_at, 'infinity'::timestamp AS detached_at
+    """,
+    "unit": """
+        SELECT d.device_id, ud.attached_at, COALESCE(ud.detached_at, 'infinity') AS detached_at
+        FROM unit_devices ud JOIN devices d ON d.id = ud.device_id
+        WHERE ud.unit_id = %(unit)s
+    """,
+    "org": """
+        SELECT device_id, '-infinity'::timestamp AS attached_at, 'infinity'::timestamp AS detached_at
+        FROM devices WHERE organisation_id = %(org)s
+    """,
+}
+
+# device_data.timestamp holds UTC wall-clock time. The session TimeZone is set
+# to the caller's zone for the transaction, so date_trunc/date_bin and
+# generate_series all bucket in local time (DST included), and start/end
+# strings without an offset are read as local time.
+HISTOGRAM_SQL = """
+WITH windows AS ({windows}),
+bounds AS (
+    SELECT %(start)s::timestamptz AS lo, %(end)s::timestamptz AS hi
+),
+buckets AS (
+    SELECT generate_series({first_bucket}, hi, %(step)s::interval) AS bucket FROM bounds
+),
+agg AS (
+    SELECT w.device_id, {bucket} AS bucket, SUM(dd.volume_ml)::bigint AS total, COUNT(*) AS readings
+    FROM windows w
+    CROSS JOIN bounds
+    JOIN device_data dd
+      ON dd.device_id = w.device_id
+     AND dd.timestamp >= GREATEST(w.attached_at, bounds.lo AT TIME ZONE 'UTC')
+     AND dd.timestamp <= bounds.hi AT TIME ZONE 'UTC'
+     AND dd.timestamp < w.detached_at
+    GROUP BY 1, 2
+)
+SELECT d.device_id, b.bucket, COALESCE(SUM(a.total), 0)::bigint, COALESCE(SUM(a.readings), 0)::bigint
+FROM (SELECT DISTINCT device_id FROM windows) d
+CROSS JOIN buckets b
+LEFT JOIN agg a ON a.device_id = d.device_id AND a.bucket = b.bucket
+GROUP BY d.device_id, b.bucket
+ORDER BY d.device_id, b.bucket
+"""
+
+
+def _bucket_expr(bucket, col):
+    unit, step, _ = BUCKETS[bucket]
+    if unit:
+        return f"date_trunc('{unit}', {col})"
+    return f"date_bin('{step}', {col}, TIMESTAMPTZ '2000-01-01')"
+
+
+def check_window(start, end, bucket):
+    """Raise ValueError for an unknown bucket or a window with too many buckets."""
+    if bucket not in BUCKETS:
+        raise ValueError(f"bucket must be one of {', '.join(BUCKETS)}")
+    lo, hi = parse_ts(start), parse_ts(end)
+    if hi < lo:
+        raise ValueError("end is before start")
+    if (hi - lo) / timedelta(seconds=BUCKETS[bucket][2]) > HISTOGRAM_MAX_BUCKETS:
+        raise ValueError(f"window spans more than {HISTOGRAM_MAX_BUCKETS} buckets; use a larger bucket")
+
+
+async def histogram_series(conn, scope, params, start, end, bucket="hour", tz="UTC"):
+    """Gap-filled per-device series for ``scope`` ("devices", "unit" or "org").
+
+    ``params`` carries the scope key (``devices``, ``unit`` or ``org``).
+    ``conn`` is an async (psycopg 3) connection from aiodb.adb. Returns
+    ``[{"device_id": ..., "points": [...]}, ...]`` from one query.
+    """
+    sql = HISTOGRAM_SQL.format(
+        windows=WINDOWS[scope],
+        first_bucket=_bucket_expr(bucket, "lo"),
+        bucket=_bucket_expr(bucket, "(dd.timestamp AT TIME ZONE 'UTC')"),
+    )
+    # set_config(..., true) only lasts until the end of the transaction
+    async with conn.transaction():
+        cursor = conn.cursor()
+        try:
+            await cursor.execute("SELECT set_config('TimeZone', %s, true)", (tz,))
+        except psycopg.DataError:
+            raise ValueError(f"unknown timezone: {tz}")
+        await cursor.execute(sql, dict(params, start=start, end=end, step=BUCKETS[bucket][1]))
+        rows = await cursor.fetchall()
+        await cursor.close()
+
+    series = []
+    for device_id, ts, total, readings in rows:
+        if not series or series[-1]["device_id"] != device_id:
+            series.append({"device_id": device_id, "points": []})
+        series[-1]["points"].append({"timestamp": ts.isoformat(), "total_volume": total, "readings": readings})
+    return series
@@ -0,0 +1,278 @@
+import io
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
+
+import psycopg2
+import psycopg2.errors
+
+from db import PoolTimeout
+from device_stats import device_stats
+from live import live
+from logs import get_logger
+from metrics import INGEST_FAILURES, INGEST_READINGS
+from rollups import rollups
+
+log = get_logger("ingest")
+
+
+# COPY text format treats backslash, tab and newlines specially
+def _copy_text(value):
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def parse_batch(body, content_type=""):
+    """Decode a batch body into a list of reading dicts.
+
+    Accepts a JSON array, ``{"readings": [...]}``, or NDJSON (one reading
+    per line) when the content type says so. Raises ``ValueError`` with a
+    message suitable for a 400 response.
+    """
+    if "ndjson" in content_type or "jsonlines" in content_type:
+        items = []
+        for lineno, line in enumerate(body.splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError as e:
+                raise ValueError(f"line {lineno}: {e}")
+        return items
+
+    try:
+        payload = json.loads(body or b"null")
+    except ValueError as e:
+        raise ValueError(f"invalid JSON: {e}")
+    if isinstance(payload, dict) and isinstance(payload.get("readings"), list):
+        payload = payload["readings"]
+    if not isinstance(payload, list):
+        raise ValueError("expected a JSON array of readings")
+    return payload
+
+
+def write_readings(conn, readings, devices=None):
+    """Insert (device_id, volume_ml, timestamp) rows in the caller's transaction.
+
+    Unknown devices are created with one set-based upsert and the readings
+    are streamed in with COPY, then folded into the rollups and running
+    device totals. Ids already in the ``devices`` cache skip the upsert. The
+    caller commits, then adds the device ids to the cache. Returns
+    ``(readings written, devices created)``.
+    """
+    rows = list(readings)
+    if not rows:
+        return 0, 0
+
+    cursor = conn.cursor()
+    # Sorted so concurrent batches take device row locks in the same order
+    device_ids = sorted({r[0] for r in rows})
+    if devices is not None:
+        device_ids = devices.missing(device_ids)
+    created = 0
+    if device_ids:
+        cursor.execute(
+            "INSERT INTO devices (device_id) SELECT unnest(%s::varchar[]) ON CONFLICT (device_id) DO NOTHING",
+            (device_ids,)
+        )
+        created = cursor.rowcount
+
+    buf = io.StringIO()
+    for device_id, volume_ml, ts in rows:
+        ts_str = ts.isoformat() if isinstance(ts, datetime) else ts
+        buf.write(f"{_copy_text(device_id)}\t{int(volume_ml)}\t{_copy_text(ts_str)}\n")
+    buf.seek(0)
+    cursor.copy_expert("COPY device_data (device_id, volume_ml, timestamp) FROM STDIN", buf)
+    rollups.apply(cursor, rows)
+    device_stats.apply(cursor, rows)
+    live.notify(cursor, rows)
+    cursor.close()
+    return len(rows), created
+
+
+# Worth retrying as is: the connection went away, the pool was exhausted,
+# or the transaction lost a serialization/deadlock conflict
+_TRANSIENT = (
+    psycopg2.OperationalError,
+    psycopg2.InterfaceError,
+    psycopg2.errors.SerializationFailure,
+    psycopg2.errors.DeadlockDetected,
+    PoolTimeout,
+)
+
+
+def _transient(error):
+    return isinstance(error, _TRANSIENT)
+
+
+class BufferFull(Exception):
+    pass
+
+
+class IngestBuffer:
+    """Write-behind queue that group-commits readings from a background thread.
+
+    A batch is flushed once ``flush_rows`` readings are waiting or the oldest
+    has waited ``flush_ms`` milliseconds, whichever comes first. ``submit``
+    returns a Future that resolves once the reading is committed, so callers
+    can choose between ack-after-enqueue and ack-after-flush.
+    """
+
+    _STOP = object()
+
+    def __init__(self, pool, flush_rows=500, flush_ms=200, capacity=50000, retries=3,
+                 devices=None, on_new_devices=None):
+        self.pool = pool
+        self.devices = devices
+        self.on_new_devices = on_new_devices
+        self.flush_rows = flush_rows
+        self.flush_ms = flush_ms
+        self.retries = retries
+        self._queue = queue.Queue(maxsize=capacity)
+        self._thread = None
+        self._lock = threading.Lock()
+
+        self._enqueued = 0
+        self._rejected = 0
+        self._flushes = 0
+        self._flushed_rows = 0
+        self._failed_rows = 0
+        self._last_batch = 0
+        self._max_batch = 0
+        self._flush_total = 0.0
+        self._flush_last = 0.0
+        self._flush_max = 0.0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="ingest-flusher", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=30.0):
+        # Sentinel goes in behind everything already queued, so the flusher drains first
+        if self._thread is not None:
+            self._queue.put(self._STOP)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def submit(self, device_id, volume_ml, timestamp):
+        fut = Future()
+        try:
+            self._queue.put_nowait(((device_id, volume_ml, timestamp), fut))
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            INGEST_FAILURES.inc("buffered")
+            raise BufferFull("ingest buffer is full")
+        with self._lock:
+            self._enqueued += 1
+        return fut
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is self._STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_ms / 1000.0
+            while len(batch) < self.flush_rows:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+
+    def _flush(self, batch):
+        started = time.monotonic()
+        failed = self._write(batch)
+        elapsed = time.monotonic() - started
+        written = len(batch) - len(failed)
+
+        with self._lock:
+            self._flushes += 1
+            self._last_batch = len(batch)
+            self._max_batch = max(self._max_batch, len(batch))
+            self._flush_last = elapsed
+            self._flush_total += elapsed
+            self._flush_max = max(self._flush_max, elapsed)
+            self._flushed_rows += written
+            self._failed_rows += len(failed)
+
+        if written:
+            INGEST_READINGS.inc("buffered", amount=written)
+        if failed:
+            INGEST_FAILURES.inc("buffered", amount=len(failed))
+            log.error("ingest flush failed", extra={"dropped": len(failed), "error": repr(failed[0][1])})
+        errors = {id(item): error for item, error in failed}
+        for item in batch:
+            error = errors.get(id(item))
+            if error is None:
+                item[1].set_result(True)
+            else:
+                item[1].set_exception(error)
+
+    def _write(self, batch):
+        """Write ``batch``; returns ``[(item, error)]`` for what could not be.
+
+        A batch that fails for a reason other than a lost connection or a
+        serialization conflict is split in halves and each half written on
+        its own, so one bad reading fails alone instead of its whole group
+        commit.
+        """
+        error = self._commit([reading for reading, _ in batch])
+        if error is None:
+            return []
+        if len(batch) == 1 or _transient(error):
+            return [(item, error) for item in batch]
+        mid = len(batch) // 2
+        return self._write(batch[:mid]) + self._write(batch[mid:])
+
+    def _commit(self, readings):
+        """One transaction, retried on transient errors; returns the last error or None."""
+        for attempt in range(self.retries + 1):
+            try:
+                with self.pool.connection() as conn:
+                    _, created = write_readings(conn, readings, self.devices)
+                    conn.commit()
+            except Exception as e:
+                if not _transient(e) or attempt == self.retries:
+                    return e
+                time.sleep(min(0.1 * 2 ** attempt, 2.0))
+                continue
+            if self.devices is not None:
+                self.devices.add_many({r[0] for r in readings})
+            if created and self.on_new_devices:
+                self.on_new_devices()
+            return None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "capacity": self._queue.maxsize,
+                "enqueued": self._enqueued,
+                "rejected": self._rejected,
+                "flushes": self._flushes,
+                "flushed_rows": self._flushed_rows,
+                "failed_rows": self._failed_rows,
+                "batch_size_last": self._last_batch,
+                "batch_size_avg": round(self._flushed_rows / self._flushes, 1) if self._flushes else 0.0,
+                "batch_size_max": self._max_batch,
+                "flush_ms_last": round(self._flush_last * 1000, 3),
+                "flush_ms_avg": round(self._flush_total * 1000 / self._flushes, 3) if self._flushes else 0.0,
+                "flush_ms_max": round(self._flush_max * 1000, 3),
+            }
@@ -0,0 +1,238 @@
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict, deque
+
+from aiodb import listener
+from logs import get_logger
+from metrics import metrics
+from rollups import parse_ts
+
+log = get_logger("live")
+
+CHANNEL = "live_readings"
+
+# NOTIFY payloads are capped at 8000 bytes; stay well under
+PAYLOAD_MAX = 7000
+
+POLICIES = ("drop_oldest", "coalesce")
+
+LIVE_DELIVERED = metrics.counter(
+    "live_readings_delivered_total", "Readings written to live subscribers",
+)
+LIVE_DROPPED = metrics.counter(
+    "live_readings_dropped_total", "Readings a slow live subscriber never saw, by buffer policy", ("policy",),
+)
+
+
+def _payloads(rows):
+    """Compact JSON arrays of ``[device_id, volume_ml, timestamp]``, each
+    small enough for one NOTIFY."""
+    out, chunk, size = [], [], 2
+    for device_id, volume_ml, ts in rows:
+        item = json.dumps([device_id, int(volume_ml), parse_ts(ts).isoformat()], separators=(",", ":"))
+        if chunk and size + len(item) + 1 > PAYLOAD_MAX:
+            out.append("[" + ",".join(chunk) + "]")
+            chunk, size = [], 2
+        chunk.append(item)
+        size += len(item) + 1
+    if chunk:
+        out.append("[" + ",".join(chunk) + "]")
+    return out
+
+
+class Subscriber:
+    """Bounded buffer between the hub and one client.
+
+    ``drop_oldest`` keeps the newest ``size`` readings; ``coalesce`` keeps
+    only the latest reading per device (at most ``size`` devices), which
+    suits dashboards that show current values. Either way a slow client
+    never holds more than ``size`` readings in memory, and the count of
+    readings it missed is reported with the next batch.
+    """
+
+    def __init__(self, devices, size=1000, policy="drop_oldest"):
+        if policy not in POLICIES:
+            raise ValueError(f"policy must be one of {', '.join(POLICIES)}")
+        self.devices = set(devices)
+        self.size = size
+        self.policy = policy
+        self.dropped = 0
+        self.resync = False
+        self._items = OrderedDict() if policy == "coalesce" else deque()
+        self._wake = asyncio.Event()
+
+    def push(self, reading):
+        items = self._items
+        if self.policy == "coalesce":
+            device_id = reading[0]
+            if device_id in items:
+                del items[device_id]
+                self.dropped += 1
+            elif len(items) >= self.size:
+                items.popitem(last=False)
+                self.dropped += 1
+            items[device_id] = reading
+        else:
+            if len(items) >= self.size:
+                items.popleft()
+                self.dropped += 1
+            items.append(reading)
+        self._wake.set()
+
+    def mark_resync(self):
+        self.resync = True
+        self._wake.set()
+
+    async def next_batch(self, timeout):
+        """Wait up to ``timeout`` seconds; returns ``(readings, dropped, resync)``
+        and empties the buffer."""
+        if not self._items and not self.resync:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self._wake.clear()
+        readings = list(self._items.values() if self.policy == "coalesce" else self._items)
+        self._items.clear()
+        dropped, self.dropped = self.dropped, 0
+        resync, self.resync = self.resync, False
+        if dropped:
+            LIVE_DROPPED.inc(self.policy, amount=dropped)
+        LIVE_DELIVERED.inc(amount=len(readings))
+        return readings, dropped, resync
+
+
+class LiveHub:
+    """In-process fan-out of newly committed readings to live subscribers.
+
+    Ingest calls ``notify`` inside its transaction, so a ``pg_notify`` goes
+    out only when the readings commit. NOTIFY serializes commits on a
+    cluster-wide lock, so the hub is off unless LIVE_ENABLED=1. Every worker LISTENs (aiodb.listener)
+    and hands each notification to the local subscribers of
+    those devices, so a reading accepted by any worker reaches subscribers
+    on all of them. Subscribers are indexed by device_id; unit and
+    organisation scopes are resolved to device ids by the caller.
+    """
+
+    def __init__(self, enabled=False, buffer=1000, max_subscribers=10000, heartbeat=15.0, scope_ttl=60.0):
+        self.enabled = enabled
+        self.buffer = buffer
+        self.max_subscribers = max_subscribers
+        self.heartbeat = heartbeat
+        self.scope_ttl = scope_ttl
+        self._by_device = {}
+        self._subscribers = set()
+        if enabled:
+            listener.subscribe(CHANNEL, self._on_notify, self._resync)
+
+    # Ingest side: psycopg2 cursor, in the same transaction as the insert
+    def notify(self, cursor, rows):
+        if not self.enabled:
+            return
+        cursor.execute("SELECT pg_notify(%s, p) FROM unnest(%s::text[]) p", (CHANNEL, _payloads(rows)))
+
+    def full(self):
+        return len(self._subscribers) >= self.max_subscribers
+
+    def subscribe(self, devices, size=None, policy="drop_oldest"):
+        sub = Subscriber(devices, size or self.buffer, policy)
+        self._subscribers.add(sub)
+        for device_id in sub.devices:
+            self._by_device.setdefault(device_id, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        self._subscribers.discard(sub)
+        self._index(sub, set())
+
+    def update(self, sub, devices):
+        """Re-point ``sub`` at a new device set (unit swaps, new org devices)."""
+        if sub in self._subscribers:
+            self._index(sub, set(devices))
+
+    def _index(self, sub, devices):
+        for device_id in sub.devices - devices:
+            subs = self._by_device.get(device_id)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._by_device[device_id]
+        for device_id in devices - sub.devices:
+            self._by_device.setdefault(device_id, set()).add(sub)
+        sub.devices = devices
+
+    def publish(self, readings):
+        by_device = self._by_device
+        for reading in readings:
+            for sub in by_device.get(reading[0], ()):
+                sub.push(reading)
+
+    async def events(self, devices, size=None, policy="drop_oldest", resolve=None):
+        """Server-sent events for a new subscriber to ``devices``: ``reading``
+        per reading, ``dropped`` when the buffer overflowed, ``resync`` after
+        a listener reconnect (refetch history to fill the gap) and a comment
+        line as heartbeat.
+
+        The subscriber only exists while the body is being streamed, so a
+        response that never starts leaves nothing behind. ``resolve`` is
+        re-awaited every ``scope_ttl`` seconds so unit and organisation
+        scopes follow device swaps and new devices.
+        """
+        sub = self.subscribe(devices, size, policy)
+        refreshed = time.monotonic()
+        try:
+            yield f"retry: {int(self.heartbeat * 1000)}\n\n"
+            while True:
+                readings, dropped, resync = await sub.next_batch(self.heartbeat)
+                if resync:
+                    yield "event: resync\ndata: {}\n\n"
+                if dropped:
+                    yield f'event: dropped\ndata: {{"count":{dropped}}}\n\n'
+                if readings:
+                    yield "".join(
+                        "event: reading\ndata: " + json.dumps(
+                            {"device_id": device_id, "volume_ml": volume_ml, "timestamp": ts}, separators=(",", ":")
+                        ) + "\n\n"
+                        for device_id, volume_ml, ts in readings
+                    )
+                elif not (resync or dropped):
+                    yield ": ping\n\n"
+                if resolve is not None and time.monotonic() - refreshed >= self.scope_ttl:
+                    refreshed = time.monotonic()
+                    try:
+                        self.update(sub, await resolve())
+                    except Exception as e:
+                        log.warning("live scope refresh failed", extra={"error": repr(e)})
+        finally:
+            self.unsubscribe(sub)
+
+    def _on_notify(self, payload):
+        self.publish(json.loads(payload))
+
+    def _resync(self):
+        # Readings committed while the listener was away were missed
+        for sub in self._subscribers:
+            sub.mark_resync()
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "listening": listener.connected,
+            "subscribers": len(self._subscribers),
+            "devices": len(self._by_device),
+            "notifications": listener.received,
+            "reconnects": listener.reconnects,
+        }
+
+
+live = LiveHub(
+    enabled=os.getenv("LIVE_ENABLED", "0") == "1",
+    buffer=int(os.getenv("LIVE_BUFFER", "1000")),
+    max_subscribers=int(os.getenv("LIVE_MAX_SUBSCRIBERS", "10000")),
+    heartbeat=float(os.getenv("LIVE_HEARTBEAT", "15")),
+    scope_ttl=float(os.getenv("LIVE_SCOPE_TTL", "60")),
+)
+
+metrics.gauge("live_subscribers", "Open live subscriptions", collect=lambda: [((), len(live._subscribers))])
@@ -0,0 +1,81 @@
+import json
+import logging
+import os
+import random
+import sys
+from datetime import datetime, timezone
+
+
+# Attributes every LogRecord has; anything else came in through ``extra=``
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, msg plus any ``extra`` fields."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """``level logger: msg key=value ...`` for reading logs in a terminal."""
+
+    def format(self, record):
+        fields = " ".join(
+            f"{key}={value}" for key, value in vars(record).items()
+            if key not in _RESERVED and not key.startswith("_")
+        )
+        line = f"{record.levelname.lower():7} {record.name}: {record.getMessage()}"
+        if fields:
+            line += " " + fields
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class SampleFilter(logging.Filter):
+    """Keep a ``rate`` fraction of records below WARNING; warnings and errors
+    always pass. Per-request debug/info lines are only affordable sampled."""
+
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or self.rate >= 1.0 or random.random() < self.rate
+
+
+def setup_logging(level=None, fmt=None, sample_rate=None):
+    """Configure the ``iot`` logger tree from LOG_LEVEL / LOG_FORMAT / LOG_SAMPLE_RATE.
+
+    Only the app's own loggers are touched, so uvicorn's access and error
+    logs keep their own configuration. Safe to call more than once.
+    """
+    level = level or os.getenv("LOG_LEVEL", "INFO")
+    fmt = fmt or os.getenv("LOG_FORMAT", "json")
+    sample_rate = float(os.getenv("LOG_SAMPLE_RATE", "1.0") if sample_rate is None else sample_rate)
+
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+    handler.addFilter(SampleFilter(sample_rate))
+
+    root = logging.getLogger("iot")
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper())
+    root.propagate = False
+    return root
+
+
+def get_logger(name):
+    return logging.getLogger("iot." + name)
@@ -1,16 +1,46 @@
 from fastapi import FastAPI, HTTPException, Request, Body, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel, Field
 from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.datastructures import MutableHeaders
 from starlette.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
 from datetime import datetime
-import psycopg2
+import asyncio
+import json
 import os
-from passlib.context import CryptContext
+import time
+from db import db_pool, schema_lock, start_db_timer
+from aiodb import adb, cancel_on_disconnect, listener
+from logs import get_logger, setup_logging
+from metrics import HTTP_DURATION, INGEST_FAILURES, INGEST_READINGS, metrics
+from device_cache import device_cache
+from device_stats import device_stats
+from user_cache import user_cache
+from passwords import PasswordBusy, password_hasher
+from response_cache import response_cache
+from rollups import parse_ts, rollups, totals_query
+from streaming import dumps, stream_rows
+from partitions import partitions
+from migrations import migrate
+from pagination import PAGE_SIZE_MAX, decode_cursor, page_of
+from downsample import METHODS as DOWNSAMPLE_METHODS, downsample as downsample_rows
+from histograms import check_window, histogram_series
+from ingest import BufferFull, IngestBuffer, parse_batch, write_readings
+from live import POLICIES as LIVE_POLICIES, live
+from gateway import Busy as GatewayBusy, Failed as GatewayFailed, Gateway, Pending as GatewayPending
+from ratelimit import ingest_limiter, load_shedder, retry_after
+from statements import statements
+from export import FORMATS as EXPORT_FORMATS, SCOPES as EXPORT_SCOPES, csv_body, export_params, parquet_body
+from export import COLUMNS as EXPORT_COLUMNS, filename as export_filename, parquet_available
+from unit_timeline import PAGE_COLUMNS, current_device, ranges, rows_query, unit_timeline
 from typing import Optional
 
 
+setup_logging()
+log = get_logger("api")
+
 app = FastAPI()
 
 # CORS setup
@@ -25,127 +55,612 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Connect to database on demand
-def get_connection():
-    return psycopg2.connect(
-        dbname=os.getenv("POSTGRES_DB", "iot"),
-        user=os.getenv("POSTGRES_USER", "postgres"),
-        password=os.getenv("POSTGRES_PASSWORD", "secret"),
-        host=os.getenv("POSTGRES_HOST", "db"),
-        port="5432",
-        sslmode="require"
+# Optional write-behind ingest: INGEST_MODE=buffered queues readings and a
+# background thread group-commits them. INGEST_ACK picks when /ingest answers:
+# "enqueue" (fastest, readings in the queue are lost on a crash) or "flush".
+INGEST_MODE = os.getenv("INGEST_MODE", "sync")
+INGEST_ACK = os.getenv("INGEST_ACK", "flush")
+INGEST_ACK_TIMEOUT = float(os.getenv("INGEST_ACK_TIMEOUT", "10"))
+
+# Apply pending migrations/*.sql at startup (otherwise: python migrations.py up)
+MIGRATE_ON_STARTUP = os.getenv("MIGRATE_ON_STARTUP", "0") == "1"
+
+ingest_buffer = None
+if INGEST_MODE == "buffered":
+    ingest_buffer = IngestBuffer(
+        db_pool,
+        flush_rows=int(os.getenv("INGEST_FLUSH_ROWS", "500")),
+        flush_ms=float(os.getenv("INGEST_FLUSH_MS", "200")),
+        capacity=int(os.getenv("INGEST_QUEUE_MAX", "50000")),
+        devices=device_cache,
+        on_new_devices=lambda: response_cache.bump("devices"),
     )
 
+# Pooled database connections; borrow with `with db_pool.connection() as conn:`
+@app.on_event("startup")
+def startup():
+    try:
+        db_pool.open()
+    except Exception as e:
+        log.error("could not pre-open DB pool", extra={"error": repr(e)})
+    # Every worker runs this; the lock keeps their DDL from racing
+    with schema_lock():
+        if MIGRATE_ON_STARTUP:
+            try:
+                with db_pool.connection() as conn:
+                    migrate(conn)
+            except Exception as e:
+                log.error("could not apply migrations", extra={"error": repr(e)})
+        try:
+            rollups.setup(db_pool)
+        except Exception as e:
+            log.error("could not set up rollups", extra={"error": repr(e)})
+        try:
+            device_stats.setup(db_pool)
+        except Exception as e:
+            log.error("could not set up device stats", extra={"error": repr(e)})
+        try:
+            with db_pool.connection() as conn:
+                partitions.ensure(conn)
+        except Exception as e:
+            log.error("could not create device_data partitions", extra={"error": repr(e)})
+    try:
+        device_cache.warm(db_pool)
+    except Exception as e:
+        log.error("could not warm device cache", extra={"error": repr(e)})
+    if ingest_limiter.org.enabled:
+        ingest_limiter.orgs.setup(db_pool)
+    if ingest_buffer:
+        ingest_buffer.start()
+
+# Read routes run on the async pool (aiodb.py); writes stay on db_pool
+@app.on_event("startup")
+async def open_async_pool():
+    try:
+        await adb.open()
+    except Exception as e:
+        log.error("could not open async DB pool", extra={"error": repr(e)})
+    # LISTEN for live readings, unit_devices, user and organisation changes
+    await listener.start()
+
+@app.on_event("shutdown")
+async def close_async_pool():
+    await listener.stop()
+    await adb.close()
+
+@app.on_event("shutdown")
+def shutdown():
+    # Drain queued readings while the pool is still open
+    if ingest_buffer:
+        ingest_buffer.stop()
+    password_hasher.close()
+    db_pool.close()
+
+@app.get("/pool/stats")
+def get_pool_stats():
+    return {**db_pool.stats(), "async": adb.stats()}
+
+@app.get("/db/statements")
+def get_statement_stats():
+    return statements.stats()
+
+@app.get("/ingest/stats")
+def get_ingest_stats():
+    if not ingest_buffer:
+        return {"mode": INGEST_MODE, "device_cache": device_cache.stats(), "limits": ingest_limiter.stats()}
+    return {
+        "mode": INGEST_MODE, "ack": INGEST_ACK, **ingest_buffer.stats(),
+        "device_cache": device_cache.stats(), "limits": ingest_limiter.stats(),
+    }
+
+# Rate limits and load shedding (ratelimit.py), checked before any connection
+# is borrowed so a flood can't tie up the pool
+def _admit(device_ids):
+    reason, retry = ingest_limiter.admit(device_ids)
+    if reason == "shed":
+        raise HTTPException(status_code=503, detail="Database under pressure, retry later",
+                            headers={"Retry-After": retry_after(retry)})
+    if reason:
+        scope = "device" if reason == "device_rate" else "organisation"
+        raise HTTPException(status_code=429, detail=f"Ingest rate limit exceeded for this {scope}",
+                            headers={"Retry-After": retry_after(retry)})
+
 # Device data model for ingestion
 class VolumeData(BaseModel):
     device_id: str
     volume_ml: int
     timestamp: datetime
 
+# Hot statements are prepared once per connection (statements.py)
+INGEST_INSERT = statements.register(
+    "ingest_reading", "INSERT INTO device_data (device_id, volume_ml, timestamp) VALUES (%s, %s, %s)"
+)
+
 # Ingest endpoint
+# Async so that waiting for a group commit holds a coroutine, not one of the
+# threadpool's 40 threads (which would cap every flush at 40 readings); the
+# direct write still runs in the threadpool
 @app.post("/ingest")
-def ingest_data(data: VolumeData):
+async def ingest_data(data: VolumeData):
+    _admit((data.device_id,))
+    if not ingest_buffer:
+        return await run_in_threadpool(_ingest_one, data)
+    try:
+        fut = ingest_buffer.submit(data.device_id, data.volume_ml, data.timestamp)
+    except BufferFull:
+        raise HTTPException(status_code=503, detail="Ingest queue full", headers={"Retry-After": "1"})
+    if INGEST_ACK != "flush":
+        return {"status": "queued"}
+    try:
+        # shield: a timeout or a disconnect must not cancel the queued write
+        await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(fut)), INGEST_ACK_TIMEOUT)
+    except asyncio.TimeoutError:
+        # Still queued and may yet commit, so a retry could duplicate it
+        # (the gateway acks the same case PENDING)
+        return JSONResponse(status_code=202, content={"status": "pending"})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"status": "ok"}
+
+def _ingest_one(data):
     try:
         timestamp_str = data.timestamp.isoformat()
-        print(f"Ingesting data: {data}")
-        print(f"timestamp_str: {timestamp_str}")
-        conn = get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT 1 FROM devices WHERE device_id = %s", (data.device_id,))
-        exists = cursor.fetchone()
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
 
-        if not exists:
-         cursor.execute("INSERT INTO devices (device_id) VALUES (%s)", (data.device_id,))
+            # Known devices skip the lookup; new ones are created race-free
+            created = 0
+            if data.device_id not in device_cache:
+                cursor.execute(
+                    "INSERT INTO devices (device_id) VALUES (%s) ON CONFLICT (device_id) DO NOTHING",
+                    (data.device_id,)
+                )
+                created = cursor.rowcount
+
+            started = time.perf_counter()
+            statements.execute_sync(cursor, INGEST_INSERT, (data.device_id, data.volume_ml, timestamp_str))
+            # Only this insert feeds the shedder's statement-time signal
+            load_shedder.observe_query(time.perf_counter() - started)
+            rollups.apply(cursor, [(data.device_id, data.volume_ml, data.timestamp)])
+            device_stats.apply(cursor, [(data.device_id, data.volume_ml, data.timestamp)])
+            live.notify(cursor, [(data.device_id, data.volume_ml, data.timestamp)])
+            conn.commit()
+            cursor.close()
+        device_cache.add(data.device_id)
+        if created:
+            response_cache.bump("devices")
+        INGEST_READINGS.inc("single")
+        return {"status": "ok"}
+    except Exception as e:
+        INGEST_FAILURES.inc("single")
+        log.error("ingest failed", extra={"device_id": data.device_id, "error": repr(e)})
+        raise HTTPException(status_code=500, detail=str(e))
 
+# Batch ingest: JSON array (or NDJSON) of readings written in one transaction
+INGEST_BATCH_MAX = int(os.getenv("INGEST_BATCH_MAX", "10000"))
 
-        cursor.execute(
-            "INSERT INTO device_data (device_id, volume_ml, timestamp) VALUES (%s, %s, %s)",
-            (data.device_id, data.volume_ml, timestamp_str)
-        )
+def _write_batch(readings):
+    with db_pool.connection() as conn:
+        count, created = write_readings(conn, readings, device_cache)
         conn.commit()
-        cursor.close()
-        conn.close()
-        return {"status": "ok"}
+    device_cache.add_many({r[0] for r in readings})
+    if created:
+        response_cache.bump("devices")
+    return count
+
+@app.post("/ingest/batch")
+async def ingest_batch(request: Request):
+    body = await request.body()
+    try:
+        items = parse_batch(body, request.headers.get("content-type", ""))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if len(items) > INGEST_BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"Batch too large (max {INGEST_BATCH_MAX} readings)")
+
+    readings = []
+    for i, item in enumerate(items):
+        try:
+            data = VolumeData(**item)
+        except Exception as e:
+            raise HTTPException(status_code=422, detail=f"reading {i}: {e}")
+        readings.append((data.device_id, data.volume_ml, data.timestamp))
+
+    _admit([r[0] for r in readings])
+    try:
+        count = await run_in_threadpool(_write_batch, readings)
     except Exception as e:
-        print("🔥 ERROR:", repr(e))  # use repr to get full error details
+        INGEST_FAILURES.inc("batch", amount=len(readings))
+        log.error("batch ingest failed", extra={"readings": len(readings), "error": repr(e)})
         raise HTTPException(status_code=500, detail=str(e))
+    INGEST_READINGS.inc("batch", amount=count)
+    return {"status": "ok", "count": count}
+
+# Binary UDP/TCP ingest (gateway.py), off unless a port is set. Frames take
+# the same path as POST /ingest: the buffered queue, or one transaction each.
+async def _gateway_write(readings):
+    if ingest_limiter.admit([r[0] for r in readings])[0]:
+        raise GatewayBusy(0)
+    if ingest_buffer:
+        futs, full = [], False
+        for reading in readings:
+            try:
+                futs.append(ingest_buffer.submit(*reading))
+            except BufferFull:
+                full = True
+                break
+        if INGEST_ACK != "flush":
+            # Acked on enqueue, like POST /ingest's "queued"
+            if full:
+                raise GatewayBusy(len(futs))
+            return
+        # Only readings confirmed written count as accepted
+        waits = [asyncio.wrap_future(f) for f in futs]
+        if waits:
+            await asyncio.wait(waits, timeout=INGEST_ACK_TIMEOUT)
+        written = [w.done() and w.exception() is None for w in waits]
+        accepted = written.index(False) if False in written else len(written)
+        if accepted == len(readings):
+            return
+        if not all(w.done() for w in waits):
+            # Still queued: the commit may yet happen, so a resend could duplicate
+            raise GatewayPending(accepted)
+        if accepted < len(waits):
+            raise GatewayFailed(accepted)
+        raise GatewayBusy(accepted)
+    try:
+        count = await run_in_threadpool(_write_batch, readings)
+    except Exception:
+        INGEST_FAILURES.inc("gateway", amount=len(readings))
+        raise
+    INGEST_READINGS.inc("gateway", amount=count)
+
+gateway = Gateway(
+    _gateway_write,
+    host=os.getenv("GATEWAY_HOST", "0.0.0.0"),
+    udp_port=int(os.getenv("GATEWAY_UDP_PORT", "0")),
+    tcp_port=int(os.getenv("GATEWAY_TCP_PORT", "0")),
+    max_connections=int(os.getenv("GATEWAY_MAX_CONNECTIONS", "1000")),
+    max_inflight=int(os.getenv("GATEWAY_MAX_INFLIGHT", "1000")),
+)
+
+@app.on_event("startup")
+async def start_gateway():
+    try:
+        await gateway.start()
+    except Exception as e:
+        log.error("could not start ingest gateway", extra={"error": repr(e)})
+
+@app.on_event("shutdown")
+async def stop_gateway():
+    await gateway.stop()
+
+@app.get("/gateway/stats")
+def get_gateway_stats():
+    return {"enabled": gateway.enabled, **gateway.stats()}
+
+# Live push: server-sent events for readings as they commit (live.py)
+LIVE_UNIT_DEVICES_SQL = """
+    SELECT d.device_id FROM unit_devices ud JOIN devices d ON d.id = ud.device_id
+    WHERE ud.unit_id = %s AND ud.active = TRUE
+"""
+
+async def _device_ids(sql, params):
+    async with adb.connection() as conn:
+        cursor = conn.cursor()
+        await cursor.execute(sql, params)
+        rows = await cursor.fetchall()
+        await cursor.close()
+    return {row[0] for row in rows}
+
+@app.get("/live")
+async def live_readings(
+    request: Request,
+    device_id: Optional[list[str]] = Query(None),
+    unitId: Optional[int] = Query(None, description="units.id; follows device swaps"),
+    policy: str = "drop_oldest",
+    buffer: Optional[int] = Query(None, ge=1, le=100000),
+):
+    if not live.enabled:
+        raise HTTPException(status_code=404, detail="Live push is disabled")
+    if policy not in LIVE_POLICIES:
+        raise HTTPException(status_code=400, detail=f"policy must be one of {', '.join(LIVE_POLICIES)}")
+
+    resolve = None
+    if device_id:
+        devices = set(device_id)
+    else:
+        if unitId is not None:
+            sql, params = LIVE_UNIT_DEVICES_SQL, (unitId,)
+        else:
+            user = getattr(request.state, "user", None)
+            if not user or not user.get("organisation_id"):
+                raise HTTPException(status_code=401, detail="Unauthenticated or organisation not set")
+            sql, params = ORG_DEVICES_SQL, (user["organisation_id"],)
+        resolve = lambda: _device_ids(sql, params)
+        try:
+            devices = await resolve()
+        except Exception as e:
+            log.error("live scope lookup failed", extra={"error": repr(e)})
+            raise HTTPException(status_code=500, detail=str(e))
+
+    if live.full():
+        raise HTTPException(status_code=503, detail="too many live subscribers", headers={"Retry-After": "5"})
+    return StreamingResponse(
+        live.events(devices, buffer, policy, resolve),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/live/stats")
+def get_live_stats():
+    return live.stats()
+
+def _device_row(row):
+    return {
+        "timestamp": row[0].isoformat() if isinstance(row[0], datetime) else row[0],
+        "volume_ml": row[1]
+    }
+
+# One prepared statement per combination of optional filters
+def _range_suffix(start, end, after=None):
+    return ("_start" if start else "") + ("_end" if end else "") + ("_after" if after else "")
+
+# Optional start/end filters shared by the single-device read routes
+def _time_filter(query, params, start, end, column="timestamp"):
+    if start:
+        query += f" AND {column} >= %s"
+        params.append(start)
+    if end:
+        query += f" AND {column} <= %s"
+        params.append(end)
+    return query, params
+
+# Readings for one device, newest first. The query builders are shared with
+# explain_check.py so the plan check runs the SQL the routes send.
+DEVICE_DATA_SQL = "SELECT timestamp, volume_ml FROM device_data WHERE device_id = %s"
+DEVICE_DATA_PAGE_SQL = "SELECT timestamp, volume_ml, id FROM device_data WHERE device_id = %s"
+
+def _device_data_query(device_id, start, end):
+    query, params = _time_filter(DEVICE_DATA_SQL, [device_id], start, end)
+    return query + " ORDER BY timestamp DESC", params
+
+# `after` is a decoded (timestamp, id) keyset position
+def _device_data_page_query(device_id, start, end, page_size, after=None):
+    query, params = _time_filter(DEVICE_DATA_PAGE_SQL, [device_id], start, end)
+    if after:
+        query += " AND (timestamp, id) < (%s, %s)"
+        params.extend(after)
+    return query + " ORDER BY timestamp DESC, id DESC LIMIT %s", params + [page_size + 1]
+
+async def _device_data_page(device_id, start, end, page_size, after):
+    query, params = _device_data_page_query(device_id, start, end, page_size, after and decode_cursor(after))
+    stmt = statements.register("device_data_page" + _range_suffix(start, end, after), query)
+
+    async with adb.connection() as conn:
+        cursor = conn.cursor()
+        await statements.execute(cursor, stmt, tuple(params))
+        rows = await cursor.fetchall()
+        await cursor.close()
+
+    rows, next_token = page_of(rows, page_size)
+    return {"data": [_device_row(row) for row in rows], "next": next_token}
 
 # Get data for a specific device
+# ?stream=ndjson|json reads through a server-side cursor and streams the rows.
+# ?page_size=N returns {"data": [...], "next": token}; pass the token back as
+# ?after= to continue (keyset on (timestamp, id), newest first).
+# ?max_points=N reduces the series server-side (LTTB, or per-bucket min/max).
 @app.get("/data/{device_id}")
-def get_device_data(device_id: str, start: str = None, end: str = None):
+@cancel_on_disconnect
+async def get_device_data(
+    request: Request,
+    device_id: str,
+    start: str = None,
+    end: str = None,
+    stream: Optional[str] = None,
+    page_size: Optional[int] = Query(None, ge=1, le=PAGE_SIZE_MAX),
+    after: Optional[str] = None,
+    max_points: Optional[int] = Query(None, ge=3),
+    downsample: str = "lttb"
+):
+    if downsample not in DOWNSAMPLE_METHODS:
+        raise HTTPException(status_code=400, detail=f"downsample must be one of {', '.join(DOWNSAMPLE_METHODS)}")
+    if page_size and max_points:
+        raise HTTPException(status_code=400, detail="page_size and max_points can't be combined")
+    if page_size:
+        return await _device_data_page(device_id, start, end, page_size, after)
+
+    query, params = _device_data_query(device_id, start, end)
+
+    if stream and not max_points:
+        return await stream_rows(adb, query, tuple(params), _device_row, stream, empty_detail="No data found")
+
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        query = "SELECT timestamp, volume_ml FROM device_data WHERE device_id = %s"
-        params = [device_id]
-        if start:
-            query += " AND timestamp >= %s"
-            params.append(start)
-        if end:
-            query += " AND timestamp <= %s"
-            params.append(end)
-        query += " ORDER BY timestamp DESC"
-        cursor.execute(query, tuple(params))
-        rows = cursor.fetchall()
-        cursor.close()
-        conn.close()
+        stmt = statements.register("device_data" + _range_suffix(start, end), query)
+        async with adb.connection() as conn:
+            cursor = conn.cursor()
+            await statements.execute(cursor, stmt, tuple(params))
+            rows = await cursor.fetchall()
+            await cursor.close()
 
         if not rows:
             raise HTTPException(status_code=404, detail="No data found")
 
-        return JSONResponse(content=[
-            {
-        "timestamp": row[0].isoformat() if isinstance(row[0], datetime) else row[0],
-        "volume_ml": row[1]
-    } for row in rows
-        ])
+        if max_points and len(rows) > max_points:
+            # Rows are newest first; reduce oldest-first and flip back
+            rows.reverse()
+            keep = await run_in_threadpool(downsample_rows, [r[0] for r in rows], [r[1] for r in rows], max_points, downsample)
+            rows = [rows[i] for i in keep[::-1]]
+
+        return JSONResponse(content=[_device_row(row) for row in rows])
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 # Get list of devices
 @app.get("/admindevices")
-def get_devices():
+def get_devices(request: Request):
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT device_id, name, organisation_id FROM devices")
-        rows = cursor.fetchall()
-        cursor.close()
-        conn.close()
+        cached = response_cache.probe(request, "admindevices", ("devices",))
+        if cached.response:
+            return cached.response
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT device_id, name, organisation_id FROM devices")
+            rows = cursor.fetchall()
+            cursor.close()
 
         if not rows:
             raise HTTPException(status_code=404, detail="No devices found")
 
-        return [{"device_id": row[0], "name": row[1], "organisation_id": row[2]} for row in rows]
+        return cached.store([{"device_id": row[0], "name": row[1], "organisation_id": row[2]} for row in rows])
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+ORG_DEVICE_LIST_SQL = "SELECT device_id, name, organisation_id FROM devices WHERE organisation_id = %s"
+
 @app.get("/devices")
-def get_devices(request: Request):
+async def get_devices(request: Request):
     try:
         user = getattr(request.state, "user", None)
-        print("🔍 Device route user:", user)  # Add this
         if not user or not user.get("organisation_id"):
             raise HTTPException(status_code=401, detail="Unauthenticated or organisation not set")
 
         org_id = user["organisation_id"]
 
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT device_id, name, organisation_id FROM devices WHERE organisation_id = %s", (org_id,))
-        rows = cursor.fetchall()
-        cursor.close()
-        conn.close()
+        async with adb.connection() as conn:
+            cursor = conn.cursor()
+            await cursor.execute(ORG_DEVICE_LIST_SQL, (org_id,))
+            rows = await cursor.fetchall()
+            await cursor.close()
 
         if not rows:
             raise HTTPException(status_code=404, detail="No devices found")
 
         return [{"device_id": row[0], "name": row[1], "organisation_id": row[2]} for row in rows]
     except Exception as e:
-        print("Device route error:", e)
+        log.error("device route failed", extra={"error": repr(e)})
+        raise HTTPException(status_code=500, detail=str(e))
+
+ORG_DEVICES_SQL = "SELECT device_id FROM devices WHERE organisation_id = %s"
+
+DEVICE_SUMMARY_SQL = """
+    SELECT d.device_id, d.name, COALESCE(t.total, 0), COALESCE(t.readings, 0), last.timestamp, last.volume_ml
+    FROM devices d
+    LEFT JOIN ({totals}) t ON t.device_id = d.device_id
+    LEFT JOIN LATERAL (
+        SELECT dd.timestamp, dd.volume_ml
+        FROM device_data dd
+        WHERE dd.device_id = d.device_id{window}
+        ORDER BY dd.timestamp DESC
+        LIMIT 1
+    ) last ON TRUE
+    WHERE d.organisation_id = %s
+    ORDER BY d.device_id
+"""
+
+# Lifetime figures straight from the running totals
+DEVICE_STATS_SUMMARY_SQL = """
+    SELECT d.device_id, d.name, COALESCE(s.total_ml, 0), COALESCE(s.readings, 0), s.last_ts, s.last_volume_ml
+    FROM devices d
+    LEFT JOIN device_stats s ON s.device_id = d.device_id
+    WHERE d.organisation_id = %s
+    ORDER BY d.device_id
+"""
+
+# Unit totals follow attachment windows, which do not line up with rollup
+# buckets, so they are grouped from device_data.
+UNIT_SUMMARY_SQL = """
+    WITH spans AS (
+        SELECT ud.unit_id, d.device_id, ud.attached_at, COALESCE(ud.detached_at, 'infinity') AS detached_at
+        FROM units u
+        JOIN unit_devices ud ON ud.unit_id = u.id
+        JOIN devices d ON d.id = ud.device_id
+        WHERE u.organisation_id = %(org)s
+    ),
+    totals AS (
+        SELECT s.unit_id, SUM(dd.volume_ml)::bigint AS total, COUNT(*) AS readings
+        FROM spans s
+        JOIN device_data dd
+          ON dd.device_id = s.device_id
+         AND dd.timestamp >= s.attached_at AND dd.timestamp < s.detached_at{window}
+        GROUP BY s.unit_id
+    )
+    SELECT u.id, u.name, COALESCE(t.total, 0), COALESCE(t.readings, 0), last.timestamp, last.volume_ml
+    FROM units u
+    LEFT JOIN totals t ON t.unit_id = u.id
+    LEFT JOIN LATERAL (
+        SELECT dd.timestamp, dd.volume_ml
+        FROM spans s
+        JOIN device_data dd
+          ON dd.device_id = s.device_id
+         AND dd.timestamp >= s.attached_at AND dd.timestamp < s.detached_at{window}
+        WHERE s.unit_id = u.id
+        ORDER BY dd.timestamp DESC
+        LIMIT 1
+    ) last ON TRUE
+    WHERE u.organisation_id = %(org)s
+    ORDER BY u.name
+"""
+
+def _summary_row(key, row):
+    return {
+        key: row[0],
+        "name": row[1],
+        "total_volume_ml": row[2],
+        "readings": row[3],
+        "last_seen": row[4].isoformat() if row[4] else None,
+        "last_volume_ml": row[5],
+    }
+
+# Totals, counts and the latest reading for every device (or unit) in the
+# caller's organisation, in one round-trip instead of one /summary per device.
+@app.get("/devices/summary")
+@cancel_on_disconnect
+async def get_devices_summary(request: Request, start: Optional[str] = None, end: Optional[str] = None, by: str = "device"):
+    user = getattr(request.state, "user", None)
+    if not user or not user.get("organisation_id"):
+        raise HTTPException(status_code=401, detail="Unauthenticated or organisation not set")
+    if by not in ("device", "unit"):
+        raise HTTPException(status_code=400, detail="by must be 'device' or 'unit'")
+    org_id = user["organisation_id"]
+
+    try:
+        async with adb.connection() as conn:
+            cursor = conn.cursor()
+            if by == "unit":
+                window = ""
+                params = {"org": org_id, "start": start, "end": end}
+                if start:
+                    window += " AND dd.timestamp >= %(start)s"
+                if end:
+                    window += " AND dd.timestamp <= %(end)s"
+                await cursor.execute(UNIT_SUMMARY_SQL.format(window=window), params)
+                items = [_summary_row("unit_id", row) for row in await cursor.fetchall()]
+            elif not start and not end and await device_stats.ready(cursor):
+                await cursor.execute(DEVICE_STATS_SUMMARY_SQL, (org_id,))
+                items = [_summary_row("device_id", row) for row in await cursor.fetchall()]
+            else:
+                rollup_window = await _rollup_window(cursor, start, end)
+                lo, hi = rollup_window or (start or None, end or None)
+                totals, params = totals_query(ORG_DEVICES_SQL, [org_id], lo, hi, use_rollups=bool(rollup_window))
+                window = ""
+                if lo is not None:
+                    window += " AND dd.timestamp >= %s"
+                    params.append(lo)
+                if hi is not None:
+                    window += " AND dd.timestamp <= %s"
+                    params.append(hi)
+                params.append(org_id)
+                await cursor.execute(DEVICE_SUMMARY_SQL.format(totals=totals, window=window), params)
+                items = [_summary_row("device_id", row) for row in await cursor.fetchall()]
+            await cursor.close()
+    except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+    return {"by": by, "start": start, "end": end, "items": items}
+
 
 # Dashboard summary model
 class DeviceSummary(BaseModel):
@@ -153,22 +668,64 @@ class DeviceSummary(BaseModel):
     name: str
     total_volume: int
 
+# Read routes answer from the hourly/daily rollups once they are backfilled
+# (see rollups.py) and only scan device_data for partial-hour edges.
+async def _rollup_window(cursor, start, end):
+    try:
+        window = (parse_ts(start or None), parse_ts(end or None))
+    except ValueError:
+        return None
+    return window if await rollups.ready(cursor) else None
+
+OWNED_BY_SQL = """
+    SELECT 1 FROM devices d JOIN users u ON u.id = d.owner_id
+    WHERE d.device_id = %s AND u.email = %s
+"""
+
+async def _owned_by(cursor, device_id, user_email):
+    await cursor.execute(OWNED_BY_SQL, (device_id, user_email))
+    return await cursor.fetchone() is not None
+
+# Dashboard totals, best source first: running totals, daily rollups, raw rows
+DASHBOARD_STATS_SQL = """
+    SELECT d.device_id, d.name, COALESCE(s.total_ml, 0) AS total_volume
+    FROM devices d
+    LEFT JOIN device_stats s ON d.device_id = s.device_id
+    WHERE d.owner_id = %s
+"""
+
+DASHBOARD_ROLLUPS_SQL = """
+    SELECT d.device_id, d.name, COALESCE(SUM(r.total_ml), 0)::bigint AS total_volume
+    FROM devices d
+    LEFT JOIN device_rollups_daily r ON d.device_id = r.device_id
+    WHERE d.owner_id = %s
+    GROUP BY d.device_id, d.name
+"""
+
+DASHBOARD_RAW_SQL = """
+    SELECT d.device_id, d.name, COALESCE(SUM(dd.volume_ml), 0) AS total_volume
+    FROM devices d
+    LEFT JOIN device_data dd ON d.device_id = dd.device_id
+    WHERE d.owner_id = %s
+    GROUP BY d.device_id, d.name
+"""
+
 # Dashboard endpoint per user
 @app.get("/dashboard/{user_id}")
-def get_dashboard(user_id: int):
+@cancel_on_disconnect
+async def get_dashboard(request: Request, user_id: int):
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT d.device_id, d.name, COALESCE(SUM(dd.volume_ml), 0) AS total_volume
-            FROM devices d
-            LEFT JOIN device_data dd ON d.device_id = dd.device_id
-            WHERE d.owner_id = %s
-            GROUP BY d.device_id, d.name
-        """, (user_id,))
-        rows = cursor.fetchall()
-        cursor.close()
-        conn.close()
+        async with adb.connection() as conn:
+            cursor = conn.cursor()
+            # Running totals: one row per device however long the history
+            if await device_stats.ready(cursor):
+                await cursor.execute(DASHBOARD_STATS_SQL, (user_id,))
+            elif await rollups.ready(cursor):
+                await cursor.execute(DASHBOARD_ROLLUPS_SQL, (user_id,))
+            else:
+                await cursor.execute(DASHBOARD_RAW_SQL, (user_id,))
+            rows = await cursor.fetchall()
+            await cursor.close()
 
         return [
             {"device_id": row[0], "name": row[1], "total_volume": row[2]}
@@ -177,27 +734,56 @@ def get_dashboard(user_id: int):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/data/{device_id}/summary")
-def get_volume_summary(device_id: str, start: Optional[str] = Query(None), end: Optional[str] = Query(None)):
-    try:
-        conn = get_connection()
-        cursor = conn.cursor()
+# Raw fallbacks of the summary and histogram routes, used until the rollups
+# are backfilled
+VOLUME_SUMMARY_SQL = "SELECT SUM(volume_ml) FROM device_data WHERE device_id = %s"
 
-        sql = "SELECT SUM(volume_ml) FROM device_data WHERE device_id = %s"
-        params = [device_id]
+VOLUME_HISTOGRAM_SQL = """
+    SELECT date_trunc(%s, timestamp) AS period, SUM(volume_ml)
+    FROM device_data
+    WHERE device_id = %s AND timestamp BETWEEN %s AND %s
+    GROUP BY period
+    ORDER BY period
+"""
 
-        if start:
-            sql += " AND timestamp >= %s"
-            params.append(start)
-        if end:
-            sql += " AND timestamp <= %s"
-            params.append(end)
+SUMMARY_SQL = """
+    SELECT SUM(dd.volume_ml) as total_volume
+    FROM device_data dd
+    WHERE dd.device_id = %s
+"""
 
-        cursor.execute(sql, tuple(params))
-        total_volume = cursor.fetchone()[0] or 0
+DAILY_HISTOGRAM_SQL = """
+    SELECT DATE_TRUNC('day', dd.timestamp) as day, SUM(dd.volume_ml)
+    FROM device_data dd
+    WHERE dd.device_id = %s
+"""
 
-        cursor.close()
-        conn.close()
+def _volume_summary_query(device_id, start, end):
+    return _time_filter(VOLUME_SUMMARY_SQL, [device_id], start, end)
+
+def _summary_query(device_id, start, end):
+    return _time_filter(SUMMARY_SQL, [device_id], start, end, "dd.timestamp")
+
+def _daily_histogram_query(device_id, start, end):
+    query, params = _time_filter(DAILY_HISTOGRAM_SQL, [device_id], start, end, "dd.timestamp")
+    return query + " GROUP BY day ORDER BY day ASC", params
+
+@app.get("/data/{device_id}/summary")
+@cancel_on_disconnect
+async def get_volume_summary(request: Request, device_id: str, start: Optional[str] = Query(None), end: Optional[str] = Query(None)):
+    try:
+        async with adb.connection() as conn:
+            cursor = conn.cursor()
+
+            window = await _rollup_window(cursor, start, end)
+            if window:
+                total_volume = await rollups.window_total(cursor, device_id, *window)
+            else:
+                sql, params = _volume_summary_query(device_id, start, end)
+                await cursor.execute(sql, tuple(params))
+                total_volume = (await cursor.fetchone())[0] or 0
+
+            await cursor.close()
 
         return {"total_volume": total_volume}
     except Exception as e:
@@ -205,27 +791,24 @@ def get_volume_summary(device_id: str, start: Optional[str] = Query(None), end:
 
 
 @app.get("/data/{device_id}/histogram")
-def get_volume_histogram(device_id: str, start: str, end: str, interval: str = "day"):
+@cancel_on_disconnect
+async def get_volume_histogram(request: Request, device_id: str, start: str, end: str, interval: str = "day"):
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-
-        if interval == "hour":
-            date_trunc = "hour"
-        else:
-            date_trunc = "day"
+        async with adb.connection() as conn:
+            cursor = conn.cursor()
 
-        cursor.execute(f"""
-            SELECT date_trunc(%s, timestamp) AS period, SUM(volume_ml)
-            FROM device_data
-            WHERE device_id = %s AND timestamp BETWEEN %s AND %s
-            GROUP BY period
-            ORDER BY period
-        """, (date_trunc, device_id, start, end))
+            if interval == "hour":
+                date_trunc = "hour"
+            else:
+                date_trunc = "day"
 
-        rows = cursor.fetchall()
-        cursor.close()
-        conn.close()
+            window = await _rollup_window(cursor, start, end)
+            if window:
+                rows = await rollups.histogram(cursor, device_id, *window, interval=date_trunc)
+            else:
+                await cursor.execute(VOLUME_HISTOGRAM_SQL, (date_trunc, device_id, start, end))
+                rows = await cursor.fetchall()
+            await cursor.close()
 
         return [
             {"timestamp": row[0].isoformat(), "total_volume": row[1]}
@@ -236,126 +819,196 @@ def get_volume_histogram(device_id: str, start: str, end: str, interval: str = "
 
 
 @app.get("/summary/{device_id}")
-def get_summary(device_id: str, start: str = None, end: str = None, user_email: str = None):
+@cancel_on_disconnect
+async def get_summary(request: Request, device_id: str, start: str = None, end: str = None, user_email: str = None):
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
+        async with adb.connection() as conn:
+            cursor = conn.cursor()
 
-        query = """
-            SELECT SUM(dd.volume_ml) as total_volume
-            FROM device_data dd
-            JOIN device d ON dd.device_id = d.id
-            JOIN "user" u ON d.user_id = u.id
-            WHERE dd.device_id = %s
-        """
-        params = [device_id]
+            # Someone else's device reads as empty, on both paths
+            if user_email and not await _owned_by(cursor, device_id, user_email):
+                await cursor.close()
+                return {"total_volume_ml": 0}
 
-        if user_email:
-            query += " AND u.email = %s"
-            params.append(user_email)
-        if start:
-            query += " AND dd.timestamp >= %s"
-            params.append(start)
-        if end:
-            query += " AND dd.timestamp <= %s"
-            params.append(end)
-
-        cursor.execute(query, tuple(params))
-        result = cursor.fetchone()
-        cursor.close()
-        conn.close()
+            window = await _rollup_window(cursor, start, end)
+            if window:
+                total = await rollups.window_total(cursor, device_id, *window)
+                await cursor.close()
+                return {"total_volume_ml": total}
+
+            query, params = _summary_query(device_id, start, end)
+            await cursor.execute(query, tuple(params))
+            result = await cursor.fetchone()
+            await cursor.close()
 
         return {"total_volume_ml": result[0] or 0}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/histogram/{device_id}")
-def get_histogram(device_id: str, start: str = None, end: str = None, user_email: str = None):
+@cancel_on_disconnect
+async def get_histogram(request: Request, device_id: str, start: str = None, end: str = None, user_email: str = None):
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
+        async with adb.connection() as conn:
+            cursor = conn.cursor()
 
-        query = """
-            SELECT DATE_TRUNC('day', dd.timestamp) as day, SUM(dd.volume_ml)
-            FROM device_data dd
-            JOIN device d ON dd.device_id = d.id
-            JOIN "user" u ON d.user_id = u.id
-            WHERE dd.device_id = %s
-        """
-        params = [device_id]
+            # Someone else's device reads as empty, on both paths
+            if user_email and not await _owned_by(cursor, device_id, user_email):
+                await cursor.close()
+                return []
 
-        if user_email:
-            query += " AND u.email = %s"
-            params.append(user_email)
-        if start:
-            query += " AND dd.timestamp >= %s"
-            params.append(start)
-        if end:
-            query += " AND dd.timestamp <= %s"
-            params.append(end)
-
-        query += " GROUP BY day ORDER BY day ASC"
-
-        cursor.execute(query, tuple(params))
-        rows = cursor.fetchall()
-        cursor.close()
-        conn.close()
+            window = await _rollup_window(cursor, start, end)
+            if window:
+                rows = await rollups.histogram(cursor, device_id, *window, interval="day")
+                await cursor.close()
+                return [{"day": row[0].isoformat(), "total_volume_ml": row[1]} for row in rows]
+
+            query, params = _daily_histogram_query(device_id, start, end)
+            await cursor.execute(query, tuple(params))
+            rows = await cursor.fetchall()
+            await cursor.close()
 
         return [{"day": row[0].isoformat(), "total_volume_ml": row[1]} for row in rows]
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Gap-filled series for many devices in one query. Scope is a list of
+# device_id values, a unit (readings clipped to attachment windows), or by
+# default the caller's organisation.
+@app.get("/histogram")
+@cancel_on_disconnect
+async def get_multi_histogram(
+    request: Request,
+    start: str,
+    end: str,
+    bucket: str = "hour",
+    tz: str = "UTC",
+    device_id: list[str] | None = Query(None),
+    unitId: int | None = None,
+):
+    try:
+        check_window(start, end, bucket)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if device_id and unitId is not None:
+        raise HTTPException(status_code=400, detail="Pass device_id or unitId, not both")
+    if device_id:
+        scope, params = "devices", {"devices": device_id}
+    elif unitId is not None:
+        scope, params = "unit", {"unit": unitId}
+    else:
+        user = getattr(request.state, "user", None)
+        if not user or not user.get("organisation_id"):
+            raise HTTPException(status_code=401, detail="Unauthenticated or organisation not set")
+        scope, params = "org", {"org": user["organisation_id"]}
+
+    try:
+        async with adb.connection() as conn:
+            series = await histogram_series(conn, scope, params, start, end, bucket, tz)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    return {"bucket": bucket, "timezone": tz, "start": start, "end": end, "series": series}
 
 class UserAuth(BaseModel):
     email: str
     password: str
 
-@app.post("/register")
-def register_user(user: UserAuth):
-    try:
-        conn = get_connection()
+# bcrypt runs in the password_hasher process pool (see passwords.py); these
+# handlers are async so a burst of logins never holds request threads.
+def _user_exists(email):
+    with db_pool.connection() as conn:
         cursor = conn.cursor()
+        cursor.execute("SELECT id FROM users WHERE email = %s", (email,))
+        row = cursor.fetchone()
+        cursor.close()
+    return row is not None
 
-        # Check if user already exists
-        cursor.execute("SELECT id FROM users WHERE email = %s", (user.email,))
-        if cursor.fetchone():
-            raise HTTPException(status_code=400, detail="User already exists")
+# User writes NOTIFY users_changed in their transaction, so every worker
+# (not just the one that served the write) drops the cached principal and
+# the cached /users responses once the change commits
+USERS_CHANNEL = "users_changed"
+
+def _notify_user_changed(cursor, user_id=None, email=None):
+    cursor.execute("SELECT pg_notify(%s, %s)", (USERS_CHANNEL, dumps({"id": user_id, "email": email})))
+
+def _forget_user(user_id=None, email=None):
+    response_cache.bump("users")
+    if user_id is not None:
+        user_cache.invalidate_user(user_id)
+    if email:
+        user_cache.invalidate_email(email)
+
+def _on_user_changed(payload):
+    change = json.loads(payload)
+    _forget_user(change.get("id"), change.get("email"))
 
-        hashed_password = pwd_context.hash(user.password)
-        cursor.execute("INSERT INTO users (email, password_hash) VALUES (%s, %s)", (user.email, hashed_password))
+def _on_users_resync():
+    # Changes made while the listener was down were missed
+    user_cache.clear()
+    response_cache.bump("users")
+
+listener.subscribe(USERS_CHANNEL, _on_user_changed, _on_users_resync)
+
+def _insert_user(email, hashed_password):
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO users (email, password_hash) VALUES (%s, %s)", (email, hashed_password))
+        _notify_user_changed(cursor, email=email)
         conn.commit()
         cursor.close()
-        conn.close()
+    _forget_user(email=email)
+
+@app.post("/register")
+async def register_user(user: UserAuth):
+    try:
+        # Check if user already exists
+        if await run_in_threadpool(_user_exists, user.email):
+            raise HTTPException(status_code=400, detail="User already exists")
+
+        hashed_password = await password_hasher.hash(user.password)
+        await run_in_threadpool(_insert_user, user.email, hashed_password)
         return {"message": "User registered successfully"}
+    except HTTPException:
+        raise
+    except PasswordBusy as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 from fastapi.responses import JSONResponse
 
-@app.post("/login")
-def login_user(user: UserAuth):
-    try:
-        conn = get_connection()
+# One round-trip for the user, organisation and role names
+LOGIN_SQL = """
+    SELECT u.id, u.password_hash, u.name, o.name, r.name
+    FROM users u
+    LEFT JOIN organisations o ON o.id = u.organisation_id
+    LEFT JOIN roles r ON r.id = u.roles_id
+    WHERE u.email = %s
+"""
+
+def _load_login(email):
+    with db_pool.connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT id, password_hash, organisation_id, roles_id, name FROM users WHERE email = %s", (user.email,))
+        cursor.execute(LOGIN_SQL, (email,))
         row = cursor.fetchone()
+        cursor.close()
+    return row
 
-        if not row or not pwd_context.verify(user.password, row[1]):
-            raise HTTPException(status_code=401, detail="Invalid credentials")
-
-        user_id, _, org_id, role_id, name = row
-
-        cursor.execute("SELECT name FROM organisations WHERE id = %s", (org_id,))
-        org_row = cursor.fetchone()
-        org_name = org_row[0] if org_row else "Unassigned"
+@app.post("/login")
+async def login_user(user: UserAuth):
+    try:
+        row = await run_in_threadpool(_load_login, user.email)
 
-        cursor.execute("SELECT name FROM roles WHERE id = %s", (role_id,))
-        role_row = cursor.fetchone()
-        role_name = role_row[0] if role_row else "user"
+        if not row or not await password_hasher.verify(user.password, row[1]):
+            raise HTTPException(status_code=401, detail="Invalid credentials")
 
-        cursor.close()
-        conn.close()
+        user_id, _, name, org_name, role_name = row
+        org_name = org_name or "Unassigned"
+        role_name = role_name or "user"
 
         # 👉 Set cookies
         response = JSONResponse(content={
@@ -369,9 +1022,17 @@ def login_user(user: UserAuth):
         response.set_cookie(key="role", value=role_name, httponly=True, secure=True, samesite="None")
         return response
 
+    except HTTPException:
+        raise
+    except PasswordBusy as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/auth/password/stats")
+def get_password_stats():
+    return password_hasher.stats()
+
 
 
 # @app.post("/login")
@@ -426,92 +1087,211 @@ def login_user(user: UserAuth):
 from fastapi import Request
 from starlette.middleware.base import BaseHTTPMiddleware
 
-@app.middleware("http")
-async def load_user(request: Request, call_next):
-    user_email = request.cookies.get("email")
-    print("🍪 Email from cookie:", user_email)  # Debug line
+USER_BY_EMAIL = statements.register(
+    "user_by_email", "SELECT id, email, organisation_id, roles_id FROM users WHERE email = %s"
+)
+
+async def _fetch_user(user_email):
+    async with adb.connection() as conn:
+        cursor = conn.cursor()
+        await statements.execute(cursor, USER_BY_EMAIL, (user_email,))
+        row = await cursor.fetchone()
+        await cursor.close()
+
+    if not row:
+        return None
+    return {
+        "id": row[0],
+        "email": row[1],
+        "organisation_id": row[2],
+        "roles_id": row[3]
+    }
+
+# Resolve the cookie's user from the TTL cache; misses query the async pool so
+# the event loop never blocks. Time spent here is reported in the
+# Server-Timing header and at /auth/stats.
+#
+# Plain ASGI rather than @app.middleware("http"): BaseHTTPMiddleware wraps
+# receive() so routes never see the client disconnect (which
+# cancel_on_disconnect relies on), and it costs an extra task per request.
+class LoadUserMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        db_time = start_db_timer()
+        request = Request(scope)
+        user_email = request.cookies.get("email")
+        user = None
+
+        if user_email:
+            hit, user = user_cache.get(user_email)
+            if not hit:
+                try:
+                    user = await _fetch_user(user_email)
+                    user_cache.put(user_email, user)
+                except Exception as e:
+                    log.error("user lookup failed", extra={"error": repr(e)})
+                    user = None
+            elapsed = time.perf_counter() - started
+            user_cache.record(elapsed, hit)
+        else:
+            elapsed = time.perf_counter() - started
+        request.state.user = user
+
+        responded = False
+
+        async def send_with_timing(message):
+            nonlocal responded
+            if message["type"] == "http.response.start":
+                responded = True
+                status = message["status"]
+                # db covers connections borrowed before the response starts;
+                # streamed bodies keep reading after the header is sent.
+                MutableHeaders(scope=message).append(
+                    "Server-Timing", f"auth;dur={elapsed * 1000:.3f}, db;dur={db_time[0] * 1000:.3f}"
+                )
+                _observe(scope, status, started, db_time)
+            await send(message)
 
-    if user_email:
         try:
-            conn = get_connection()
-            cursor = conn.cursor()
-            cursor.execute("SELECT id, email, organisation_id, roles_id FROM users WHERE email = %s", (user_email,))
-            row = cursor.fetchone()
-            cursor.close()
-            conn.close()
-
-            if row:
-                user = {
-                    "id": row[0],
-                    "email": row[1],
-                    "organisation_id": row[2],
-                    "roles_id": row[3]
-                }
-                print("✅ Loaded user:", user)  # Debug
-                request.state.user = user
-            else:
-                print("⚠️ No matching user found for email")
-                request.state.user = None
-        except Exception as e:
-            print("🔥 Middleware DB error:", e)
-            request.state.user = None
-    else:
-        print("⚠️ No email cookie found")
-        request.state.user = None
+            await self.app(scope, receive, send_with_timing)
+        except BaseException:
+            # ServerErrorMiddleware answers 500 outside this middleware
+            if not responded:
+                _observe(scope, 500, started, db_time)
+            raise
+
+def _observe(scope, status, started, db_time):
+    # Route templates keep the label set small; unmatched paths share one
+    route = scope.get("route")
+    route = route.path if route is not None else "unmatched"
+    duration = time.perf_counter() - started
+    HTTP_DURATION.observe(scope["method"], route, str(status), value=duration)
+    log.debug("request", extra={
+        "method": scope["method"], "route": route, "status": status,
+        "ms": round(duration * 1000, 3), "db_ms": round(db_time[0] * 1000, 3),
+    })
+
+app.add_middleware(LoadUserMiddleware)
+
+@app.get("/cache/stats")
+def get_cache_stats():
+    return response_cache.stats()
+
+@app.get("/auth/stats")
+def get_auth_stats():
+    return user_cache.stats()
+
+@app.get("/unit/timeline/stats")
+def get_unit_timeline_stats():
+    return unit_timeline.stats()
+
+def _pool_connections():
+    sync, async_ = db_pool.stats(), adb.stats()
+    rows = [(("sync", state), sync[state]) for state in ("size", "idle", "in_use", "waiting")]
+    if async_["open"]:
+        rows += [(("async", state), async_[state]) for state in ("size", "idle", "waiting")]
+    return rows
+
+metrics.gauge("db_pool_connections", "Pooled connections by pool and state", ("pool", "state"), collect=_pool_connections)
+metrics.gauge(
+    "ingest_queue_depth", "Readings waiting in the write-behind ingest queue",
+    collect=lambda: [((), ingest_buffer.stats()["queue_depth"])] if ingest_buffer else [],
+)
 
-    response = await call_next(request)
-    return response
+# Prometheus scrape target (text exposition format)
+@app.get("/metrics")
+def get_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
 
 
     
+# Reference-data GETs below are served from response_cache with ETags; the
+# write routes bump the resources they touch.
+
+# Organisation writes NOTIFY organisations_changed in their transaction, so
+# every worker (not just the one that served the write) drops its cached
+# /organisations responses once the change commits
+ORGS_CHANNEL = "organisations_changed"
+
+def _notify_org_changed(cursor, org_id=None):
+    cursor.execute("SELECT pg_notify(%s, %s)", (ORGS_CHANNEL, dumps({"id": org_id})))
+
+def _forget_org(org_id=None):
+    if org_id is None:
+        response_cache.bump("organisations")
+    else:
+        response_cache.bump("organisations", f"organisations/{org_id}")
+
+def _on_org_changed(payload):
+    _forget_org(json.loads(payload).get("id"))
+
+def _on_orgs_resync():
+    # Changes made while the listener was down were missed; every cached
+    # organisation response depends on "organisations"
+    response_cache.bump("organisations")
+
+listener.subscribe(ORGS_CHANNEL, _on_org_changed, _on_orgs_resync)
+
 @app.get("/organisations")
-def get_organisations():
+def get_organisations(request: Request):
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name FROM organisations")
-        rows = cursor.fetchall()
-        cursor.close()
-        conn.close()
+        cached = response_cache.probe(request, "organisations", ("organisations",))
+        if cached.response:
+            return cached.response
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, name FROM organisations")
+            rows = cursor.fetchall()
+            cursor.close()
 
         organisations = [{"id": row[0], "name": row[1]} for row in rows]
-        return organisations
+        return cached.store(organisations)
 
     except Exception as e: 
         raise HTTPException(status_code=500, detail=str(e))
     
 @app.get("/organisations/{org_id}")
-def get_organisation(org_id: int):
+def get_organisation(org_id: int, request: Request):
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name FROM organisations WHERE id = %s", (org_id,))
-        row = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        cached = response_cache.probe(request, f"organisations/{org_id}", ("organisations", f"organisations/{org_id}"))
+        if cached.response:
+            return cached.response
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, name FROM organisations WHERE id = %s", (org_id,))
+            row = cursor.fetchone()
+            cursor.close()
 
         if not row:
             raise HTTPException(status_code=404, detail="Organisation not found")
-        return {"id": row[0], "name": row[1]}
+        return cached.store({"id": row[0], "name": row[1]})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
 @app.put("/organisations/{org_id}")
 def update_organisation(org_id: int, payload: dict = Body(...)):
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        # Only update known valid fields
-        allowed_keys = {"name"}
-        for key, value in payload.items():
-            if key in allowed_keys:
-                query = f"UPDATE organisations SET {key} = %s WHERE id = %s"
-                cursor.execute(query, (value, org_id))
-        conn.commit()
-        cursor.execute("SELECT id, name FROM organisations WHERE id = %s", (org_id,))
-        row = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            # Only update known valid fields
+            allowed_keys = {"name"}
+            for key, value in payload.items():
+                if key in allowed_keys:
+                    query = f"UPDATE organisations SET {key} = %s WHERE id = %s"
+                    cursor.execute(query, (value, org_id))
+            _notify_org_changed(cursor, org_id)
+            conn.commit()
+            _forget_org(org_id)
+            cursor.execute("SELECT id, name FROM organisations WHERE id = %s", (org_id,))
+            row = cursor.fetchone()
+            cursor.close()
         if not row:
             raise HTTPException(status_code=404, detail="Organisation not found")   
         return {"id": row[0], "name": row[1]}
@@ -529,13 +1309,17 @@ class OrgIn(BaseModel):
 @app.post("/organisations")
 def create_org(payload: OrgIn):
     try:
-        conn = get_connection(); cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO organisations (name, notes) VALUES (%s, %s) RETURNING id, name, notes",
-            (payload.name, payload.notes)
-        )
-        row = cur.fetchone(); conn.commit()
-        cur.close(); conn.close()
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "INSERT INTO organisations (name, notes) VALUES (%s, %s) RETURNING id, name, notes",
+                (payload.name, payload.notes)
+            )
+            row = cur.fetchone()
+            _notify_org_changed(cur)
+            conn.commit()
+            cur.close()
+        _forget_org()
         return {"id": row[0], "name": row[1], "notes": row[2]}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -545,16 +1329,19 @@ def create_org(payload: OrgIn):
 @app.put("/organisations/{org_id}")
 def update_org(org_id: int, payload: OrgIn):
     try:
-        conn = get_connection(); cur = conn.cursor()
-        cur.execute(
-            "UPDATE organisations SET name = %s, notes = %s WHERE id = %s RETURNING id, name, notes",
-            (payload.name, payload.notes, org_id)
-        )
-        row = cur.fetchone()
-        if not row:
-            cur.close(); conn.close()
-            raise HTTPException(status_code=404, detail="Organisation not found")
-        conn.commit(); cur.close(); conn.close()
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "UPDATE organisations SET name = %s, notes = %s WHERE id = %s RETURNING id, name, notes",
+                (payload.name, payload.notes, org_id)
+            )
+            row = cur.fetchone()
+            if not row:
+                cur.close()
+                raise HTTPException(status_code=404, detail="Organisation not found")
+            _notify_org_changed(cur, org_id)
+            conn.commit(); cur.close()
+        _forget_org(org_id)
         return {"id": row[0], "name": row[1], "notes": row[2]}
     except HTTPException:
         raise
@@ -563,31 +1350,32 @@ def update_org(org_id: int, payload: OrgIn):
 
 
 @app.get("/users")
-def get_users():
+def get_users(request: Request):
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, email, organisation_id, roles_id, name FROM users")
-        rows = cursor.fetchall()
-        cursor.close()
-        conn.close()
+        cached = response_cache.probe(request, "users", ("users",))
+        if cached.response:
+            return cached.response
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, email, organisation_id, roles_id, name FROM users")
+            rows = cursor.fetchall()
+            cursor.close()
 
         if not rows:
             raise HTTPException(status_code=404, detail="No users found")
 
-        return [{"id": row[0], "email": row[1], "organisation_id": row[2], "roles_id": row[3], "name": row[4]} for row in rows]
+        return cached.store([{"id": row[0], "email": row[1], "organisation_id": row[2], "roles_id": row[3], "name": row[4]} for row in rows])
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
 @app.get("/users/{user_id}")
 def get_user(user_id: int):
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, email, organisation_id, roles_id, name FROM users WHERE id = %s", (user_id,))
-        row = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, email, organisation_id, roles_id, name FROM users WHERE id = %s", (user_id,))
+            row = cursor.fetchone()
+            cursor.close()
 
         if not row:
             raise HTTPException(status_code=404, detail="User not found")
@@ -599,28 +1387,29 @@ def get_user(user_id: int):
 @app.put("/users/{user_id}")
 def update_user(user_id: int, payload: dict = Body(...)):
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
 
-        # Only update known valid fields
-        allowed_keys = {"email", "organisation_id", "roles_id", "name"}
+            # Only update known valid fields
+            allowed_keys = {"email", "organisation_id", "roles_id", "name"}
 
-        for key, value in payload.items():
-            if key in allowed_keys:
-                query = f"UPDATE users SET {key} = %s WHERE id = %s"
-                cursor.execute(query, (value, user_id))
+            for key, value in payload.items():
+                if key in allowed_keys:
+                    query = f"UPDATE users SET {key} = %s WHERE id = %s"
+                    cursor.execute(query, (value, user_id))
 
-        conn.commit()
+            _notify_user_changed(cursor, user_id, payload.get("email"))
+            conn.commit()
+            _forget_user(user_id, payload.get("email"))
 
-        cursor.execute("SELECT id, email, organisation_id, roles_id, name FROM users WHERE id = %s", (user_id,))
-        row = cursor.fetchone()
+            cursor.execute("SELECT id, email, organisation_id, roles_id, name FROM users WHERE id = %s", (user_id,))
+            row = cursor.fetchone()
 
-        if not row:
-            raise HTTPException(status_code=404, detail="User not found")
+            if not row:
+                raise HTTPException(status_code=404, detail="User not found")
 
-        columns = [desc[0] for desc in cursor.description]
-        cursor.close()
-        conn.close()
+            columns = [desc[0] for desc in cursor.description]
+            cursor.close()
 
         return dict(zip(columns, row))
 
@@ -628,36 +1417,40 @@ def update_user(user_id: int, payload: dict = Body(...)):
         raise HTTPException(status_code=500, detail=str(e))
     
 @app.get("/roles")
-def get_roles():
+def get_roles(request: Request):
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name FROM roles")
-        rows = cursor.fetchall()
-        cursor.close()
-        conn.close()
+        cached = response_cache.probe(request, "roles", ("roles",))
+        if cached.response:
+            return cached.response
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, name FROM roles")
+            rows = cursor.fetchall()
+            cursor.close()
 
         if not rows:
             raise HTTPException(status_code=404, detail="No users found")
 
-        return [{"id": row[0], "name": row[1]} for row in rows]
+        return cached.store([{"id": row[0], "name": row[1]} for row in rows])
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
 @app.get("/roles/{role_id}")
-def get_role(role_id: int):
+def get_role(role_id: int, request: Request):
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name FROM roles WHERE id = %s", (role_id,))
-        row = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        cached = response_cache.probe(request, f"roles/{role_id}", ("roles",))
+        if cached.response:
+            return cached.response
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, name FROM roles WHERE id = %s", (role_id,))
+            row = cursor.fetchone()
+            cursor.close()
 
         if not row:
             raise HTTPException(status_code=404, detail="User not found")
 
-        return {"id": row[0], "name": row[1]}
+        return cached.store({"id": row[0], "name": row[1]})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
@@ -670,15 +1463,19 @@ def list_units(request: Request):
         raise HTTPException(status_code=401, detail="Unauthenticated or organisation not set")
 
     org_id = user["organisation_id"]
-    conn = get_connection(); cur = conn.cursor()
-    cur.execute("""
-        SELECT id, name, organisation_id, location, commissioned_at
-        FROM units
-        WHERE organisation_id = %s
-        ORDER BY name
-    """, (org_id,))
-    rows = cur.fetchall(); cur.close(); conn.close()
-    return [
+    cached = response_cache.probe(request, f"units?org={org_id}", ("units",))
+    if cached.response:
+        return cached.response
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT id, name, organisation_id, location, commissioned_at
+            FROM units
+            WHERE organisation_id = %s
+            ORDER BY name
+        """, (org_id,))
+        rows = cur.fetchall(); cur.close()
+    return cached.store([
         {
             "id": r[0],
             "name": r[1],
@@ -687,32 +1484,27 @@ def list_units(request: Request):
             "commissioned_at": r[4].isoformat() if r[4] else None,
         }
         for r in rows
-    ]
+    ])
 
 # --- Unit metadata + current device (external device_id) ---
+UNIT_STMT = statements.register("unit", """
+    SELECT
+      u.id, u.name, u.organisation_id, o.name AS organisation_name,
+      u.location, u.commissioned_at
+    FROM units u
+    LEFT JOIN organisations o ON o.id = u.organisation_id
+    WHERE u.id = %s
+""")
+
 @app.get("/unit")
-def get_unit(unitId: int = Query(..., description="units.id")):
-    conn = get_connection(); cur = conn.cursor()
-    cur.execute("""
-        SELECT
-          u.id, u.name, u.organisation_id, o.name AS organisation_name,
-          u.location, u.commissioned_at,
-          d.id AS device_pk, d.device_id AS current_device_id
-        FROM units u
-        LEFT JOIN organisations o ON o.id = u.organisation_id
-        LEFT JOIN LATERAL (
-          SELECT d.id, d.device_id
-          FROM unit_devices ud
-          JOIN devices d ON d.id = ud.device_id
-          WHERE ud.unit_id = u.id AND ud.active = TRUE
-          LIMIT 1
-        ) d ON TRUE
-        WHERE u.id = %s
-        LIMIT 1
-    """, (unitId,))
-    row = cur.fetchone(); cur.close(); conn.close()
+async def get_unit(unitId: int = Query(..., description="units.id")):
+    async with adb.connection() as conn:
+        cur = conn.cursor()
+        await statements.execute(cur, UNIT_STMT, (unitId,))
+        row = await cur.fetchone(); await cur.close()
     if not row:
         raise HTTPException(status_code=404, detail="Unit not found")
+    current = current_device(await unit_timeline.get(adb, unitId))
 
     return {
         "id": row[0],
@@ -721,7 +1513,7 @@ def get_unit(unitId: int = Query(..., description="units.id")):
         "organisation_name": row[3],
         "location": row[4],
         "commissioned_at": row[5].isoformat() if row[5] else None,
-        "current_device": ({"device_pk": row[6], "device_id": row[7]} if row[7] else None)
+        "current_device": ({"device_pk": current[0], "device_id": current[1]} if current else None)
     }
 
 # --- ALL historical data for a unit (across device swaps) ---
@@ -772,35 +1564,96 @@ def get_unit(unitId: int = Query(..., description="units.id")):
 #         "data": data
 #     }
 
+# Unit history reads go through the unit's cached attachment intervals
+# (unit_timeline.py): one range scan per attached device on
+# device_data (device_id, timestamp), merged in timestamp order, instead of
+# joining unit_devices -> devices -> device_data on every request.
+async def _unit_scans(unitId, from_, to, clip=True):
+    try:
+        start, end = parse_ts(from_), parse_ts(to)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="from/to must be ISO timestamps")
+    return ranges(await unit_timeline.get(adb, unitId), start, end, clip), end
+
+async def _unit_data_page(unitId, from_, to, page_size, after):
+    keyset = decode_cursor(after) if after else None
+    scans, end = await _unit_scans(unitId, from_, to)
+    sql, params = rows_query(scans, end, PAGE_COLUMNS, after=keyset, limit=page_size + 1)
+    # One prepared statement per shape: branch count and whether it continues a page
+    stmt = statements.register(f"unit_data_page_{len(scans)}{'_after' if keyset else ''}", sql)
+    async with adb.connection() as conn:
+        cur = conn.cursor()
+        await statements.execute(cur, stmt, params)
+        rows = await cur.fetchall(); await cur.close()
+
+    rows, next_token = page_of(rows, page_size)
+    devices, data = {}, []
+    for ts, vol, dev_id, dev_pk, _ in rows:
+        devices.setdefault(dev_pk, {"device_pk": dev_pk, "device_id": dev_id})
+        data.append({
+            "timestamp": ts.isoformat() if hasattr(ts,"isoformat") else ts,
+            "volume_ml": vol,
+            "device_id": dev_id,
+            "device_pk": dev_pk
+        })
+
+    return {"unitId": unitId, "devices": list(devices.values()), "data": data, "next": next_token}
+
+# Streamed unit history: rows as they come, the devices list at the end
+async def _stream_unit_rows(unitId, sql, params, fmt):
+    devices = {}
+
+    def to_dict(row):
+        ts, vol, dev_id, dev_pk = row
+        if dev_pk not in devices:
+            devices[dev_pk] = {"device_pk": dev_pk, "device_id": dev_id}
+        return {
+            "timestamp": ts.isoformat() if hasattr(ts,"isoformat") else ts,
+            "volume_ml": vol,
+            "device_id": dev_id,
+            "device_pk": dev_pk
+        }
+
+    return await stream_rows(
+        adb, sql, params, to_dict, fmt,
+        head='{"unitId":%d,"data":[' % unitId,
+        tail=lambda: '],"devices":' + dumps(list(devices.values())) + "}",
+    )
+
 @app.get("/unit/data")
-def get_unit_data(
+@cancel_on_disconnect
+async def get_unit_data(
+    request: Request,
     unitId: int = Query(...),
     from_: str | None = Query(None, alias="from"),
     to: str | None = None,
-    limit: int = 100000
+    limit: int = 100000,
+    stream: str | None = None,
+    page_size: int | None = Query(None, ge=1, le=PAGE_SIZE_MAX),
+    after: str | None = None,
+    max_points: int | None = Query(None, ge=3),
+    downsample: str = "lttb"
 ):
-    conn = get_connection(); cur = conn.cursor()
-    cur.execute("""
-        SELECT
-          dd.timestamp, dd.volume_ml,
-          d.device_id AS device_id,
-          d.id        AS device_pk
-        FROM unit_devices ud
-        JOIN devices d
-          ON d.id = ud.device_id
-        JOIN device_data dd
-          ON dd.device_id = d.device_id
-         -- clip to attachment window (dd.timestamp is timestamp WITHOUT time zone)
-         AND dd.timestamp >= ud.attached_at
-         AND dd.timestamp < COALESCE(ud.detached_at, 'infinity')
-         -- apply user window with consistent types
-         AND (%s::timestamp IS NULL OR dd.timestamp >= %s::timestamp)
-         AND (%s::timestamp IS NULL OR dd.timestamp <= %s::timestamp)
-        WHERE ud.unit_id = %s
-        ORDER BY dd.timestamp
-        LIMIT %s
-    """, (from_, from_, to, to, unitId, limit))
-    rows = cur.fetchall(); cur.close(); conn.close()
+    if downsample not in DOWNSAMPLE_METHODS:
+        raise HTTPException(status_code=400, detail=f"downsample must be one of {', '.join(DOWNSAMPLE_METHODS)}")
+    if page_size and max_points:
+        raise HTTPException(status_code=400, detail="page_size and max_points can't be combined")
+    if page_size:
+        return await _unit_data_page(unitId, from_, to, page_size, after)
+
+    scans, end = await _unit_scans(unitId, from_, to)
+    sql, params = rows_query(scans, end, limit=limit)
+    if stream and not max_points:
+        return await _stream_unit_rows(unitId, sql, params, stream)
+
+    async with adb.connection() as conn:
+        cur = conn.cursor()
+        await statements.execute(cur, statements.register(f"unit_data_{len(scans)}", sql), params)
+        rows = await cur.fetchall(); await cur.close()
+
+    if max_points and len(rows) > max_points:
+        keep = await run_in_threadpool(downsample_rows, [r[0] for r in rows], [r[1] for r in rows], max_points, downsample)
+        rows = [rows[i] for i in keep]
 
     devices, data = {}, []
     for ts, vol, dev_id, dev_pk in rows:
@@ -814,22 +1667,67 @@ def get_unit_data(
 
     return {"unitId": unitId, "devices": list(devices.values()), "data": data}
 
-# TEMP sanity endpoint
+# Bulk export of a unit, a device or the caller's organisation (export.py):
+# CSV straight from COPY TO STDOUT, or Parquet row groups; no row limit
+@app.get("/export")
+@cancel_on_disconnect
+async def export_history(
+    request: Request,
+    unitId: Optional[int] = None,
+    device_id: Optional[str] = None,
+    from_: Optional[str] = Query(None, alias="from"),
+    to: Optional[str] = None,
+    format: str = "csv",
+):
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(EXPORT_FORMATS)}")
+    if format == "parquet" and not parquet_available():
+        raise HTTPException(status_code=501, detail="Parquet export needs pyarrow installed")
+    if unitId is not None and device_id:
+        raise HTTPException(status_code=400, detail="Pass unitId or device_id, not both")
+    # Bad bounds must fail before the response starts streaming
+    try:
+        parse_ts(from_)
+        parse_ts(to)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="from/to must be ISO timestamps")
+
+    if unitId is not None:
+        scope, scope_id = "unit", unitId
+    elif device_id:
+        scope, scope_id = "device", device_id
+    else:
+        user = getattr(request.state, "user", None)
+        if not user or not user.get("organisation_id"):
+            raise HTTPException(status_code=401, detail="Unauthenticated or organisation not set")
+        scope, scope_id = "org", user["organisation_id"]
+
+    if scope == "unit":
+        scans, end = await _unit_scans(unitId, from_, to)
+        sql, params = rows_query(scans, end, EXPORT_COLUMNS)
+    else:
+        sql, params = EXPORT_SCOPES[scope], export_params(scope_id, from_, to)
+    body = (csv_body if format == "csv" else parquet_body)(adb, sql, params)
+    return StreamingResponse(
+        body,
+        media_type=EXPORT_FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{export_filename(scope, scope_id, format)}"'},
+    )
+
+# TEMP sanity endpoint: every reading of every device the unit ever had,
+# attachment windows ignored
 @app.get("/unit/data/raw")
-def get_unit_data_raw(unitId: int, from_: str | None = Query(None, alias="from"), to: str | None = None, limit: int = 100000):
-    conn = get_connection(); cur = conn.cursor()
-    cur.execute("""
-        SELECT dd.timestamp, dd.volume_ml, d.device_id, d.id AS device_pk
-        FROM unit_devices ud
-        JOIN devices d  ON d.id = ud.device_id
-        JOIN device_data dd ON dd.device_id = d.device_id
-        WHERE ud.unit_id = %s
-          AND (%s::timestamp IS NULL OR dd.timestamp >= %s::timestamp)
-          AND (%s::timestamp IS NULL OR dd.timestamp <= %s::timestamp)
-        ORDER BY dd.timestamp
-        LIMIT %s
-    """, (unitId, from_, from_, to, to, limit))
-    rows = cur.fetchall(); cur.close(); conn.close()
+@cancel_on_disconnect
+async def get_unit_data_raw(request: Request, unitId: int, from_: str | None = Query(None, alias="from"), to: str | None = None, limit: int = 100000, stream: str | None = None):
+    scans, end = await _unit_scans(unitId, from_, to, clip=False)
+    sql, params = rows_query(scans, end, limit=limit)
+    if stream:
+        return await _stream_unit_rows(unitId, sql, params, stream)
+
+    async with adb.connection() as conn:
+        cur = conn.cursor()
+        await cur.execute(sql, params)
+        rows = await cur.fetchall(); await cur.close()
     devices, data = {}, []
     for ts, vol, dev_id, dev_pk in rows:
         devices.setdefault(dev_pk, {"device_pk": dev_pk, "device_id": dev_id})
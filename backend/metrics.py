@@ -0,0 +1,218 @@
+import re
+import threading
+from bisect import bisect_left
+from functools import lru_cache
+
+
+# Seconds; covers a cache hit (sub-millisecond) up to a pool timeout
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}")
+        return tuple(labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        lines.extend(self._samples(items))
+        return lines
+
+    def _samples(self, items):
+        return [f"{self.name}{_labels(self.labels, key)} {_number(value)}" for key, value in items]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Values read from ``collect()`` at scrape time, e.g. pool or queue sizes."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), collect=None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def set(self, *labels, value):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self):
+        if self.collect is not None:
+            try:
+                for labels, value in self.collect():
+                    self.set(*labels, value=value)
+            except Exception:
+                pass
+        return super().render()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, *labels, value):
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # [per-bucket counts..., +Inf count, sum]
+                series = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            # le is inclusive; past the last bound lands on +Inf
+            series[bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def _samples(self, items):
+        lines = []
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = 'le="%s"' % _number(float(bound))
+                lines.append(f"{self.name}_bucket{_labels(self.labels, key, le)} {cumulative}")
+            labels = _labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {_number(round(series[-1], 6))}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Process-local metrics rendered in the Prometheus text format.
+
+    Each worker process keeps its own values; scrape every worker (or run
+    one) and let Prometheus aggregate across them.
+    """
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), collect=None):
+        return self.register(Gauge(name, help, labels, collect))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = Registry()
+
+HTTP_DURATION = metrics.histogram(
+    "http_request_duration_seconds", "Time to the response headers, by route template",
+    ("method", "route", "status"),
+)
+DB_QUERY_DURATION = metrics.histogram(
+    "db_query_duration_seconds", "Statement execution time, by statement label", ("statement",),
+)
+DB_ROWS = metrics.counter(
+    "db_rows_total", "Rows returned or affected, by statement label", ("statement",),
+)
+DB_SLOW_QUERIES = metrics.counter(
+    "db_slow_queries_total", "Statements slower than SLOW_QUERY_MS", ("statement",),
+)
+DB_POOL_ACQUIRE = metrics.histogram(
+    "db_pool_acquire_seconds", "Time to borrow a pooled connection (waiting, opening, health check), by pool",
+    ("pool",),
+)
+INGEST_READINGS = metrics.counter(
+    "ingest_readings_total", "Readings written, by ingest path", ("path",),
+)
+INGEST_FAILURES = metrics.counter(
+    "ingest_failed_readings_total", "Readings rejected or dropped on a database error, by ingest path", ("path",),
+)
+
+
+_VERB = re.compile(r"^\s*(?:(?:--[^\n]*\n|/\*.*?\*/)\s*)*(\w+)", re.S)
+_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE|COPY)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?([A-Za-z_][\w.]*)", re.I)
+_MAIN = re.compile(r"\)\s*(SELECT|INSERT|UPDATE|DELETE)\b", re.I)
+
+# Labels only need the head of a statement; execute_values inlines its rows
+LABEL_PREFIX = 1024
+
+
+def statement_label(sql):
+    """``"select device_data"``: verb plus the first table named, so labels
+    stay few (one per query shape) and never include parameter values."""
+    if isinstance(sql, bytes):
+        sql = sql[:LABEL_PREFIX].decode("utf-8", "replace")
+    elif not isinstance(sql, str):
+        # psycopg2.sql.Composed and friends
+        return "composed"
+    return _label(sql[:LABEL_PREFIX])
+
+
+@lru_cache(maxsize=1024)
+def _label(sql):
+    verb = _VERB.match(sql)
+    if not verb:
+        return "unknown"
+    label = verb.group(1).lower()
+    if label == "with":
+        # CTE: label by the statement after it, e.g. "with insert device_data"
+        main = _MAIN.search(sql)
+        if main:
+            label += " " + main.group(1).lower()
+    table = _TABLE.search(sql)
+    if table:
+        # Monthly partitions share one label
+        label += " " + re.sub(r"_p\d{4}_\d{2}$", "_pyyyy_mm", table.group(1).lower())
+    return label
@@ -0,0 +1,112 @@
+import argparse
+import hashlib
+import os
+import re
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+# Any stable 64-bit number; serialises concurrent runs (several workers at startup)
+LOCK_ID = 7340021
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INTEGER PRIMARY KEY,
+    name VARCHAR(255) NOT NULL,
+    checksum VARCHAR(64) NOT NULL,
+    applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+"""
+
+
+def discover(path=MIGRATIONS_DIR):
+    """``[(version, name, sql, checksum)]`` for ``NNNN_name.sql`` files, in order."""
+    found = []
+    for filename in sorted(os.listdir(path)):
+        match = re.match(r"^(\d+)_(\w+)\.sql$", filename)
+        if not match:
+            continue
+        with open(os.path.join(path, filename), encoding="utf-8") as f:
+            sql = f.read()
+        found.append((int(match.group(1)), match.group(2), sql, hashlib.sha256(sql.encode("utf-8")).hexdigest()))
+    versions = [m[0] for m in found]
+    if len(set(versions)) != len(versions):
+        raise ValueError("duplicate migration version in %s" % path)
+    return found
+
+
+def applied(cursor):
+    cursor.execute("SELECT version, checksum FROM schema_migrations ORDER BY version")
+    return dict(cursor.fetchall())
+
+
+def migrate(conn, path=MIGRATIONS_DIR):
+    """Apply pending migrations, each in its own transaction. Returns their versions.
+
+    Applied files must not change; a checksum mismatch stops the run so the
+    database and the repo do not silently drift apart.
+    """
+    cursor = conn.cursor()
+    cursor.execute(SCHEMA)
+    conn.commit()
+
+    done = []
+    for version, name, sql, checksum in discover(path):
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (LOCK_ID,))
+        seen = applied(cursor)
+        if version in seen:
+            if seen[version] != checksum:
+                conn.rollback()
+                raise ValueError(f"migration {version:04d}_{name} was edited after it was applied")
+            conn.rollback()
+            continue
+        cursor.execute(sql)
+        cursor.execute(
+            "INSERT INTO schema_migrations (version, name, checksum) VALUES (%s, %s, %s)",
+            (version, name, checksum)
+        )
+        conn.commit()
+        done.append(version)
+    cursor.close()
+    return done
+
+
+def status(conn, path=MIGRATIONS_DIR):
+    cursor = conn.cursor()
+    cursor.execute(SCHEMA)
+    conn.commit()
+    seen = applied(cursor)
+    cursor.close()
+    rows = []
+    for version, name, _, checksum in discover(path):
+        if version not in seen:
+            state = "pending"
+        elif seen[version] != checksum:
+            state = "modified"
+        else:
+            state = "applied"
+        rows.append((version, name, state))
+    return rows
+
+
+# python migrations.py [up|status]
+def main(argv=None):
+    from db import get_connection
+
+    parser = argparse.ArgumentParser(description="Apply versioned schema migrations")
+    parser.add_argument("command", nargs="?", default="up", choices=["up", "status"])
+    args = parser.parse_args(argv)
+
+    conn = get_connection()
+    try:
+        if args.command == "status":
+            for version, name, state in status(conn):
+                print(f"{version:04d}_{name}: {state}")
+        else:
+            done = migrate(conn)
+            print(f"Applied {len(done)} migration(s)" + (": " + ", ".join(f"{v:04d}" for v in done) if done else ""))
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+-- Tables the API reads and writes. Everything is IF NOT EXISTS so this also
+-- runs cleanly against databases created from db/init.sql or by hand.
+
+CREATE TABLE IF NOT EXISTS organisations (
+    id SERIAL PRIMARY KEY,
+    name VARCHAR(100) NOT NULL,
+    notes TEXT
+);
+
+CREATE TABLE IF NOT EXISTS roles (
+    id SERIAL PRIMARY KEY,
+    name VARCHAR(50) NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS users (
+    id SERIAL PRIMARY KEY,
+    email VARCHAR(255) UNIQUE NOT NULL,
+    password_hash TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+ALTER TABLE users ADD COLUMN IF NOT EXISTS name VARCHAR(255);
+ALTER TABLE users ADD COLUMN IF NOT EXISTS organisation_id INTEGER REFERENCES organisations(id);
+ALTER TABLE users ADD COLUMN IF NOT EXISTS roles_id INTEGER REFERENCES roles(id);
+
+CREATE TABLE IF NOT EXISTS devices (
+    id SERIAL PRIMARY KEY,
+    device_id VARCHAR(255) UNIQUE NOT NULL,
+    name VARCHAR(255),
+    owner_id INTEGER REFERENCES users(id),
+    location TEXT,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+ALTER TABLE devices ADD COLUMN IF NOT EXISTS organisation_id INTEGER REFERENCES organisations(id);
+
+CREATE TABLE IF NOT EXISTS device_data (
+    id SERIAL PRIMARY KEY,
+    device_id VARCHAR(255) REFERENCES devices(device_id),
+    volume_ml INTEGER NOT NULL,
+    timestamp TIMESTAMP DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS units (
+    id SERIAL PRIMARY KEY,
+    name VARCHAR(255) NOT NULL,
+    organisation_id INTEGER REFERENCES organisations(id),
+    location TEXT,
+    commissioned_at TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS unit_devices (
+    id SERIAL PRIMARY KEY,
+    unit_id INTEGER REFERENCES units(id),
+    device_id INTEGER REFERENCES devices(id),
+    attached_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    detached_at TIMESTAMP,
+    active BOOLEAN NOT NULL DEFAULT TRUE
+);
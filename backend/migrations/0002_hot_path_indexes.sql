@@ -0,0 +1,21 @@
+-- Indexes behind the read routes. On a large live table, build these ahead of
+-- time with CREATE INDEX CONCURRENTLY under the same names; the IF NOT EXISTS
+-- below then turns into a no-op.
+
+-- /data/{device_id}, histograms, summaries: device + time range, covering the
+-- columns those reads return so they can be answered from the index
+CREATE INDEX IF NOT EXISTS device_data_device_ts_idx
+    ON device_data (device_id, timestamp) INCLUDE (volume_ml, id);
+
+-- /unit, /unit/data: a unit's attachments
+CREATE INDEX IF NOT EXISTS unit_devices_unit_active_idx
+    ON unit_devices (unit_id, active) INCLUDE (device_id, attached_at, detached_at);
+CREATE INDEX IF NOT EXISTS unit_devices_device_idx ON unit_devices (device_id);
+
+-- Organisation-scoped lists and summaries
+CREATE INDEX IF NOT EXISTS devices_organisation_idx ON devices (organisation_id);
+CREATE INDEX IF NOT EXISTS devices_owner_idx ON devices (owner_id);
+CREATE INDEX IF NOT EXISTS units_organisation_idx ON units (organisation_id, name);
+CREATE INDEX IF NOT EXISTS users_organisation_idx ON users (organisation_id);
+
+-- users(email) is covered by the UNIQUE constraint from 0001
@@ -0,0 +1,19 @@
+-- Tell the API when a unit's device attachments change, so its cached unit
+-- timelines (unit_timeline.py) are dropped instead of waiting for their TTL.
+-- The payload is the unit id; NOTIFY only goes out on commit.
+CREATE OR REPLACE FUNCTION notify_unit_devices_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM pg_notify('unit_devices_changed', OLD.unit_id::text);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM pg_notify('unit_devices_changed', NEW.unit_id::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS unit_devices_changed ON unit_devices;
+CREATE TRIGGER unit_devices_changed
+    AFTER INSERT OR UPDATE OR DELETE ON unit_devices
+    FOR EACH ROW EXECUTE FUNCTION notify_unit_devices_changed();
@@ -0,0 +1,47 @@
+-- Summary tables kept in step with device_data by ingest (rollups.py,
+-- device_stats.py). IF NOT EXISTS so databases where the API created them
+-- at startup apply this cleanly.
+
+-- Per-device hourly and daily buckets, also the archive for readings that
+-- retention has dropped from device_data
+CREATE TABLE IF NOT EXISTS device_rollups_hourly (
+    device_id VARCHAR(255) NOT NULL,
+    bucket TIMESTAMP NOT NULL,
+    total_ml BIGINT NOT NULL,
+    readings INTEGER NOT NULL,
+    min_ml INTEGER NOT NULL,
+    max_ml INTEGER NOT NULL,
+    first_ts TIMESTAMP NOT NULL,
+    last_ts TIMESTAMP NOT NULL,
+    PRIMARY KEY (device_id, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS device_rollups_daily (
+    device_id VARCHAR(255) NOT NULL,
+    bucket TIMESTAMP NOT NULL,
+    total_ml BIGINT NOT NULL,
+    readings INTEGER NOT NULL,
+    min_ml INTEGER NOT NULL,
+    max_ml INTEGER NOT NULL,
+    first_ts TIMESTAMP NOT NULL,
+    last_ts TIMESTAMP NOT NULL,
+    PRIMARY KEY (device_id, bucket)
+);
+
+-- Lifetime totals per device, read by /devices/summary and /dashboard
+CREATE TABLE IF NOT EXISTS device_stats (
+    device_id VARCHAR(255) PRIMARY KEY,
+    total_ml BIGINT NOT NULL,
+    readings BIGINT NOT NULL,
+    first_ts TIMESTAMP NOT NULL,
+    last_ts TIMESTAMP NOT NULL,
+    -- NULL once a device's last raw reading has been dropped by retention
+    last_volume_ml INTEGER
+);
+
+-- Which backfills have finished ('backfill', 'device_stats'); reads fall
+-- back to device_data until theirs is recorded
+CREATE TABLE IF NOT EXISTS rollup_state (
+    name VARCHAR(64) PRIMARY KEY,
+    completed_at TIMESTAMP NOT NULL
+);
@@ -0,0 +1,37 @@
+import base64
+import json
+import os
+from datetime import datetime
+
+from fastapi import HTTPException
+
+
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "10000"))
+
+
+# Opaque keyset token for the last row of a page: (timestamp, device_data.id)
+def encode_cursor(ts, row_id):
+    raw = json.dumps([ts.isoformat() if isinstance(ts, datetime) else ts, row_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        ts, row_id = json.loads(raw)
+        return datetime.fromisoformat(ts), int(row_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid page token")
+
+
+def page_of(rows, page_size):
+    """Trim a ``LIMIT page_size + 1`` result to one page.
+
+    Rows must start with the timestamp and end with the ``device_data.id``.
+    Returns ``(rows, next_token)``; the token is ``None`` on the last page.
+    """
+    if len(rows) <= page_size:
+        return rows, None
+    rows = rows[:page_size]
+    last = rows[-1]
+    return rows, encode_cursor(last[0], last[-1])
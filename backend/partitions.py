@@ -0,0 +1,244 @@
+import argparse
+import os
+import time
+from datetime import datetime, timedelta
+
+from rollups import rollups
+
+
+PARENT = "device_data"
+DEFAULT = "device_data_default"
+LEGACY = "device_data_legacy"
+
+PARTITIONED_SCHEMA = """
+CREATE TABLE device_data (
+    id INTEGER NOT NULL DEFAULT nextval('device_data_id_seq'),
+    device_id VARCHAR(255) REFERENCES devices(device_id),
+    volume_ml INTEGER NOT NULL,
+    timestamp TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (id, timestamp)
+) PARTITION BY RANGE (timestamp);
+
+CREATE INDEX device_data_device_ts_idx ON device_data (device_id, timestamp) INCLUDE (volume_ml, id);
+
+-- Catches readings outside every monthly partition until ensure() moves them
+CREATE TABLE device_data_default PARTITION OF device_data DEFAULT;
+"""
+
+
+def month_start(ts):
+    return ts.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(ts, months):
+    index = ts.year * 12 + ts.month - 1 + months
+    return ts.replace(year=index // 12, month=index % 12 + 1)
+
+
+def partition_name(month):
+    return f"device_data_p{month:%Y_%m}"
+
+
+class PartitionManager:
+    """Monthly range partitions for ``device_data`` plus raw-data retention.
+
+    ``convert`` turns an existing plain table into a partitioned one (run
+    once, offline). ``ensure`` keeps ``months_ahead`` future partitions
+    ready. ``apply_retention`` drops raw partitions older than
+    ``retention_months`` once their hourly/daily rollups are rebuilt, so the
+    history stays available at rollup resolution.
+    """
+
+    def __init__(self, months_ahead=3, retention_months=0):
+        self.months_ahead = months_ahead
+        self.retention_months = retention_months
+
+    def is_partitioned(self, cursor):
+        cursor.execute("""
+            SELECT 1 FROM pg_partitioned_table p
+            JOIN pg_class c ON c.oid = p.partrelid
+            WHERE c.relname = %s AND pg_table_is_visible(c.oid)
+        """, (PARENT,))
+        return cursor.fetchone() is not None
+
+    def partitions(self, cursor):
+        """``[(name, lower, upper)]`` of the monthly partitions, oldest first."""
+        cursor.execute("""
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = %s::regclass AND c.relname <> %s
+        """, (PARENT, DEFAULT))
+        out = []
+        for name, bound in cursor.fetchall():
+            # FOR VALUES FROM ('2025-01-01 00:00:00') TO ('2025-02-01 00:00:00')
+            parts = bound.split("'")
+            out.append((name, datetime.fromisoformat(parts[1]), datetime.fromisoformat(parts[3])))
+        return sorted(out, key=lambda p: p[1])
+
+    def convert(self, conn, drop_legacy=False):
+        """Rebuild device_data as a partitioned table in one transaction.
+
+        Readings are copied with one INSERT; the old table is kept as
+        ``device_data_legacy`` unless ``drop_legacy`` is set. Ingest is
+        blocked while this runs. Returns the number of rows copied.
+        """
+        cursor = conn.cursor()
+        if self.is_partitioned(cursor):
+            cursor.close()
+            return 0
+
+        cursor.execute(f"LOCK TABLE {PARENT} IN ACCESS EXCLUSIVE MODE")
+        cursor.execute(f"SELECT COUNT(*) FROM {PARENT} WHERE timestamp IS NULL")
+        missing = cursor.fetchone()[0]
+        if missing:
+            conn.rollback()
+            raise ValueError(f"{missing} readings have no timestamp; fix or delete them before converting")
+
+        cursor.execute(f"""
+            ALTER SEQUENCE device_data_id_seq OWNED BY NONE;
+            ALTER TABLE {PARENT} RENAME TO {LEGACY};
+            ALTER TABLE {LEGACY} RENAME CONSTRAINT device_data_pkey TO device_data_legacy_pkey;
+            ALTER INDEX IF EXISTS device_data_device_ts_idx RENAME TO device_data_legacy_device_ts_idx;
+        """)
+        cursor.execute(PARTITIONED_SCHEMA)
+
+        cursor.execute(f"SELECT MIN(timestamp), MAX(timestamp) FROM {LEGACY}")
+        lo, hi = cursor.fetchone()
+        now = datetime.utcnow()
+        lo = month_start(min(lo or now, now))
+        hi = add_months(month_start(max(hi or now, now)), self.months_ahead + 1)
+        month = lo
+        while month < hi:
+            self._create(cursor, month)
+            month = add_months(month, 1)
+
+        cursor.execute(f"""
+            INSERT INTO {PARENT} (id, device_id, volume_ml, timestamp)
+            SELECT id, device_id, volume_ml, timestamp FROM {LEGACY}
+        """)
+        copied = cursor.rowcount
+        cursor.execute(f"ALTER SEQUENCE device_data_id_seq OWNED BY {PARENT}.id")
+        if drop_legacy:
+            cursor.execute(f"DROP TABLE {LEGACY}")
+        conn.commit()
+        cursor.close()
+        return copied
+
+    def _create(self, cursor, month):
+        name = partition_name(month)
+        cursor.execute(f"""
+            CREATE TABLE {name} PARTITION OF {PARENT}
+            FOR VALUES FROM (%s) TO (%s)
+        """, (month, add_months(month, 1)))
+        return name
+
+    def ensure(self, conn, now=None):
+        """Create missing partitions up to ``months_ahead`` months from now.
+
+        Readings already parked in the default partition for a new month are
+        moved into it before it is attached. Returns the names created.
+        """
+        cursor = conn.cursor()
+        if not self.is_partitioned(cursor):
+            cursor.close()
+            return []
+        existing = {name for name, _, _ in self.partitions(cursor)}
+        month = month_start(now or datetime.utcnow())
+        created = []
+        for _ in range(self.months_ahead + 1):
+            name = partition_name(month)
+            if name not in existing:
+                upper = add_months(month, 1)
+                cursor.execute(f"""
+                    CREATE TABLE {name} (LIKE {PARENT} INCLUDING DEFAULTS INCLUDING CONSTRAINTS);
+                    WITH moved AS (
+                        DELETE FROM {DEFAULT} WHERE timestamp >= %(lo)s AND timestamp < %(hi)s
+                        RETURNING id, device_id, volume_ml, timestamp
+                    )
+                    INSERT INTO {name} (id, device_id, volume_ml, timestamp) SELECT * FROM moved;
+                    ALTER TABLE {PARENT} ATTACH PARTITION {name} FOR VALUES FROM (%(lo)s) TO (%(hi)s);
+                """, {"lo": month, "hi": upper})
+                conn.commit()
+                created.append(name)
+            month = add_months(month, 1)
+        cursor.close()
+        return created
+
+    def apply_retention(self, conn, now=None):
+        """Drop raw partitions that ended more than ``retention_months`` ago.
+
+        Each partition's rollups are rebuilt from its raw rows first, then
+        the partition is detached and dropped in the same transaction that
+        moves the ``raw_from`` boundary. Returns the names dropped.
+        """
+        if self.retention_months <= 0:
+            return []
+        cursor = conn.cursor()
+        if not self.is_partitioned(cursor):
+            cursor.close()
+            return []
+        # Without backfilled rollups the dropped months would simply vanish
+        cursor.execute("SELECT 1 FROM rollup_state WHERE name = 'backfill'")
+        if cursor.fetchone() is None:
+            cursor.close()
+            raise ValueError("rollups are not backfilled; run 'python rollups.py rebuild' first")
+
+        cutoff = add_months(month_start(now or datetime.utcnow()), -self.retention_months)
+        dropped = []
+        for name, lower, upper in self.partitions(cursor):
+            if upper > cutoff:
+                break
+            rollups.rebuild(conn, start=lower, end=upper - timedelta(seconds=1))
+            cursor.execute(f"ALTER TABLE {PARENT} DETACH PARTITION {name}")
+            cursor.execute(f"DROP TABLE {name}")
+            cursor.execute("""
+                INSERT INTO rollup_state (name, completed_at) VALUES ('raw_from', %s)
+                ON CONFLICT (name) DO UPDATE SET completed_at = GREATEST(rollup_state.completed_at, EXCLUDED.completed_at)
+            """, (upper,))
+            conn.commit()
+            dropped.append(name)
+        cursor.close()
+        return dropped
+
+    def maintain(self, conn):
+        return self.ensure(conn), self.apply_retention(conn)
+
+
+partitions = PartitionManager(
+    months_ahead=int(os.getenv("PARTITION_MONTHS_AHEAD", "3")),
+    retention_months=int(os.getenv("RAW_RETENTION_MONTHS", "0")),
+)
+
+
+# python partitions.py convert|maintain
+def main(argv=None):
+    from db import get_connection, schema_lock
+
+    parser = argparse.ArgumentParser(description="Manage device_data partitions")
+    sub = parser.add_subparsers(dest="command", required=True)
+    convert = sub.add_parser("convert", help="turn device_data into monthly partitions (offline)")
+    convert.add_argument("--drop-legacy", action="store_true", help="drop the old table afterwards")
+    sub.add_parser("maintain", help="create future partitions and apply retention")
+    args = parser.parse_args(argv)
+
+    conn = get_connection()
+    try:
+        started = time.monotonic()
+        if args.command == "convert":
+            copied = partitions.convert(conn, args.drop_legacy)
+            created = partitions.ensure(conn)
+            print(f"Copied {copied} reading(s) into {PARENT} partitions in {time.monotonic() - started:.1f}s")
+        else:
+            # Don't race an API worker creating the same partitions at startup
+            with schema_lock():
+                created, dropped = partitions.maintain(conn)
+            print(f"Created {len(created)} partition(s), dropped {len(dropped)} in {time.monotonic() - started:.1f}s")
+            for name in dropped:
+                print(f"  dropped {name}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
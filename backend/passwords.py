@@ -0,0 +1,117 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from passlib.context import CryptContext
+
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+class PasswordBusy(Exception):
+    pass
+
+
+# Runs in a worker process; timestamps let the parent see queue vs bcrypt time
+def _run(op, args, submitted):
+    started = time.time()
+    if op == "hash":
+        result = pwd_context.hash(*args)
+    else:
+        result = pwd_context.verify(*args)
+    return result, started - submitted, time.time() - started
+
+
+class PasswordHasher:
+    """Runs bcrypt in a small process pool so logins never tie up the
+    request threadpool.
+
+    At most ``max_pending`` operations may be queued or running; callers
+    beyond that wait up to ``wait_timeout`` seconds for a slot, then get
+    ``PasswordBusy``.
+    """
+
+    def __init__(self, workers=2, max_pending=16, wait_timeout=5.0):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.wait_timeout = wait_timeout
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+        self._completed = 0
+        self._rejected = 0
+        self._in_flight = 0
+        self._queue_total = 0.0
+        self._queue_max = 0.0
+        self._work_total = 0.0
+
+    def _pool(self):
+        if self._executor is None:
+            # spawn: forking a threaded server process is not safe
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            self._slots = asyncio.Semaphore(self.max_pending)
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    async def _submit(self, op, *args):
+        executor = self._pool()
+        submitted = time.time()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.wait_timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self._rejected += 1
+            raise PasswordBusy("password hashing is saturated")
+        try:
+            with self._lock:
+                self._in_flight += 1
+            result, queued, worked = await asyncio.wrap_future(executor.submit(_run, op, args, submitted))
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self._slots.release()
+
+        with self._lock:
+            self._completed += 1
+            self._queue_total += queued
+            self._queue_max = max(self._queue_max, queued)
+            self._work_total += worked
+        return result
+
+    async def hash(self, password):
+        return await self._submit("hash", password)
+
+    async def verify(self, password, password_hash):
+        return await self._submit("verify", password, password_hash)
+
+    def stats(self):
+        with self._lock:
+            done = self._completed
+            return {
+                "workers": self.workers,
+                "max_pending": self.max_pending,
+                "in_flight": self._in_flight,
+                "completed": done,
+                "rejected": self._rejected,
+                "queue_ms_avg": round(self._queue_total * 1000 / done, 3) if done else 0.0,
+                "queue_ms_max": round(self._queue_max * 1000, 3),
+                "hash_ms_avg": round(self._work_total * 1000 / done, 3) if done else 0.0,
+            }
+
+
+password_hasher = PasswordHasher(
+    workers=int(os.getenv("PASSWORD_WORKERS", "2")),
+    max_pending=int(os.getenv("PASSWORD_MAX_PENDING", "16")),
+    wait_timeout=float(os.getenv("PASSWORD_WAIT_TIMEOUT", "5")),
+)
@@ -0,0 +1,268 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from logs import get_logger
+from metrics import metrics
+
+log = get_logger("ratelimit")
+
+INGEST_REJECTED = metrics.counter(
+    "ingest_rejected_total", "Ingest requests turned away before touching the database, by reason", ("reason",),
+)
+
+
+class TokenBuckets:
+    """One token bucket per key: ``rate`` tokens a second up to ``burst``.
+
+    Keys are kept in an LRU of ``capacity`` entries; an evicted key comes
+    back with a full bucket, which only errs on the side of admitting.
+    ``rate`` 0 turns the limiter off.
+    """
+
+    def __init__(self, rate=0.0, burst=0.0, capacity=100000):
+        self.rate = rate
+        self.burst = max(burst, rate)
+        self.capacity = capacity
+        self._buckets = OrderedDict()  # key -> [tokens, updated_at]
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def take(self, counts):
+        """Take ``counts[key]`` tokens from each bucket, all or nothing.
+
+        Returns 0 when admitted, otherwise the seconds until the emptiest
+        bucket could cover its count (``inf`` if it never can).
+        """
+        if not self.enabled:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            buckets = []
+            wait = 0.0
+            for key, n in counts.items():
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = self._buckets[key] = [self.burst, now]
+                else:
+                    bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                    bucket[1] = now
+                    self._buckets.move_to_end(key)
+                if n > self.burst:
+                    wait = math.inf
+                elif bucket[0] < n:
+                    wait = max(wait, (n - bucket[0]) / self.rate)
+                buckets.append((bucket, n))
+            if not wait:
+                for bucket, n in buckets:
+                    bucket[0] -= n
+            while len(self._buckets) > self.capacity:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def refund(self, counts):
+        """Give back tokens taken by ``take`` for a request refused later."""
+        if not self.enabled:
+            return
+        with self._lock:
+            for key, n in counts.items():
+                bucket = self._buckets.get(key)
+                if bucket is not None:
+                    bucket[0] = min(self.burst, bucket[0] + n)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class DeviceOrgs:
+    """device_id -> organisation_id for the per-organisation limit.
+
+    The whole map is reloaded in a background thread every ``ttl`` seconds,
+    so a lookup never waits on the database; devices not in an organisation
+    (or not seen yet) are only limited per device.
+    """
+
+    def __init__(self, ttl=300.0):
+        self.ttl = ttl
+        self._orgs = {}
+        self._loaded_at = None
+        self._loading = False
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def setup(self, pool):
+        self._pool = pool
+        self._load()
+
+    def get(self, device_id):
+        if self._pool is not None and not self._loading and (
+            self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl
+        ):
+            with self._lock:
+                if not self._loading:
+                    self._loading = True
+                    threading.Thread(target=self._load, name="device-orgs", daemon=True).start()
+        return self._orgs.get(device_id)
+
+    def _load(self):
+        try:
+            with self._pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT device_id, organisation_id FROM devices WHERE organisation_id IS NOT NULL")
+                self._orgs = dict(cursor.fetchall())
+                cursor.close()
+        except Exception as e:
+            log.warning("could not load device organisations", extra={"error": repr(e)})
+        finally:
+            self._loaded_at = time.monotonic()
+            self._loading = False
+
+
+class LoadShedder:
+    """Turns ingest away while the write pool is under pressure.
+
+    Tracks moving averages of the sync pool's borrow wait and of the
+    single-reading ingest insert (``/ingest`` feeds it; COPY batches,
+    migrations and other maintenance statements do not, so one long
+    legitimate statement can't shut ingest). While either is over its
+    threshold, ``check`` returns a Retry-After. The averages decay with ``half_life`` between samples, so
+    once shedding stops the traffic that fed them, ingest is let back in
+    and re-measured instead of staying shut. A threshold of 0 ignores that
+    signal.
+    """
+
+    ALPHA = 0.2
+
+    def __init__(self, max_wait_ms=250.0, max_query_ms=0.0, half_life=5.0):
+        self.thresholds = {"pool_wait": max_wait_ms / 1000.0, "query": max_query_ms / 1000.0}
+        self.half_life = half_life
+        self._values = {"pool_wait": [0.0, time.monotonic()], "query": [0.0, time.monotonic()]}
+        self._lock = threading.Lock()
+
+    def _decayed(self, signal, now):
+        value, updated_at = self._values[signal]
+        return value * 0.5 ** ((now - updated_at) / self.half_life)
+
+    def observe(self, signal, seconds):
+        now = time.monotonic()
+        with self._lock:
+            value = self._decayed(signal, now)
+            self._values[signal] = [value + self.ALPHA * (seconds - value), now]
+
+    def observe_wait(self, seconds):
+        self.observe("pool_wait", seconds)
+
+    def observe_query(self, seconds):
+        self.observe("query", seconds)
+
+    def check(self):
+        """0 to admit, else seconds until the averages decay under their thresholds."""
+        now = time.monotonic()
+        retry = 0.0
+        with self._lock:
+            for signal, limit in self.thresholds.items():
+                value = self._decayed(signal, now)
+                if limit and value > limit:
+                    retry = max(retry, self.half_life * math.log2(value / limit))
+        return retry
+
+    def pressure(self):
+        now = time.monotonic()
+        with self._lock:
+            return {signal: self._decayed(signal, now) for signal in self._values}
+
+
+class IngestLimiter:
+    """Admission control for ingest, checked before any connection is borrowed."""
+
+    def __init__(self, device, org, shedder, orgs):
+        self.device = device
+        self.org = org
+        self.shedder = shedder
+        self.orgs = orgs
+        self._admitted = 0
+        self._rejected = {"device_rate": 0, "org_rate": 0, "shed": 0}
+        self._lock = threading.Lock()
+
+    def admit(self, device_ids):
+        """Returns ``(reason, retry_after)``; ``reason`` is None when admitted.
+        ``device_ids`` has one entry per reading."""
+        retry = self.shedder.check()
+        if retry:
+            return self._reject("shed", retry)
+        counts = {}
+        for device_id in device_ids:
+            counts[device_id] = counts.get(device_id, 0) + 1
+        retry = self.device.take(counts)
+        if retry:
+            return self._reject("device_rate", retry)
+        if self.org.enabled:
+            org_counts = {}
+            for device_id, n in counts.items():
+                org_id = self.orgs.get(device_id)
+                if org_id is not None:
+                    org_counts[org_id] = org_counts.get(org_id, 0) + n
+            retry = self.org.take(org_counts)
+            if retry:
+                # The request never ran, so it must not eat into device budgets
+                self.device.refund(counts)
+                return self._reject("org_rate", retry)
+        with self._lock:
+            self._admitted += 1
+        return None, 0.0
+
+    def _reject(self, reason, retry):
+        INGEST_REJECTED.inc(reason)
+        with self._lock:
+            self._rejected[reason] += 1
+        return reason, retry
+
+    def stats(self):
+        with self._lock:
+            admitted, rejected = self._admitted, dict(self._rejected)
+        return {
+            "admitted": admitted,
+            "rejected": rejected,
+            "device_rate": self.device.rate,
+            "org_rate": self.org.rate,
+            "tracked_devices": len(self.device),
+            "tracked_orgs": len(self.org),
+            "pressure_ms": {k: round(v * 1000, 3) for k, v in self.shedder.pressure().items()},
+            "shed_thresholds_ms": {k: v * 1000 for k, v in self.shedder.thresholds.items()},
+        }
+
+
+def retry_after(seconds):
+    """Whole seconds for a Retry-After header (at least 1, capped at an hour,
+    which is also what a batch bigger than the burst gets)."""
+    return str(max(1, math.ceil(min(seconds, 3600))))
+
+
+load_shedder = LoadShedder(
+    max_wait_ms=float(os.getenv("SHED_POOL_WAIT_MS", "250")),
+    max_query_ms=float(os.getenv("SHED_QUERY_MS", "0")),
+    half_life=float(os.getenv("SHED_HALF_LIFE", "5")),
+)
+
+ingest_limiter = IngestLimiter(
+    device=TokenBuckets(
+        rate=float(os.getenv("RATE_LIMIT_DEVICE", "0")),
+        burst=float(os.getenv("RATE_LIMIT_DEVICE_BURST", "0")),
+    ),
+    org=TokenBuckets(
+        rate=float(os.getenv("RATE_LIMIT_ORG", "0")),
+        burst=float(os.getenv("RATE_LIMIT_ORG_BURST", "0")),
+    ),
+    shedder=load_shedder,
+    orgs=DeviceOrgs(ttl=float(os.getenv("RATE_LIMIT_ORG_REFRESH", "300"))),
+)
+
+metrics.gauge(
+    "ingest_pressure_seconds", "Decaying average of the write pool's borrow wait and statement time",
+    ("signal",), collect=lambda: [((signal,), value) for signal, value in load_shedder.pressure().items()],
+)
@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+from starlette.responses import Response
+
+
+class _Probe:
+    def __init__(self, cache, key, deps, versions, if_none_match, response=None):
+        self.cache = cache
+        self.key = key
+        self.deps = deps
+        self.versions = versions
+        self.if_none_match = if_none_match
+        self.response = response
+
+    def store(self, content):
+        return self.cache._store(self, content)
+
+
+class ResponseCache:
+    """In-process cache of JSON responses with version-based ETags.
+
+    Every cached route names the resources it depends on ("organisations",
+    "organisations/5", ...). Write routes ``bump`` those resources, which
+    invalidates exactly the entries built from them. ``ttl`` bounds how long
+    changes made outside this process can go unnoticed.
+    """
+
+    def __init__(self, ttl=300.0, enabled=True):
+        self.ttl = ttl
+        self.enabled = enabled
+        # Versions restart at 0 with the process; the boot id keeps old ETags from matching
+        self._boot = uuid.uuid4().hex[:8]
+        self._versions = {}
+        self._entries = {}  # key -> (versions, etag, body, expires_at)
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._not_modified = 0
+
+    def bump(self, *resources):
+        with self._lock:
+            for resource in resources:
+                self._versions[resource] = self._versions.get(resource, 0) + 1
+
+    def probe(self, request, key, deps):
+        """Look up ``key``; ``probe.response`` is set on a hit (200 or 304).
+
+        On a miss, build the content and return ``probe.store(content)``.
+        Versions are captured here, before the query runs, so a write that
+        lands mid-query invalidates what gets stored.
+        """
+        if_none_match = request.headers.get("if-none-match")
+        now = time.monotonic()
+        with self._lock:
+            versions = tuple(self._versions.get(d, 0) for d in deps)
+            entry = self._entries.get(key) if self.enabled else None
+            if entry and entry[0] == versions and entry[3] > now:
+                self._hits += 1
+                _, etag, body, _ = entry
+            else:
+                self._misses += 1
+                return _Probe(self, key, deps, versions, if_none_match)
+        return _Probe(self, key, deps, versions, if_none_match, self._respond(etag, body, if_none_match))
+
+    def _store(self, probe, content):
+        body = json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+        digest = hashlib.sha1(body).hexdigest()[:12]
+        etag = '"%s-%s-%s"' % (self._boot, ".".join(map(str, probe.versions)), digest)
+        if self.enabled:
+            with self._lock:
+                current = tuple(self._versions.get(d, 0) for d in probe.deps)
+                if current == probe.versions:
+                    self._entries[probe.key] = (probe.versions, etag, body, time.monotonic() + self.ttl)
+        return self._respond(etag, body, probe.if_none_match)
+
+    def _respond(self, etag, body, if_none_match):
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if if_none_match and etag in [t.strip() for t in if_none_match.split(",")]:
+            with self._lock:
+                self._not_modified += 1
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "ttl": self.ttl,
+                "hits": self._hits,
+                "misses": self._misses,
+                "not_modified": self._not_modified,
+            }
+
+
+response_cache = ResponseCache(
+    ttl=float(os.getenv("RESPONSE_CACHE_TTL", "300")),
+    enabled=os.getenv("RESPONSE_CACHE_ENABLED", "1") == "1",
+)
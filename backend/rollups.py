@@ -0,0 +1,340 @@
+import argparse
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from psycopg2.extras import execute_values
+
+
+HOUR = timedelta(hours=1)
+DAY = timedelta(days=1)
+
+TABLES = {"hour": "device_rollups_hourly", "day": "device_rollups_daily"}
+
+UPSERT = """
+    INSERT INTO {table} (device_id, bucket, total_ml, readings, min_ml, max_ml, first_ts, last_ts)
+    VALUES %s
+    ON CONFLICT (device_id, bucket) DO UPDATE SET
+        total_ml = {table}.total_ml + EXCLUDED.total_ml,
+        readings = {table}.readings + EXCLUDED.readings,
+        min_ml = LEAST({table}.min_ml, EXCLUDED.min_ml),
+        max_ml = GREATEST({table}.max_ml, EXCLUDED.max_ml),
+        first_ts = LEAST({table}.first_ts, EXCLUDED.first_ts),
+        last_ts = GREATEST({table}.last_ts, EXCLUDED.last_ts)
+"""
+
+
+# device_data.timestamp is WITHOUT time zone: Postgres drops any offset on
+# insert, so bucket on the wall-clock value the same way.
+def parse_ts(value):
+    if value is None or isinstance(value, datetime):
+        ts = value
+    else:
+        ts = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    return ts.replace(tzinfo=None) if ts is not None else None
+
+
+def floor_ts(ts, unit):
+    ts = ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(hour=0) if unit == "day" else ts
+
+
+def ceil_ts(ts, unit):
+    floored = floor_ts(ts, unit)
+    if floored == ts:
+        return ts
+    return floored + (DAY if unit == "day" else HOUR)
+
+
+def split_window(start, end, finest="day"):
+    """Split the inclusive window [start, end] into rollup and raw pieces.
+
+    Returns ``(source, lo, hi, hi_inclusive)`` tuples where source is "raw",
+    "hour" or "day"; ``None`` bounds are open. Whole days come from the
+    daily table (unless ``finest`` is "hour"), whole hours from the hourly
+    table, and only the sub-hour edges touch ``device_data``.
+    """
+    if start is not None and end is not None and start > end:
+        return []
+    h1 = ceil_ts(start, "hour") if start is not None else None
+    h2 = floor_ts(end, "hour") if end is not None else None
+    if h1 is not None and h2 is not None and h1 >= h2:
+        return [("raw", start, end, True)]
+
+    pieces = []
+    if start is not None and start < h1:
+        pieces.append(("raw", start, h1, False))
+
+    d1 = ceil_ts(h1, "day") if h1 is not None else None
+    d2 = floor_ts(h2, "day") if h2 is not None else None
+    if finest == "day" and (d1 is None or d2 is None or d1 < d2):
+        if h1 is not None and h1 < d1:
+            pieces.append(("hour", h1, d1, False))
+        pieces.append(("day", d1, d2, False))
+        if h2 is not None and d2 < h2:
+            pieces.append(("hour", d2, h2, False))
+    else:
+        pieces.append(("hour", h1, h2, False))
+
+    if end is not None:
+        pieces.append(("raw", h2, end, True))
+    return pieces
+
+
+def _union(pieces, device_id, trunc=None):
+    parts, params = [], []
+    for source, lo, hi, inclusive in pieces:
+        if source == "raw":
+            table, col, value = "device_data", "timestamp", "volume_ml"
+        else:
+            table, col, value = TABLES[source], "bucket", "total_ml"
+        period = f"date_trunc(%s, {col})" if trunc else "NULL::timestamp"
+        sql = f"SELECT {period} AS period, SUM({value})::bigint AS total FROM {table} WHERE device_id = %s"
+        if trunc:
+            params.append(trunc)
+        params.append(device_id)
+        if lo is not None:
+            sql += f" AND {col} >= %s"
+            params.append(lo)
+        if hi is not None:
+            sql += f" AND {col} {'<=' if inclusive else '<'} %s"
+            params.append(hi)
+        if trunc:
+            sql += " GROUP BY period"
+        parts.append(sql)
+    return " UNION ALL ".join(parts), params
+
+
+def totals_query(devices_sql, devices_params, start, end, use_rollups=True):
+    """SQL for ``(device_id, total, readings)`` over many devices at once.
+
+    ``devices_sql`` selects the device_id values to include. With
+    ``use_rollups`` the window is split as in ``split_window``; otherwise a
+    single grouped scan of ``device_data`` is used.
+    """
+    pieces = split_window(start, end) if use_rollups else [("raw", start, end, True)]
+    parts, params = [], []
+    for source, lo, hi, inclusive in pieces:
+        if source == "raw":
+            table, col, value, count = "device_data", "timestamp", "volume_ml", "COUNT(*)"
+        else:
+            table, col, value, count = TABLES[source], "bucket", "total_ml", "SUM(readings)"
+        sql = (
+            f"SELECT device_id, SUM({value})::bigint AS total, {count}::bigint AS readings"
+            f" FROM {table} WHERE device_id IN ({devices_sql})"
+        )
+        params.extend(devices_params)
+        if lo is not None:
+            sql += f" AND {col} >= %s"
+            params.append(lo)
+        if hi is not None:
+            sql += f" AND {col} {'<=' if inclusive else '<'} %s"
+            params.append(hi)
+        parts.append(sql + " GROUP BY device_id")
+    if not parts:
+        return "SELECT NULL::varchar AS device_id, 0::bigint AS total, 0::bigint AS readings WHERE FALSE", []
+    union = " UNION ALL ".join(parts)
+    return (
+        f"SELECT device_id, SUM(total)::bigint AS total, SUM(readings)::bigint AS readings"
+        f" FROM ({union}) t GROUP BY device_id"
+    ), params
+
+
+class Rollups:
+    """Per-device hourly and daily aggregates kept in step with ingest.
+
+    Reads only use the rollups once a full rebuild has been recorded in
+    ``rollup_state``; until then callers fall back to raw ``device_data``.
+    """
+
+    def __init__(self, enabled=True, ready_ttl=60.0):
+        self.enabled = enabled
+        self.ready_ttl = ready_ttl
+        self._active = False
+        self._ready = False
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def setup(self, pool):
+        if not self.enabled:
+            return
+        with pool.connection() as conn:
+            cursor = conn.cursor()
+            # Nothing to backfill on an empty database
+            cursor.execute("""
+                INSERT INTO rollup_state (name, completed_at)
+                SELECT 'backfill', NOW() WHERE NOT EXISTS (SELECT 1 FROM device_data)
+                ON CONFLICT (name) DO NOTHING
+            """)
+            conn.commit()
+            cursor.close()
+        self._active = True
+
+    # The read side (ready, window_total, histogram) runs on the async pool
+    # and takes a psycopg 3 cursor from aiodb.adb; writes stay on psycopg2.
+    async def ready(self, cursor):
+        if not self._active:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            if now - self._checked < self.ready_ttl:
+                return self._ready
+        await cursor.execute("SELECT 1 FROM rollup_state WHERE name = 'backfill'")
+        ready = await cursor.fetchone() is not None
+        with self._lock:
+            self._ready, self._checked = ready, now
+        return ready
+
+    # Fold freshly inserted (device_id, volume_ml, timestamp) rows into the
+    # rollups, inside the same transaction as the insert.
+    def apply(self, cursor, rows):
+        if not self._active:
+            return
+        for unit, table in TABLES.items():
+            buckets = {}
+            for device_id, volume_ml, ts in rows:
+                ts = parse_ts(ts)
+                key = (device_id, floor_ts(ts, unit))
+                agg = buckets.get(key)
+                if agg is None:
+                    buckets[key] = [volume_ml, 1, volume_ml, volume_ml, ts, ts]
+                else:
+                    agg[0] += volume_ml
+                    agg[1] += 1
+                    agg[2] = min(agg[2], volume_ml)
+                    agg[3] = max(agg[3], volume_ml)
+                    agg[4] = min(agg[4], ts)
+                    agg[5] = max(agg[5], ts)
+            # Sorted so concurrent writers lock bucket rows in the same order
+            values = [key + tuple(agg) for key, agg in sorted(buckets.items())]
+            execute_values(cursor, UPSERT.format(table=table), values, page_size=1000)
+
+    async def window_total(self, cursor, device_id, start, end):
+        sql, params = _union(split_window(start, end), device_id)
+        if not sql:
+            return 0
+        await cursor.execute(f"SELECT COALESCE(SUM(total), 0)::bigint FROM ({sql}) t", params)
+        return (await cursor.fetchone())[0]
+
+    async def histogram(self, cursor, device_id, start, end, interval="day"):
+        sql, params = _union(split_window(start, end, finest=interval), device_id, trunc=interval)
+        if not sql:
+            return []
+        await cursor.execute(
+            f"SELECT period, SUM(total)::bigint FROM ({sql}) t GROUP BY period ORDER BY period",
+            params
+        )
+        return await cursor.fetchall()
+
+    # Raw readings before this point were dropped by retention (see
+    # partitions.py) and survive only as rollups; rollup_state.completed_at
+    # holds the boundary under the name 'raw_from'.
+    def raw_from(self, cursor):
+        cursor.execute("SELECT completed_at FROM rollup_state WHERE name = 'raw_from'")
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def rebuild(self, conn, device_id=None, start=None, end=None, chunk_days=31):
+        """Recompute rollups from device_data, one chunk of days per transaction.
+
+        The rollup tables are locked against concurrent ingest while a chunk
+        is rebuilt. A full rebuild (no device or window) marks the rollups ready.
+        """
+        full = device_id is None and start is None and end is None
+        cursor = conn.cursor()
+        self._active = True
+        raw_from = self.raw_from(cursor)
+
+        if start is None or end is None:
+            sql = "SELECT MIN(timestamp), MAX(timestamp) FROM device_data"
+            params = ()
+            if device_id:
+                sql += " WHERE device_id = %s"
+                params = (device_id,)
+            cursor.execute(sql, params)
+            lo, hi = cursor.fetchone()
+            start = start if start is not None else lo
+            end = end if end is not None else hi
+
+        # Buckets older than the retained raw data cannot be recomputed
+        if raw_from is not None and start is not None and start < raw_from:
+            start = raw_from
+
+        chunks = 0
+        if start is not None and end is not None:
+            lo = floor_ts(start, "day")
+            hi = floor_ts(end, "day") + DAY
+            while lo < hi:
+                chunk_hi = min(lo + timedelta(days=chunk_days), hi)
+                self._rebuild_range(cursor, device_id, lo, chunk_hi)
+                conn.commit()
+                chunks += 1
+                lo = chunk_hi
+
+        if full:
+            cursor.execute("""
+                INSERT INTO rollup_state (name, completed_at) VALUES ('backfill', NOW())
+                ON CONFLICT (name) DO UPDATE SET completed_at = EXCLUDED.completed_at
+            """)
+            conn.commit()
+        cursor.close()
+        with self._lock:
+            self._checked = 0.0
+        return chunks
+
+    def _rebuild_range(self, cursor, device_id, lo, hi):
+        cursor.execute("LOCK TABLE device_rollups_hourly, device_rollups_daily IN EXCLUSIVE MODE")
+        device_filter = " AND device_id = %s" if device_id else ""
+        extra = (device_id,) if device_id else ()
+
+        for table in TABLES.values():
+            cursor.execute(
+                f"DELETE FROM {table} WHERE bucket >= %s AND bucket < %s{device_filter}",
+                (lo, hi) + extra
+            )
+        cursor.execute(f"""
+            INSERT INTO device_rollups_hourly (device_id, bucket, total_ml, readings, min_ml, max_ml, first_ts, last_ts)
+            SELECT device_id, date_trunc('hour', timestamp), SUM(volume_ml), COUNT(*),
+                   MIN(volume_ml), MAX(volume_ml), MIN(timestamp), MAX(timestamp)
+            FROM device_data
+            WHERE timestamp >= %s AND timestamp < %s{device_filter}
+            GROUP BY 1, 2
+        """, (lo, hi) + extra)
+        cursor.execute(f"""
+            INSERT INTO device_rollups_daily (device_id, bucket, total_ml, readings, min_ml, max_ml, first_ts, last_ts)
+            SELECT device_id, date_trunc('day', bucket), SUM(total_ml), SUM(readings),
+                   MIN(min_ml), MAX(max_ml), MIN(first_ts), MAX(last_ts)
+            FROM device_rollups_hourly
+            WHERE bucket >= %s AND bucket < %s{device_filter}
+            GROUP BY 1, 2
+        """, (lo, hi) + extra)
+
+
+rollups = Rollups(enabled=os.getenv("ROLLUPS_ENABLED", "1") == "1")
+
+
+# python rollups.py rebuild [--device ID] [--start TS] [--end TS]
+def main(argv=None):
+    from db import get_connection
+
+    parser = argparse.ArgumentParser(description="Maintain device_data rollups")
+    sub = parser.add_subparsers(dest="command", required=True)
+    rebuild = sub.add_parser("rebuild", help="backfill / rebuild rollups from device_data")
+    rebuild.add_argument("--device", help="only this device_id")
+    rebuild.add_argument("--start", type=parse_ts, help="window start (ISO timestamp)")
+    rebuild.add_argument("--end", type=parse_ts, help="window end (ISO timestamp)")
+    rebuild.add_argument("--chunk-days", type=int, default=31)
+    args = parser.parse_args(argv)
+
+    conn = get_connection()
+    try:
+        started = time.monotonic()
+        chunks = rollups.rebuild(conn, args.device, args.start, args.end, args.chunk_days)
+        print(f"Rebuilt {chunks} chunk(s) in {time.monotonic() - started:.1f}s")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
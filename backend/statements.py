@@ -0,0 +1,106 @@
+import os
+import re
+import threading
+import weakref
+
+from metrics import metrics
+
+DB_PREPARES = metrics.counter(
+    "db_statement_prepares_total", "Registered statements parsed and planned on a connection, by name", ("statement",),
+)
+DB_EXECUTIONS = metrics.counter(
+    "db_statement_executions_total", "Registered statements executed, by name", ("statement",),
+)
+
+
+class Statement:
+    __slots__ = ("name", "sql", "prepares", "executions")
+
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+        self.prepares = 0
+        self.executions = 0
+
+
+class StatementRegistry:
+    """Hot statements prepared on each connection the first time they run
+    there, then executed by name, so Postgres parses and plans them once per
+    connection instead of once per request.
+
+    Async (psycopg 3) cursors use the driver's own prepared-statement cache
+    (``prepare=True``); psycopg2 cursors get an explicit ``PREPARE`` and then
+    ``EXECUTE``. Either way the connections must be long-lived and not
+    behind a transaction-pooling proxy: set ``DB_PREPARE=0`` there and the
+    statements run as plain queries.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._statements = {}
+        self._prepared = weakref.WeakKeyDictionary()  # connection -> names prepared on it
+        self._lock = threading.Lock()
+
+    def register(self, name, sql):
+        """Idempotent; a name always maps to the same SQL."""
+        with self._lock:
+            stmt = self._statements.get(name)
+            if stmt is None:
+                stmt = self._statements[name] = Statement(name, sql)
+            elif stmt.sql != sql:
+                raise ValueError(f"statement {name!r} is already registered with different SQL")
+            return stmt
+
+    def _first_use(self, conn, stmt):
+        with self._lock:
+            names = self._prepared.setdefault(conn, set())
+            first = stmt.name not in names
+            if first:
+                names.add(stmt.name)
+                stmt.prepares += 1
+            stmt.executions += 1
+        if first:
+            DB_PREPARES.inc(stmt.name)
+        DB_EXECUTIONS.inc(stmt.name)
+        return first
+
+    async def execute(self, cursor, stmt, params=None):
+        """Run ``stmt`` on a psycopg 3 async cursor."""
+        if self.enabled:
+            self._first_use(cursor.connection, stmt)
+        return await cursor.execute(stmt.sql, params, prepare=self.enabled)
+
+    def execute_sync(self, cursor, stmt, params=None):
+        """Run ``stmt`` on a psycopg2 cursor (``%s`` placeholders only)."""
+        if not self.enabled:
+            return cursor.execute(stmt.sql, params)
+        if self._first_use(cursor.connection, stmt):
+            try:
+                cursor.execute(f"PREPARE {stmt.name} AS {_numbered(stmt.sql)}")
+            except Exception:
+                # Not prepared after all; the next use tries again
+                with self._lock:
+                    self._prepared.get(cursor.connection, set()).discard(stmt.name)
+                raise
+        placeholders = ", ".join(["%s"] * len(params or ()))
+        return cursor.execute(f"EXECUTE {stmt.name} ({placeholders})" if placeholders else f"EXECUTE {stmt.name}", params)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "connections": len(self._prepared),
+                "statements": {
+                    s.name: {"prepares": s.prepares, "executions": s.executions}
+                    for s in self._statements.values()
+                },
+            }
+
+
+def _numbered(sql):
+    """``%s`` placeholders to ``$1, $2, ...`` for PREPARE."""
+    count = iter(range(1, sql.count("%s") + 1))
+    return re.sub(r"%s", lambda _: f"${next(count)}", sql)
+
+
+statements = StatementRegistry(enabled=os.getenv("DB_PREPARE", "1") == "1")
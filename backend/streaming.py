@@ -0,0 +1,62 @@
+import json
+import os
+
+from fastapi import HTTPException
+from starlette.responses import StreamingResponse
+
+
+STREAM_CHUNK_ROWS = int(os.getenv("STREAM_CHUNK_ROWS", "5000"))
+
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "json": "application/json"}
+
+
+def dumps(obj):
+    # Same encoding as JSONResponse
+    return json.dumps(obj, ensure_ascii=False, allow_nan=False, separators=(",", ":"))
+
+
+async def ndjson_body(chunks, to_dict):
+    async for rows in chunks:
+        yield "".join(dumps(to_dict(row)) + "\n" for row in rows)
+
+
+async def json_array_body(chunks, to_dict, head="[", tail=lambda: "]"):
+    yield head
+    first = True
+    async for rows in chunks:
+        body = ",".join(dumps(to_dict(row)) for row in rows)
+        yield body if first else "," + body
+        first = False
+    yield tail()
+
+
+async def stream_rows(db, sql, params, to_dict, fmt, head="[", tail=lambda: "]", empty_detail=None):
+    """Stream a query as NDJSON (``fmt="ndjson"``) or a JSON array (``"json"``).
+
+    The first chunk is fetched before the response starts so an empty result
+    can still be answered with a 404 when ``empty_detail`` is given.
+    """
+    if fmt not in MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="stream must be 'ndjson' or 'json'")
+
+    chunks = db.iter_query(sql, params, STREAM_CHUNK_ROWS)
+    first = await anext(chunks, None)
+    if first is None and empty_detail:
+        raise HTTPException(status_code=404, detail=empty_detail)
+
+    async def all_chunks():
+        # Closing the query generator returns its connection even when the
+        # client disconnects mid-stream and Starlette cancels the body
+        try:
+            if first is not None:
+                yield first
+                async for rows in chunks:
+                    yield rows
+        finally:
+            await chunks.aclose()
+
+    if fmt == "ndjson":
+        body = ndjson_body(all_chunks(), to_dict)
+    else:
+        body = json_array_body(all_chunks(), to_dict, head, tail)
+    return StreamingResponse(body, media_type=MEDIA_TYPES[fmt])
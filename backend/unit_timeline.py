@@ -0,0 +1,173 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from aiodb import listener
+
+CHANNEL = "unit_devices_changed"
+
+INTERVALS_SQL = """
+    SELECT d.device_id, d.id, ud.attached_at, ud.detached_at, ud.active
+    FROM unit_devices ud
+    JOIN devices d ON d.id = ud.device_id
+    WHERE ud.unit_id = %s
+    ORDER BY ud.attached_at, ud.id
+"""
+
+# Open ends of an interval or window; both fit in a Postgres timestamp
+NEVER = datetime.min
+FOREVER = datetime.max
+
+DATA_COLUMNS = ("timestamp", "volume_ml", "device_id", "device_pk")
+PAGE_COLUMNS = DATA_COLUMNS + ("id",)
+
+
+class UnitTimeline:
+    """Cache of each unit's device attachments:
+    ``[(device_id, device_pk, attached_at, detached_at, active)]``, oldest first.
+
+    Loaded with one small query per unit and dropped when ``unit_devices``
+    changes (the trigger from migration 0003 NOTIFYs the unit id), after a
+    listener reconnect, or after ``ttl`` seconds as a backstop for databases
+    without the trigger.
+    """
+
+    def __init__(self, capacity=10000, ttl=300.0):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._entries = OrderedDict()  # unit_id -> (intervals, expires_at)
+        self._generation = 0           # bumped on every invalidation
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+        listener.subscribe(CHANNEL, self._on_notify, self.clear)
+
+    async def get(self, db, unit_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(unit_id)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(unit_id)
+                self._hits += 1
+                return entry[0]
+            self._misses += 1
+            generation = self._generation
+
+        async with db.connection() as conn:
+            cursor = conn.cursor()
+            await cursor.execute(INTERVALS_SQL, (unit_id,))
+            intervals = await cursor.fetchall()
+            await cursor.close()
+
+        with self._lock:
+            # An invalidation while we were loading may make this stale
+            if generation == self._generation:
+                self._entries[unit_id] = (intervals, time.monotonic() + self.ttl)
+                self._entries.move_to_end(unit_id)
+                while len(self._entries) > self.capacity:
+                    self._entries.popitem(last=False)
+        return intervals
+
+    def invalidate(self, unit_id):
+        with self._lock:
+            self._generation += 1
+            self._invalidations += 1
+            self._entries.pop(unit_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def _on_notify(self, payload):
+        try:
+            self.invalidate(int(payload))
+        except ValueError:
+            self.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "size": len(self._entries),
+                "capacity": self.capacity,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_ratio": round(self._hits / lookups, 4) if lookups else 0.0,
+                "invalidations": self._invalidations,
+            }
+
+
+def current_device(intervals):
+    """The most recently attached active device, as ``(device_pk, device_id)``."""
+    for device_id, device_pk, _, _, active in reversed(intervals):
+        if active:
+            return device_pk, device_id
+    return None
+
+
+def ranges(intervals, start=None, end=None, clip=True):
+    """``[(device_id, device_pk, lo, hi)]`` to scan: readings with
+    ``lo <= timestamp < hi`` and ``timestamp <= end``. ``clip=False``
+    ignores attachment windows (every device the unit ever had, whole
+    history). Ranges outside the window are dropped."""
+    start = start or NEVER
+    end = end or FOREVER
+    if not clip:
+        seen = {}
+        for device_id, device_pk, _, _, _ in intervals:
+            seen.setdefault(device_id, device_pk)
+        return [(device_id, device_pk, start, FOREVER) for device_id, device_pk in seen.items()]
+    out = []
+    for device_id, device_pk, attached_at, detached_at, _ in intervals:
+        lo = max(attached_at, start)
+        hi = detached_at or FOREVER
+        if lo < hi and lo <= end:
+            out.append((device_id, device_pk, lo, hi))
+    return out
+
+
+def rows_query(scans, end=None, columns=DATA_COLUMNS, after=None, limit=None):
+    """``(sql, params)`` reading ``scans`` (from ``ranges``) as one UNION ALL
+    of per-device range scans on (device_id, timestamp), which Postgres
+    merges in timestamp order (Merge Append) without joining unit_devices or
+    devices.
+
+    With ``id`` among the columns rows are ordered by (timestamp, id), and
+    ``after`` is a ``(timestamp, id)`` keyset to continue from.
+    """
+    end = end or FOREVER
+    select = ", ".join("%s::int AS device_pk" if c == "device_pk" else c for c in columns)
+    order = "timestamp, id" if "id" in columns else "timestamp"
+    branch = f"SELECT {select} FROM device_data WHERE device_id = %s AND timestamp >= %s AND timestamp < %s AND timestamp <= %s"
+    if after:
+        branch += " AND (timestamp, id) > (%s, %s)"
+    # Ordering each branch is what lets the planner use a Merge Append over
+    # the index scans; without it the whole union is sorted
+    branch = f"({branch} ORDER BY {order})"
+    pk = "device_pk" in columns
+
+    params = []
+    branches = []
+    for device_id, device_pk, lo, hi in scans:
+        branches.append(branch)
+        params.extend(([device_pk] if pk else []) + [device_id, lo, hi, end] + (list(after) if after else []))
+    if not branches:
+        # Same columns, no rows
+        branches.append(f"SELECT {select} FROM device_data WHERE false")
+        params.extend([None] if pk else [])
+
+    sql = "SELECT {} FROM ({}) t ORDER BY {}".format(", ".join(columns), " UNION ALL ".join(branches), order)
+    if limit is not None:
+        sql += " LIMIT %s"
+        params.append(limit)
+    return sql, tuple(params)
+
+
+unit_timeline = UnitTimeline(
+    capacity=int(os.getenv("UNIT_TIMELINE_SIZE", "10000")),
+    ttl=float(os.getenv("UNIT_TIMELINE_TTL", "300")),
+)
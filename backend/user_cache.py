@@ -0,0 +1,91 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class UserCache:
+    """TTL + LRU cache of the user principal behind an ``email`` cookie.
+
+    Unknown emails are cached too (as ``None``) so a bad cookie does not hit
+    the database on every request. Writers must call ``invalidate_*`` after
+    changing a user; main.py also NOTIFYs the change so every worker does.
+    """
+
+    def __init__(self, capacity=10000, ttl=60.0):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._entries = OrderedDict()  # email -> (user or None, expires_at)
+        self._emails = {}              # user id -> email, for invalidation
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._hit_time = 0.0
+        self._miss_time = 0.0
+
+    def get(self, email):
+        """Return ``(found, user)``; ``user`` is a copy safe to hand to a request."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(email)
+            if entry is None or entry[1] < now:
+                return False, None
+            self._entries.move_to_end(email)
+            user = entry[0]
+        return True, dict(user) if user else None
+
+    def put(self, email, user):
+        with self._lock:
+            self._entries[email] = (dict(user) if user else None, time.monotonic() + self.ttl)
+            self._entries.move_to_end(email)
+            if user:
+                self._emails[user["id"]] = email
+            while len(self._entries) > self.capacity:
+                _, (old, _) = self._entries.popitem(last=False)
+                if old:
+                    self._emails.pop(old["id"], None)
+
+    def invalidate_email(self, email):
+        with self._lock:
+            entry = self._entries.pop(email, None)
+            if entry and entry[0]:
+                self._emails.pop(entry[0]["id"], None)
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            email = self._emails.pop(user_id, None)
+            if email is not None:
+                self._entries.pop(email, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._emails.clear()
+
+    # Time spent resolving the principal, split by cache outcome
+    def record(self, elapsed, hit):
+        with self._lock:
+            if hit:
+                self._hits += 1
+                self._hit_time += elapsed
+            else:
+                self._misses += 1
+                self._miss_time += elapsed
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "capacity": self.capacity,
+                "ttl": self.ttl,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_ms_avg": round(self._hit_time * 1000 / self._hits, 4) if self._hits else 0.0,
+                "miss_ms_avg": round(self._miss_time * 1000 / self._misses, 4) if self._misses else 0.0,
+            }
+
+
+user_cache = UserCache(
+    capacity=int(os.getenv("USER_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("USER_CACHE_TTL", "60")),
+)